@@ -0,0 +1,71 @@
+"""
+dropbox_byte_pool.py
+
+Measures how long DropboxWriter.append_bytes takes to pool and cut chunks as
+the size of each read grows, alongside the previous implementation that
+concatenated bytes objects. The pooled cost should grow linearly with the
+bytes appended, so the time per MB stays flat.
+
+Usage, from the repository root:
+    PYTHONPATH=. python3 ancillary/benchmarks/dropbox_byte_pool.py
+"""
+
+import os
+import time
+from watchtower.streamer.writer.dropbox_writer import DropboxWriter
+
+FILE_CHUNK_SIZE = 1024*1024  # file_chunk_kb of 1024
+TOTAL_BYTES = 64*1024*1024
+READ_SIZES = [64*1024, 256*1024, 1024*1024, 2560*1024, 8*1024*1024]
+
+
+class NullUploader:
+    def files_upload(self, bts, path):
+        pass
+
+
+class ConcatenatingPool:
+    """
+    The previous DropboxWriter pooling, without the uploads.
+    """
+
+    def __init__(self, file_chunk_size):
+        self.file_chunk_size = file_chunk_size
+        self.byte_pool = b''
+
+    def append_bytes(self, bts, close=False):
+        self.byte_pool += bts
+        if len(self.byte_pool) < self.file_chunk_size and not close:
+            return
+        sub_bytes = self.byte_pool[:self.file_chunk_size]
+        while len(sub_bytes) == self.file_chunk_size:
+            self.byte_pool = self.byte_pool[self.file_chunk_size:]
+            sub_bytes = self.byte_pool[:self.file_chunk_size]
+        self.byte_pool = sub_bytes
+
+
+def measure(writer, data, read_size):
+    start_time = time.perf_counter()
+    for i in range(0, TOTAL_BYTES, read_size):
+        writer.append_bytes(memoryview(data)[i:i+read_size], close=(i + read_size >= TOTAL_BYTES))
+    return time.perf_counter() - start_time
+
+
+def main():
+    data = os.urandom(TOTAL_BYTES)
+    print('%10s %16s %16s' % ('read KB', 'concat ms/MB', 'pooled ms/MB'))
+    for read_size in READ_SIZES:
+        concat_time = measure(ConcatenatingPool(FILE_CHUNK_SIZE), data, read_size)
+        writer = DropboxWriter('/benchmark/video.h264',
+                               dropbox_token=None,
+                               file_chunk_size=FILE_CHUNK_SIZE,
+                               test_dropbox_uploader=NullUploader())
+        pooled_time = measure(writer, data, read_size)
+        while not writer.is_finished_writing():
+            time.sleep(0.05)
+        megabytes = TOTAL_BYTES / (1024*1024)
+        print('%10d %16.3f %16.3f' % (read_size // 1024, concat_time * 1000 / megabytes, pooled_time * 1000 / megabytes))
+
+
+if __name__ == '__main__':
+    main()
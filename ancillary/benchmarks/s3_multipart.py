@@ -0,0 +1,43 @@
+"""
+s3_multipart.py
+
+Measures how fast S3Writer uploads a recording to the local stand-in server
+as the number of connections grows. Each request is delayed to emulate the
+round trip to a remote store, so throughput should grow with the number of
+parts uploaded in parallel.
+
+Usage, from the repository root:
+    PYTHONPATH=. python3 ancillary/benchmarks/s3_multipart.py
+"""
+
+import os
+import time
+from watchtower.streamer.writer.s3_writer import S3Client, S3Writer
+from watchtower.util.local_s3 import LocalS3Server
+
+PART_SIZE = 5*1024*1024
+TOTAL_BYTES = 100*1024*1024
+READ_SIZE = 256*1024
+LATENCY = 0.2  # In seconds
+CONNECTIONS = [1, 2, 4, 8]
+
+
+def main():
+    data = os.urandom(TOTAL_BYTES)
+    server = LocalS3Server(bucket='benchmark', latency=LATENCY)
+    server.start()
+    print('%12s %10s' % ('connections', 'MB/s'))
+    for connections in CONNECTIONS:
+        client = S3Client(server.endpoint, 'benchmark', 'access', 'secret', max_connections=connections)
+        writer = S3Writer('/benchmark/video.h264', client, part_size=PART_SIZE)
+        start_time = time.perf_counter()
+        for i in range(0, TOTAL_BYTES, READ_SIZE):
+            writer.append_bytes(memoryview(data)[i:i+READ_SIZE], close=(i + READ_SIZE >= TOTAL_BYTES))
+        elapsed = time.perf_counter() - start_time
+        assert(server.objects['benchmark/video.h264'] == data)
+        print('%12d %10.1f' % (connections, TOTAL_BYTES / (1024*1024) / elapsed))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,77 @@
 import argparse
 import base64
+import struct
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 """
 John Newman
 April 8, 2019
 
-This program is used for decrypting files encrypted by watchtower. The first
-bytes of the file contain the character length (int) of the encrypted Fernet
-key. The key is expected to be base64 encoded and to appear in the file
+This program is used for decrypting files encrypted by watchtower. Two file
+formats are supported.
+
+Files beginning with b'WTE1' hold a header and AES-256-GCM records:
+"WTE1{version}{algorithm}{record_size}{key_length}{encrypted_key}{nonce_prefix}{records}"
+The records are decrypted one at a time, so the whole file is never held in
+memory. See watchtower/streamer/writer/encryption.py for the full layout.
+
+Older files contain the character length (int) of the encrypted Fernet key
+first. The key is expected to be base64 encoded and to appear in the file
 following the length and a space.
 
 File format:
 "{length_int} {encoded_encrypted_key}{encrypted_data}"
 
-The supplied private pem path is used to decrypt the Fernet key.
+The supplied private pem path is used to decrypt the AES or Fernet key.
 """
 
+MAGIC = b'WTE1'
+HEADER_FORMAT = '>4sBBIH'
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                            algorithm=hashes.SHA256(),
+                            label=None)
+
+
+def decrypt_records(private_key, encrypted_file, output_file):
+    header = encrypted_file.read(struct.calcsize(HEADER_FORMAT))
+    magic, version, algorithm, record_size, key_size = struct.unpack(HEADER_FORMAT, header)
+    if version != 1 or algorithm != 1:
+        raise ValueError('Unsupported file version %d or algorithm %d.' % (version, algorithm))
+    encrypted_key = encrypted_file.read(key_size)
+    nonce_prefix = encrypted_file.read(NONCE_PREFIX_SIZE)
+    header += encrypted_key + nonce_prefix
+    aesgcm = AESGCM(private_key.decrypt(encrypted_key, OAEP_PADDING))
+
+    index = 0
+    record = encrypted_file.read(record_size + TAG_SIZE)
+    while True:
+        # A record is only known to be the final one once the file ends.
+        next_record = encrypted_file.read(record_size + TAG_SIZE)
+        final = len(next_record) == 0
+        nonce = nonce_prefix + struct.pack('>I', index)
+        output_file.write(aesgcm.decrypt(nonce, record, header + (b'\x01' if final else b'\x00')))
+        if final:
+            break
+        record = next_record
+        index += 1
+
+
+def decrypt_fernet(private_key, encrypted_file, output_file):
+    file_string = encrypted_file.read()
+    separator = file_string.find(b' ')
+    key_size = int(file_string[:separator])
+    encrypted_key = base64.b64decode(file_string[separator+1:key_size+separator+1])
+    decrypted_key = private_key.decrypt(encrypted_key, OAEP_PADDING)
+    f = Fernet(decrypted_key)
+    output_file.write(f.decrypt(file_string[separator + key_size:]))
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-k', '--private-pem', type=str, help='path to the private key', required=True)
 parser.add_argument('-i', '--file-path', type=str, help='path to encrypted file', required=True)
@@ -32,15 +84,10 @@ with open(supplied_args['private_pem'], 'rb') as key_file:
                                                      password=None,
                                                      backend=default_backend())
     with open(supplied_args['file_path'], 'rb') as encrypted_file:
-        file_string = encrypted_file.read()
-        separator = file_string.find(b' ')
-        key_size = int(file_string[:separator])
-        encrypted_key = base64.b64decode(file_string[separator+1:key_size+separator+1])
-        decrypted_key = private_key.decrypt(encrypted_key,
-                                            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                         algorithm=hashes.SHA256(),
-                                                         label=None))
-        f = Fernet(decrypted_key)
-        decrypted_data = f.decrypt(file_string[separator + key_size:])
+        is_record_format = encrypted_file.read(len(MAGIC)) == MAGIC
+        encrypted_file.seek(0)
         with open(supplied_args['output_path'], 'ab') as output_file:
-            output_file.write(decrypted_data)
+            if is_record_format:
+                decrypt_records(private_key, encrypted_file, output_file)
+            else:
+                decrypt_fernet(private_key, encrypted_file, output_file)
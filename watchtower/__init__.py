@@ -6,17 +6,21 @@ RunLoop thread is started when the app is initialized.
 """
 
 from datetime import datetime
-from flask import Flask, Response, jsonify, request, stream_with_context, render_template, send_from_directory
+from urllib.parse import quote
+from flask import Flask, Response, jsonify, request, stream_with_context, render_template, send_from_directory, url_for
 import json
 import logging.config
+import mimetypes
 import os
 import picamera
 import time
 from .remote.servo import Servo
 from .run_loop import RunLoop
-from .streamer.mjpeg_streamer import MJPEGStreamer
+from .streamer.live_server import LiveStreamServer
+from .streamer.mjpeg_streamer import parse_stream_options
 from .streamer.writer import http_writer
 from .util import file_system as fs
+from .util.mp4_remux import RemuxedMP4, SampleIndexWriter
 
 __author__ = "John Newman"
 __copyright__ = "Copyright 2020, John Newman"
@@ -25,6 +29,8 @@ __version__ = "1.6.0"
 __maintainer__ = "John Newman"
 __status__ = "Production"
 
+DEFAULT_MJPEG_RATE = 4  # Frames per second sent to MJPEG viewers by default
+
 def setup_logging(app):
     with open(os.environ.get('LOG_CONFIG'), 'r') as log_config_file:
         logging.config.dictConfig(json.load(log_config_file))
@@ -52,6 +58,18 @@ def create_app(test_config=None):
             logging.getLogger(__name__).info('Adding web app routes.')
 
     main.start()
+
+    # nginx proxies every live stream to this event loop. The Flask MJPEG
+    # routes remain available for running without nginx.
+    live_stream_socket = os.environ.get('LIVE_STREAM_SOCKET')
+    if live_stream_socket:
+        LiveStreamServer(main.mjpeg_broadcast,
+                         socket_path=live_stream_socket,
+                         default_rate=DEFAULT_MJPEG_RATE,
+                         web_app_enabled=(app.config.get('WEB_APP_ENABLED') == True)).start()
+    else:
+        logging.getLogger(__name__).warning('LIVE_STREAM_SOCKET is not set, so live streams are only served by uWSGI. '
+                                            'Live streams proxied by nginx will fail until it is added to .env.')
     return app
 
 def add_api_routes(app, main_loop):
@@ -61,6 +79,9 @@ def add_api_routes(app, main_loop):
 
     day_format = app.config['DIR_DAY_FORMAT']
     time_format = app.config['DIR_TIME_FORMAT']
+    # The internal nginx location that serves the recordings directory, if
+    # recording files are handed off to nginx.
+    accel_path = app.config.get('RECORDINGS_ACCEL_PATH')
 
     @app.route('/api/status')
     def status():
@@ -90,15 +111,61 @@ def add_api_routes(app, main_loop):
         main_loop.camera.should_record = True
         return '', 204
 
+    def listing_response(list_page):
+        """
+        Responds with a page of a listing from the recordings index. The
+        response's ETag changes whenever a recording is saved or deleted, and
+        a request with a matching If-None-Match header gets a 304 without
+        listing anything. When the listing has more pages, a Link header holds
+        the URL of the next one.
+
+        :param list_page: a function taking the request's cursor and limit,
+        and returning the page and the next page's cursor or None.
+        """
+        try:
+            limit = request.args.get('limit')
+            if limit is not None:
+                limit = int(limit)
+                if limit <= 0:
+                    raise ValueError('limit must be positive.')
+            # Read the ETag first, so it's never newer than the listing.
+            etag = main_loop.recording_index.etag
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                page, cursor = list_page(request.args.get('cursor'), limit)
+                response = jsonify(page)
+                if cursor is not None:
+                    args = dict(request.view_args, **request.args.to_dict())
+                    args['cursor'] = cursor
+                    response.headers['Link'] = '<%s>; rel="next"' % url_for(request.endpoint, **args)
+        except ValueError:
+            return '', 422
+        response.set_etag(etag)
+        # Clients must revalidate, since recordings change at any time.
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
     @app.route('/api/recordings')
     def recordings():
         """
-        GET all recordings in Watchtower.
+        GET all recordings in Watchtower. The optional since and until
+        parameters limit the listing to a range of days.
+        """
+        return listing_response(lambda cursor, limit: main_loop.recording_index.recordings_page(
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            cursor=cursor,
+            limit=limit
+        ))
+
+    @app.route('/api/recordings/reindex', methods=['POST'])
+    def reindex_recordings():
+        """
+        POST to rebuild the recordings index from the recordings directory.
         """
-        recordings = fs.all_recordings(path=os.path.join(app.instance_path, 'recordings'),
-                                       day_format=day_format,
-                                       time_format=time_format)
-        return jsonify(recordings), 200
+        main_loop.recording_index.rebuild()
+        return jsonify(main_loop.recording_index.all_recordings()), 200
 
     @app.route('/api/recordings/<day>', methods=['GET', 'DELETE'])
     def recordings_for_day(day):
@@ -109,10 +176,11 @@ def add_api_routes(app, main_loop):
             return delete_recording(day)
         try:
             if datetime.strptime(day, day_format) is not None:
-                times = fs.all_recording_times_for_day(path=os.path.join(app.instance_path, 'recordings'),
-                                                       day_dirname=day,
-                                                       time_format=time_format)
-                return jsonify(times), 200
+                return listing_response(lambda cursor, limit: main_loop.recording_index.recording_times_page(
+                    day,
+                    cursor=cursor,
+                    limit=limit
+                ))
         except ValueError:
             pass
         return '', 422
@@ -132,7 +200,8 @@ def add_api_routes(app, main_loop):
                 if time is None or datetime.strptime(time, time_format) is not None:
                     successful = fs.delete_recording(path=os.path.join(app.instance_path, 'recordings'),
                                                      day_dirname=day,
-                                                     time_dirname=time)
+                                                     time_dirname=time,
+                                                     index=main_loop.recording_index)
                     if successful:
                         return '', 204
                     return '', 404
@@ -150,27 +219,118 @@ def add_api_routes(app, main_loop):
     @app.route('/api/recordings/<path:path>/video')
     def recording_video(path):
         """
-        GET a recording video for a day and time.
+        GET a recording video for a day and time. MP4 recordings are served
+        in place of raw H.264 when they exist.
         """
+        recording = parse_recording_path(path)
+        if recording is None:
+            return '', 422
+        if os.path.isfile(os.path.join(app.instance_path, 'recordings', *recording, 'video.mp4')):
+            return serve_recording('video.mp4', path)
         return serve_recording('video.h264', path)
 
-    def serve_recording(name, path):
+    @app.route('/api/recordings/<path:path>/video.mp4')
+    def recording_mp4(path):
+        """
+        GET a recording video for a day and time as an MP4 that browsers can
+        play and seek in. Raw H.264 recordings are remuxed into an MP4 as they
+        are sent, once they have been saved and indexed.
+        """
+        recording = parse_recording_path(path)
+        if recording is None:
+            return '', 422
+        directory = os.path.join(app.instance_path, 'recordings', *recording)
+        if os.path.isfile(os.path.join(directory, 'video.mp4')):
+            return serve_recording('video.mp4', path, as_attachment=False)
+        h264_path = os.path.join(directory, 'video.h264')
+        if not os.path.isfile(h264_path):
+            return '', 404
+        if SampleIndexWriter.is_writing(h264_path):
+            # The recording is indexed once it is saved.
+            return '', 409
+        try:
+            mp4 = RemuxedMP4(h264_path, framerate=app.config['VIDEO_FRAMERATE'])
+        except ValueError:
+            return '', 422
+        return remuxed_response(mp4)
+
+    def parse_recording_path(path):
+        """
+        :return: a tuple of the day and time of a day/time recording path, or
+        None if it doesn't match the directory formats.
+        """
         elements = path.split('/')
         if not len(elements) == 2:
-            return '', 422
+            return None
         try:
-            day = elements[0]
-            time = elements[1]
-            if datetime.strptime(day, day_format) is not None:
-                if datetime.strptime(time, time_format) is not None:
-                    directory = os.path.join(app.instance_path, 'recordings', day, time)
-                    return send_from_directory(os.path.abspath(directory),
-                                               name,
-                                               as_attachment=True,
-                                               attachment_filename=('%s;%s;%s' % (day, time, name)))
+            datetime.strptime(elements[0], day_format)
+            datetime.strptime(elements[1], time_format)
         except ValueError:
-            pass
-        return '', 422
+            return None
+        return elements[0], elements[1]
+
+    def serve_recording(name, path, as_attachment=True):
+        """
+        Responds with a recording file. Range requests are answered with the
+        requested bytes, so downloads can be resumed, and the file's ETag and
+        Last-Modified validators are sent.
+
+        When RECORDINGS_ACCEL_PATH is configured, the file is handed off to
+        nginx with an X-Accel-Redirect header instead, so its bytes are sent
+        by nginx rather than through a uWSGI worker.
+        """
+        recording = parse_recording_path(path)
+        if recording is None:
+            return '', 422
+        day, time = recording
+        directory = os.path.join(app.instance_path, 'recordings', day, time)
+        attachment_filename = '%s;%s;%s' % (day, time, name)
+        if accel_path is not None:
+            if not os.path.isfile(os.path.join(directory, name)):
+                return '', 404
+            response = app.response_class(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                                 filename=attachment_filename)
+            response.headers['X-Accel-Redirect'] = quote('%s/%s/%s/%s' % (accel_path.rstrip('/'), day, time, name))
+            return response
+        return send_from_directory(os.path.abspath(directory),
+                                   name,
+                                   as_attachment=as_attachment,
+                                   attachment_filename=attachment_filename,
+                                   conditional=True)
+
+    def remuxed_response(mp4):
+        """
+        Streams a RemuxedMP4. A Range request is answered with a 206 holding
+        the requested bytes, read straight from the raw recording.
+        """
+        etag = mp4.etag
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        start, stop, status = 0, mp4.size, 200
+        # Ranges are only sent if the client's partial copy is current.
+        if request.range is not None and request.if_range.date is None and request.if_range.etag in (None, etag):
+            byte_range = request.range.range_for_length(mp4.size)
+            if byte_range is not None:
+                start, stop = byte_range
+                status = 206
+            elif len(request.range.ranges) == 1:
+                response = app.response_class(status=416)
+                response.headers['Content-Range'] = 'bytes */%d' % mp4.size
+                return response
+        response = app.response_class(mp4.iter_bytes(start, stop),
+                                      status=status,
+                                      mimetype='video/mp4',
+                                      direct_passthrough=True)
+        response.content_length = stop - start
+        if status == 206:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, mp4.size)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.set_etag(etag)
+        response.last_modified = mp4.last_modified
+        return response
 
     def expose_camera():
         if main_loop.servo is not None:
@@ -180,6 +340,17 @@ def add_api_routes(app, main_loop):
         if main_loop.servo is not None:
             main_loop.servo.disable()
 
+    @app.route('/api/metrics')
+    def metrics():
+        """
+        GET runtime metrics for Watchtower's streams.
+        """
+        return jsonify(mjpeg=main_loop.mjpeg_broadcast.stats(),
+                       preroll=main_loop.preroll_stats(),
+                       scheduler=main_loop.scheduler_stats(),
+                       uploads=main_loop.upload_stats(),
+                       writers=main_loop.writer_stats()), 200
+
     @app.route('/api/internal_mjpeg')
     def internal_stream():
         return shared_stream(main_loop)
@@ -194,9 +365,6 @@ def add_web_routes(app, main_loop):
     Adds all of the routes for Watchtower's the web app.
     """
 
-    day_format = app.config['DIR_DAY_FORMAT']
-    time_format = app.config['DIR_TIME_FORMAT']
-
     @app.route('/')
     def index():
         config_params = dict(
@@ -205,9 +373,7 @@ def add_web_routes(app, main_loop):
             image_effects=picamera.PiCamera.IMAGE_EFFECTS,
             meter_modes=picamera.PiCamera.METER_MODES
         )
-        recordings = fs.all_recordings(path=os.path.join(app.instance_path, 'recordings'),
-                                       day_format=day_format,
-                                       time_format=time_format)
+        recordings = main_loop.recording_index.all_recordings()
         return render_template('base.html',
                                camera=main_loop.camera,
                                recordings=recordings,
@@ -219,31 +385,33 @@ def add_web_routes(app, main_loop):
 
 def shared_stream(main_loop):
     """
-    Starts an MJPEG stream using an HTTPMultipartWriter fed to an instance
-    of MJPEGStreamer. A generator is used to continuously block, waiting on
-    a signal from the writer when a new frame is ready for output to the
-    client.
+    Starts an MJPEG stream by subscribing to the RunLoop's shared
+    MJPEGBroadcast. A generator is used to continuously block, waiting on a
+    signal from the subscribed writer when a new frame is ready for output to
+    the client. Every viewer shares the same frames, which are published by
+    the MJPEG recorder as they are encoded.
 
     An optional encoding=base64 parameter can be supplied to encode the raw
-    image data in the response.
+    image data in the response. An optional fps parameter limits the frame
+    rate sent to the client. It defaults to DEFAULT_MJPEG_RATE and can be
+    raised up to the camera's framerate. Optional width and quality
+    parameters downscale and recompress each frame. Each variant of a frame
+    is produced once and shared by all viewers requesting it.
     """
-    encoding = request.args.get('encoding', type=str)
-    fps = 4
-    writer = http_writer.HTTPMultipartWriter(use_base64=(encoding == 'base64'))
-    streamer = MJPEGStreamer(main_loop.camera,
-                            byte_writers=[writer],
-                            name='MJPEG',
-                            servo=main_loop.servo,
-                            rate=fps)
-    streamer.start()
+    try:
+        variant, fps = parse_stream_options(request.args, DEFAULT_MJPEG_RATE)
+    except ValueError:
+        return '', 422
+    broadcast = main_loop.mjpeg_broadcast
+    writer = broadcast.subscribe(variant, rate=fps)
 
     @stream_with_context
     def generate():
         try:
             while True:
                 yield(writer.blocking_read())
-        except:
-            streamer.stop()
+        finally:
+            broadcast.unsubscribe(writer)
 
     mimetype = 'multipart/x-mixed-replace; boundary=' + http_writer.MULTIPART_BOUNDARY
-    return Response(generate(), mimetype=mimetype)
\ No newline at end of file
+    return Response(generate(), mimetype=mimetype)
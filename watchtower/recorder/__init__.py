@@ -1,45 +1,10 @@
 import logging
 import os
 import picamera
-from enum import Enum
-from ..streamer.writer import dropbox_writer, disk_writer
 from ..streamer import stream_saver, video_stream_saver
-
-
-class Destination(Enum):
-    """
-    This enum represents one destination for a Recorder. Each Destination
-    instance houses the necessary information for writing to that destination.
-    """
-    disk = 0
-    dropbox = 1
-
-    def __init__(self, value):
-        self.file_chunk_size = -1
-        self.token = None
-        self.pem_path = None
-        self.instance_path = None
-
-    def create_writer(self, path, camera_name, video=True):
-        """
-        This function creates and returns a ByteWriter instance for the current
-        destination.
-
-        :param path: The path to write to. This is the recording day/time dir.
-        :param camera_name: The camera's name which some destinations may need.
-        :param video: Specifies whether the writer should be set up for video
-        recording or jpeg recording (with False).
-        """
-        if self is Destination.disk:
-            disk_path = os.path.join(self.instance_path, 'recordings', path)
-            return disk_writer.DiskWriter(disk_path)
-        else:
-            return dropbox_writer.DropboxWriter(
-                full_path='/'+os.path.join(camera_name, path),
-                dropbox_token=self.token,
-                file_chunk_size=self.file_chunk_size if video else -1,
-                public_pem_path=self.pem_path if video else None
-            )
+from .circular_stream import IndexedCircularIO
+from .destinations import Destination, create_destination, register_destination
+from .preroll import encoder_bitrate
 
 
 class Recorder:
@@ -49,7 +14,7 @@ class Recorder:
     can persist its stream's data to any number of Destination instances.
     """
 
-    def __init__(self, camera, padding_sec=0, destinations=None, splitter_port=0, resize_resolution=None):
+    def __init__(self, camera, padding_sec=0, destinations=None, splitter_port=0, resize_resolution=None, batch_bytes=0, batch_delay=0, bitrate=None, buffer_size=None, video_format='h264', index=None):
         """
         :param camera: the PiCamera used for recordings.
         :param padding_sec: the amount of time to record before a motion event.
@@ -58,19 +23,45 @@ class Recorder:
         the primary port used. 0-3 are valid.
         :param resize_resolution: the resolution to resize from the camera's
         resolution. If used, this should be smaller than the camera resolution.
+        :param batch_bytes: the number of new video bytes to collect before
+        they are passed to the destinations. 0 passes along every frame.
+        :param batch_delay: the most seconds to wait for ``batch_bytes``.
+        :param bitrate: the H.264 bitrate the encoder targets, in bits per
+        second, or None to use picamera's default.
+        :param buffer_size: the size of the pre-roll buffer in bytes. If None,
+        the buffer holds ``padding_sec`` of video at ``bitrate``, or at
+        picamera's default bitrate.
+        :param video_format: ``h264`` to save the raw H.264 stream or ``mp4``
+        to save a fragmented MP4 that can be played as it is written.
+        :param index: the RecordingIndex to add persisted recordings to, or
+        None if no destination saves to the recordings directory.
         """
 
         self.__camera = camera
         self.__destinations = destinations
         self.__resize_resolution = resize_resolution
         self.__splitter_port = splitter_port
+        self.__batch_bytes = batch_bytes
+        self.__batch_delay = batch_delay
+        self.__bitrate = bitrate
+        self.__buffer_size = buffer_size
+        self.__video_format = video_format
+        self.__index = index
         self.__stream = self.create_stream(padding_sec)
         self.__stream_saver = None
+        self.__stream_savers = []  # Savers that may still be writing
 
     def create_stream(self, padding_sec):
-        return picamera.PiCameraCircularIO(
+        if self.__buffer_size is not None:
+            return IndexedCircularIO(
+                self.camera,
+                size=self.__buffer_size,
+                splitter_port=self.splitter_port
+            )
+        return IndexedCircularIO(
             self.camera,
             seconds=padding_sec,
+            bitrate=encoder_bitrate(self.bitrate),
             splitter_port=self.splitter_port
         )
 
@@ -78,6 +69,10 @@ class Recorder:
     def splitter_port(self) -> int:
         return self.__splitter_port
 
+    @property
+    def bitrate(self) -> int:
+        return self.__bitrate
+
     @property
     def camera(self) -> picamera.PiCamera:
         return self.__camera
@@ -90,11 +85,15 @@ class Recorder:
         """
         Begins saving video data to an in-memory stream.
         """
+        options = {}
+        if self.bitrate is not None:
+            options['bitrate'] = self.bitrate
         self.camera.start_recording(
             self.__stream,
             format='h264',
             resize=self.resize_resolution,
-            splitter_port=self.splitter_port
+            splitter_port=self.splitter_port,
+            **options
         )
 
     def stop_recording():
@@ -118,6 +117,7 @@ class Recorder:
             logging.getLogger(__name__).error('Call to persist() but already recording.')
             return None
 
+        use_mp4 = self.__video_format == 'mp4'
         def create_writers(file_name, video=True):
             """
             Returns writers for all destinations using the specified file name.
@@ -126,7 +126,9 @@ class Recorder:
                 lambda dest: dest.create_writer(
                     path=os.path.join(directory, file_name),
                     camera_name=self.camera.name,
-                    video=video
+                    video=video,
+                    mp4_resolution=(self.resize_resolution or self.camera.resolution) if video and use_mp4 else None,
+                    mp4_framerate=self.camera.framerate if video and use_mp4 else None
                 ),
                 self.__destinations
             ))
@@ -140,14 +142,44 @@ class Recorder:
         )
         jpeg_streamer.start()
 
-        video_writers = create_writers('video.h264')
+        video_writers = create_writers('video.mp4' if use_mp4 else 'video.h264')
         self.__stream_saver = video_stream_saver.VideoStreamSaver(
             stream=self.__stream,
             byte_writers=video_writers,
             name=('%s%s.video' % (directory, self.__destinations)),
-            start_time=start_time
+            start_time=start_time,
+            min_batch_bytes=self.__batch_bytes,
+            max_batch_delay=self.__batch_delay
         )
         self.__stream_saver.start()
+        self.__stream_savers.append(jpeg_streamer)
+        self.__stream_savers.append(self.__stream_saver)
+        if self.__index is not None:
+            day_dirname, time_dirname = os.path.split(directory)
+            self.__index.add(day_dirname, time_dirname)
+
+    def preroll_stats(self):
+        """
+        :return: a dictionary describing the size and usage of the pre-roll
+        buffer, or None if the recorder doesn't buffer video.
+        """
+        if self.__stream is None:
+            return None
+        return dict(
+            splitter_port=self.splitter_port,
+            resolution=self.resize_resolution or self.camera.resolution,
+            bitrate=self.bitrate,
+            buffer_bytes=self.__stream.size,
+            used_bytes=self.__stream.buffered_bytes
+        )
+
+    def writer_stats(self):
+        """
+        :return: a list describing the writer queues of every recording that
+        is still being written.
+        """
+        self.__stream_savers = [saver for saver in self.__stream_savers if saver.is_alive()]
+        return [stats for saver in self.__stream_savers for stats in saver.stats()]
 
     def stop_persisting(self):
         """
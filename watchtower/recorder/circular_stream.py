@@ -0,0 +1,94 @@
+import picamera
+from collections import deque
+from threading import Condition
+from ..streamer.frame_index import FrameIndex
+
+
+class IndexedCircularIO(picamera.PiCameraCircularIO):
+    """
+    A ``PiCameraCircularIO`` that keeps a ``FrameIndex`` up to date as the
+    encoder appends frames and the ring buffer evicts old data. Readers can use
+    ``frame_index`` to locate frames in constant time instead of walking the
+    ``frames`` property, which rebuilds every frame's position on each pass.
+    Ranges can be read with ``read_range()`` without copying the buffer.
+    ``frame_condition`` is notified each time a frame is completed.
+    """
+
+    def __init__(self, camera, size=None, seconds=None, bitrate=17000000, splitter_port=1):
+        super(IndexedCircularIO, self).__init__(camera,
+                                                size=size,
+                                                seconds=seconds,
+                                                bitrate=bitrate,
+                                                splitter_port=splitter_port)
+        # Recordings must start on an SPS header to be decodable.
+        self.__frame_index = FrameIndex(keyframe_type=picamera.PiVideoFrameType.sps_header)
+        self.__bytes_written = 0
+        self.__frame_condition = Condition(self.lock)
+
+    @property
+    def frame_index(self) -> FrameIndex:
+        return self.__frame_index
+
+    @property
+    def buffered_bytes(self) -> int:
+        """
+        The number of bytes currently held in the buffer, up to ``size``.
+        """
+        with self.lock:
+            return self._length
+
+    @property
+    def frame_condition(self) -> Condition:
+        """
+        A condition sharing the stream's ``lock`` that is notified when a
+        frame is added to ``frame_index``.
+        """
+        return self.__frame_condition
+
+    def write(self, b):
+        """
+        Overridden to record each completed frame in the index and trim the
+        frames evicted by the write.
+        """
+        with self.lock:
+            result = super(IndexedCircularIO, self).write(b)
+            self.__bytes_written += result
+            # The camera only ever appends, so the new chunk is the last one.
+            # PiCameraDequeHack stores it with the metadata of the frame it
+            # completes, if any.
+            chunk, frame = deque.__getitem__(self._data, -1)
+            if frame is not None:
+                self.__frame_index.append(index=frame.index,
+                                          frame_type=frame.frame_type,
+                                          timestamp=frame.timestamp,
+                                          start=self.__bytes_written - frame.frame_size,
+                                          end=self.__bytes_written)
+                self.__frame_condition.notify_all()
+            self.__frame_index.trim(self.__bytes_written - self._length)
+            return result
+
+    def read_range(self, start, end):
+        """
+        Returns ``memoryview`` instances over the buffer's chunks that cover the
+        requested range. Nothing is copied. Chunks are immutable ``bytes``, so
+        the views remain valid after the lock is released, even if the chunks
+        are evicted from the buffer.
+
+        :param start: the buffer position of the first byte.
+        :param end: the buffer position just past the last byte.
+        :return: a list of ``memoryview`` instances in stream order.
+        """
+        views = []
+        with self.lock:
+            # Reads are almost always near the end of the buffer, so walk
+            # backwards and stop once the start of the range is reached.
+            chunk_end = self._length
+            for chunk, frame in deque.__reversed__(self._data):
+                if chunk_end <= start:
+                    break
+                chunk_start = chunk_end - len(chunk)
+                if chunk_start < end:
+                    views.append(memoryview(chunk)[max(start - chunk_start, 0):min(end, chunk_end) - chunk_start])
+                chunk_end = chunk_start
+        views.reverse()
+        return views
@@ -0,0 +1,219 @@
+import importlib
+import logging
+import os
+from abc import ABCMeta, abstractmethod
+from ..streamer.writer import dropbox_writer, disk_writer, s3_writer
+from ..streamer.writer.encryption_pool import EncryptionPool
+from ..streamer.writer.mp4_writer import FragmentedMP4Writer
+from ..streamer.writer.queued_writer import QueuedWriter, Backpressure, DEFAULT_MAX_QUEUED_BYTES
+from ..streamer.writer.upload_scheduler import UploadScheduler
+from ..streamer.writer.upload_spool import UploadSpool
+from ..util.mp4_remux import SampleIndexWriter
+
+
+class Destination:
+    """
+    A place a Recorder saves recordings to. Each entry of the ``DESTINATIONS``
+    config object creates one destination from its options.
+
+    Subclasses implement ``create_byte_writer()`` and are made available to
+    the config file with ``register_destination()``. An entry's ``type``
+    selects its class, and defaults to the entry's name. A ``type`` that
+    isn't registered is imported as ``package.module.ClassName``, so
+    destinations can live outside Watchtower.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, name, options, instance_path):
+        """
+        :param name: the destination's name in the config file.
+        :param options: the destination's config options.
+        :param instance_path: the Flask app's instance path.
+        """
+        self.name = name
+        self.max_queued_bytes = options.get('queue_kb', DEFAULT_MAX_QUEUED_BYTES//1024)*1024
+        self.backpressure = Backpressure(options.get('backpressure', Backpressure.block.value))
+
+    @abstractmethod
+    def create_byte_writer(self, path, camera_name, video):
+        """
+        :param path: The path to write to, within the recording day/time dir.
+        :param camera_name: The camera's name which some destinations may need.
+        :param video: Specifies whether the writer should be set up for video
+        recording or jpeg recording (with False).
+        :return: a ``ByteWriter`` that saves one file to the destination.
+        """
+        pass
+
+    def configure_recording(self, bitrate, max_event_sec):
+        """
+        Called once the bitrate of the destination's video is known.
+
+        :param bitrate: the video's bitrate in bits per second.
+        :param max_event_sec: the longest a recording can last.
+        """
+        pass
+
+    def create_writer(self, path, camera_name, video=True, mp4_resolution=None, mp4_framerate=None):
+        """
+        This function creates and returns a ByteWriter instance for the current
+        destination. The writer is fed through a ``QueuedWriter`` using the
+        destination's queue size and backpressure policy.
+
+        :param path: The path to write to. This is the recording day/time dir.
+        :param camera_name: The camera's name which some destinations may need.
+        :param video: Specifies whether the writer should be set up for video
+        recording or jpeg recording (with False).
+        :param mp4_resolution: If supplied with ``mp4_framerate``, the H.264
+        video is wrapped in a fragmented MP4 of this resolution.
+        :param mp4_framerate: The framerate of the MP4 video.
+        """
+        writer = self.create_byte_writer(path, camera_name, video)
+        if mp4_resolution is not None and mp4_framerate is not None:
+            writer = FragmentedMP4Writer(writer, mp4_resolution, mp4_framerate)
+        return QueuedWriter(writer,
+                            max_queued_bytes=self.max_queued_bytes,
+                            backpressure=self.backpressure)
+
+    def __repr__(self):
+        return '<Destination.%s>' % self.name
+
+
+class DiskDestination(Destination):
+    """
+    Saves recordings to the ``recordings`` directory of the instance path.
+    """
+
+    def __init__(self, name, options, instance_path):
+        super(DiskDestination, self).__init__(name, options, instance_path)
+        self.instance_path = instance_path
+        self.buffer_size = options.get('buffer_kb', 1024)*1024
+        self.fsync_policy = disk_writer.FsyncPolicy(options.get('fsync', disk_writer.FsyncPolicy.close.value))
+        self.fsync_interval = options.get('fsync_interval', disk_writer.DEFAULT_FSYNC_INTERVAL)
+        self.preallocate = options.get('preallocate', True)
+        self.preallocate_bytes = 0
+
+    def configure_recording(self, bitrate, max_event_sec):
+        if self.preallocate:
+            # Reserve disk space for the longest possible event.
+            self.preallocate_bytes = int(bitrate / 8 * max_event_sec)
+
+    def create_byte_writer(self, path, camera_name, video):
+        writer = disk_writer.DiskWriter(
+            os.path.join(self.instance_path, 'recordings', path),
+            buffer_size=self.buffer_size,
+            preallocate_bytes=self.preallocate_bytes if video else 0,
+            fsync_policy=self.fsync_policy,
+            fsync_interval=self.fsync_interval
+        )
+        if video and path.endswith('.h264'):
+            # Index raw video once it is saved, so it can be served as an MP4.
+            writer = SampleIndexWriter(writer)
+        return writer
+
+
+class DropboxDestination(Destination):
+    """
+    Uploads recordings to Dropbox. The recordings of every Dropbox
+    destination share the process's ``UploadScheduler``. Each destination has
+    its own ``UploadSpool`` when spooling is enabled.
+    """
+
+    def __init__(self, name, options, instance_path):
+        super(DropboxDestination, self).__init__(name, options, instance_path)
+        self.token = options['token']
+        self.pem_path = options.get('public_key_path')
+        self.file_chunk_size = options['file_chunk_kb']*1024
+        self.upload_sessions = options.get('upload_sessions', False)
+        self.session_append_size = options.get('session_append_kb', dropbox_writer.DEFAULT_SESSION_APPEND_SIZE//1024)*1024
+        # All Dropbox uploads, of every destination, share the scheduler's
+        # threads and connections.
+        self.scheduler = UploadScheduler.shared(options.get('max_uploads'))
+        self.spool = None
+        if options.get('spool', True):
+            # Each destination's spool is retried with its own token.
+            directory = 'upload_spool' if name == 'dropbox' else 'upload_spool_%s' % name
+            self.spool = UploadSpool(os.path.join(instance_path, directory), self.scheduler.client(self.token))
+            self.spool.start()
+        self.encryption_pool = None
+        if self.pem_path is not None and options.get('encryption_processes', 0) != 0:
+            # A negative count uses every CPU.
+            processes = options['encryption_processes']
+            self.encryption_pool = EncryptionPool(processes if processes > 0 else None)
+
+    def create_byte_writer(self, path, camera_name, video):
+        return dropbox_writer.DropboxWriter(
+            full_path='/'+os.path.join(camera_name, path),
+            dropbox_token=self.token,
+            file_chunk_size=self.file_chunk_size if video else -1,
+            public_pem_path=self.pem_path if video else None,
+            upload_sessions=self.upload_sessions,
+            session_append_size=self.session_append_size,
+            spool=self.spool,
+            encryption_pool=self.encryption_pool,
+            scheduler=self.scheduler
+        )
+
+
+class S3Destination(Destination):
+    """
+    Uploads recordings to a bucket of an S3-compatible object store with
+    multipart uploads. All recordings share one ``S3Client``.
+    """
+
+    def __init__(self, name, options, instance_path):
+        super(S3Destination, self).__init__(name, options, instance_path)
+        self.client = s3_writer.S3Client(
+            endpoint=options['endpoint'],
+            bucket=options['bucket'],
+            access_key=options['access_key'],
+            secret_key=options['secret_key'],
+            region=options.get('region', s3_writer.DEFAULT_REGION),
+            max_connections=options.get('max_connections', s3_writer.DEFAULT_MAX_CONNECTIONS)
+        )
+        self.part_size = options.get('part_size_mb', s3_writer.DEFAULT_PART_SIZE//(1024*1024))*1024*1024
+        if self.part_size < s3_writer.MIN_PART_SIZE:
+            logging.getLogger(__name__).warning('part_size_mb is below the 5 MB S3 allows. Using 5 MB.')
+            self.part_size = s3_writer.MIN_PART_SIZE
+        self.prefix = options.get('prefix', '')
+
+    def create_byte_writer(self, path, camera_name, video):
+        return s3_writer.S3Writer(
+            os.path.join(self.prefix, camera_name, path),
+            self.client,
+            part_size=self.part_size
+        )
+
+
+DESTINATION_TYPES = {}
+
+
+def register_destination(type_name, destination_class):
+    """
+    Makes a ``Destination`` subclass available to the ``DESTINATIONS`` config
+    object under ``type_name``.
+    """
+    DESTINATION_TYPES[type_name] = destination_class
+
+
+def create_destination(name, options, instance_path):
+    """
+    :param name: the destination's name in the config file.
+    :param options: the destination's config options.
+    :param instance_path: the Flask app's instance path.
+    :return: the configured ``Destination``.
+    """
+    type_name = options.get('type', name)
+    if type_name in DESTINATION_TYPES:
+        destination_class = DESTINATION_TYPES[type_name]
+    elif '.' in type_name:
+        module_name, _, class_name = type_name.rpartition('.')
+        destination_class = getattr(importlib.import_module(module_name), class_name)
+    else:
+        raise ValueError('Unknown destination type "%s".' % type_name)
+    return destination_class(name, options, instance_path)
+
+
+register_destination('disk', DiskDestination)
+register_destination('dropbox', DropboxDestination)
+register_destination('s3', S3Destination)
@@ -5,8 +5,19 @@ class MJPEGRecorder(Recorder):
     Special type of Recorder that will continuously stream an MJPEG feed and
     supply the most recent JPEG to the camera instance. This is a much faster
     way to capture stills than using the ``capture(...)`` function on PiCamera.
+    Each JPEG is also published to a broadcaster as soon as it is encoded so
+    MJPEG viewers receive it without polling.
     """
 
+    def __init__(self, camera, broadcaster, splitter_port=0, resize_resolution=None):
+        """
+        :param broadcaster: a ``ByteWriter`` that every new JPEG is appended to.
+        """
+        super(MJPEGRecorder, self).__init__(camera,
+                                            splitter_port=splitter_port,
+                                            resize_resolution=resize_resolution)
+        self.__broadcaster = broadcaster
+
     def create_stream(self, padding_sec):
         """
         Overridden since we don't use a stream. We only hold the raw jpeg data.
@@ -42,6 +53,7 @@ class MJPEGRecorder(Recorder):
     def write(self, buf):
         if buf.startswith(b'\xff\xd8'):
             self.camera.jpeg_data = buf
+            self.__broadcaster.append_bytes(buf)
 
     def flush(self):
         pass
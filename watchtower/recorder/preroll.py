@@ -0,0 +1,38 @@
+import logging
+
+DEFAULT_BITRATE = 17000000  # picamera's default H.264 bitrate
+
+
+def encoder_bitrate(bitrate):
+    """
+    :param bitrate: the bitrate configured for a recording, or None.
+    :return: the bitrate the H.264 encoder records at, in bits per second.
+    """
+    return bitrate if bitrate is not None else DEFAULT_BITRATE
+
+
+def buffer_sizes(padding_sec, bitrates, budget_bytes=None):
+    """
+    Sizes the pre-roll buffer of each recorder. Every buffer holds
+    ``padding_sec`` of video at its bitrate. If the buffers would exceed
+    ``budget_bytes`` in total, the budget is instead split in proportion to
+    the bitrates, which shortens the pre-roll equally for every recorder.
+
+    :param padding_sec: the seconds of video to hold before an event.
+    :param bitrates: the bitrate of each recorder in bits per second.
+    :param budget_bytes: the most memory all buffers may use together. If
+    None, the buffers are not limited.
+    :return: a list of buffer sizes in bytes, in the order of ``bitrates``.
+    """
+    sizes = [int(padding_sec * bitrate / 8) for bitrate in bitrates]
+    total = sum(sizes)
+    if budget_bytes is None or total <= budget_bytes:
+        return sizes
+
+    total_bitrate = sum(bitrates)
+    sizes = [int(budget_bytes * bitrate / total_bitrate) for bitrate in bitrates]
+    logging.getLogger(__name__).warning(
+        'Pre-roll buffers need %d bytes, which exceeds the budget of %d bytes. Pre-roll is reduced to %.1f seconds.'
+        % (total, budget_bytes, budget_bytes * 8 / total_bitrate)
+    )
+    return sizes
@@ -8,11 +8,16 @@ import os
 import picamera
 import time
 from .camera import SafeCamera
-from .recorder import Recorder, Destination
+from .recorder import Recorder, create_destination
+from .recorder.destinations import DiskDestination, DropboxDestination
 from .recorder.mjpeg import MJPEGRecorder
+from .recorder import preroll
 from .remote import downstream
 from .remote import micro
 from .remote.servo import Servo
+from .streamer.mjpeg_streamer import MJPEGBroadcast
+from .streamer.writer.http_writer import HTTPMultipartBroadcaster, DEFAULT_QUEUE_DEPTH, ENCODED_CACHE_SIZE
+from .util.recording_index import RecordingIndex
 from .util.shutdown import TerminableThread
 
 WAIT_TIME = 0.1
@@ -41,10 +46,32 @@ class RunLoop(TerminableThread):
         self.__padding = app.config['RECORDING_PADDING']
         self.__max_event_time = app.config['MAX_EVENT_TIME']
         self.__instance_path = app.instance_path
-        self.__recorders, self.camera = self.setup_destinations(app)
-        self.__start_time = None
+        self.__upload_batch_bytes = app.config.get('UPLOAD_BATCH_KB', 0)*1024
+        self.__upload_batch_delay = app.config.get('UPLOAD_BATCH_DELAY', 0)
+        self.__video_format = app.config.get('VIDEO_FORMAT', 'h264')
+        if self.__video_format not in ('h264', 'mp4'):
+            logging.getLogger(__name__).error('VIDEO_FORMAT must be h264 or mp4.')
+            raise Exception('Invalid config file')
+        mjpeg_queue_depth = app.config.get('MJPEG_QUEUE_DEPTH', DEFAULT_QUEUE_DEPTH)
+        # Cache enough encoded frames to cover a full queue in a few variants.
+        self.__mjpeg_broadcaster = HTTPMultipartBroadcaster(
+            cache_size=max(ENCODED_CACHE_SIZE, 2 * mjpeg_queue_depth)
+        )
         self.__day_format = app.config['DIR_DAY_FORMAT']
         self.__time_format = app.config['DIR_TIME_FORMAT']
+        self.__recording_index = RecordingIndex(os.path.join(self.__instance_path, 'recordings'),
+                                                os.path.join(self.__instance_path, 'recordings_index.sqlite'),
+                                                self.__day_format,
+                                                self.__time_format)
+        self.__upload_spool = None
+        self.__upload_scheduler = None
+        self.__recorders, self.camera = self.setup_destinations(app)
+        self.__mjpeg_broadcast = MJPEGBroadcast(self.__mjpeg_broadcaster,
+                                                self.camera,
+                                                servo=self.servo,
+                                                max_rate=app.config['VIDEO_FRAMERATE'],
+                                                queue_depth=mjpeg_queue_depth)
+        self.__start_time = None
         self.__video_date_format = app.config['VIDEO_DATE_FORMAT']
 
     @property
@@ -55,6 +82,49 @@ class RunLoop(TerminableThread):
     def servo(self, value):
         self.__servo = value
 
+    @property
+    def mjpeg_broadcast(self) -> MJPEGBroadcast:
+        return self.__mjpeg_broadcast
+
+    @property
+    def recording_index(self) -> RecordingIndex:
+        return self.__recording_index
+
+    def writer_stats(self):
+        """
+        :return: a list describing the writer queues of every recording that
+        is still being written.
+        """
+        return [stats for recorder in self.__recorders for stats in recorder.writer_stats()]
+
+    def upload_stats(self):
+        """
+        :return: a dictionary describing the Dropbox upload backlog, or None if
+        uploads are not spooled.
+        """
+        return self.__upload_spool.stats() if self.__upload_spool is not None else None
+
+    def scheduler_stats(self):
+        """
+        :return: a dictionary describing the Dropbox upload threads, or None
+        if Dropbox is not a destination.
+        """
+        return self.__upload_scheduler.stats() if self.__upload_scheduler is not None else None
+
+    def preroll_stats(self):
+        """
+        :return: a dictionary comparing the memory used by the pre-roll buffers
+        with the configured budget.
+        """
+        recorders = [stats for stats in map(lambda recorder: recorder.preroll_stats(), self.__recorders)
+                     if stats is not None]
+        return dict(
+            budget_bytes=self.__preroll_budget,
+            buffer_bytes=sum(stats['buffer_bytes'] for stats in recorders),
+            used_bytes=sum(stats['used_bytes'] for stats in recorders),
+            recorders=recorders
+        )
+
     def setup_microcontroller_comm(self, app):
         controller_config = app.config.get_namespace('SERVO_')
         angle_on = controller_config['angle_on']
@@ -69,6 +139,7 @@ class RunLoop(TerminableThread):
         """
 
         sizes = {}
+        configured_bitrates = {}
         def add_destination(options, destination):
             """
             Adds the destination to the sizes dictionary with the key being the
@@ -78,33 +149,47 @@ class RunLoop(TerminableThread):
             if size_tuple not in sizes:
                 sizes[size_tuple] = []
             sizes[size_tuple].append(destination)
+            # Destinations sharing a resolution share a recording, so use the
+            # highest bitrate requested.
+            if 'bitrate' in options:
+                configured_bitrates[size_tuple] = max(options['bitrate'], configured_bitrates.get(size_tuple, 0))
 
         destinations = app.config.get('DESTINATIONS')
         if destinations is None:
             logging.getLogger(__name__).error('DESTINATIONS key does not exist in config file.')
             raise Exception('Invalid config file')
-        
-        if 'disk' in destinations:
-            options = destinations['disk']
-            disk_dest = Destination.disk
-            disk_dest.instance_path = self.__instance_path
-            add_destination(options, disk_dest)
-        if 'dropbox' in destinations:
-            options = destinations['dropbox']
-            dropbox_dest = Destination.dropbox
-            dropbox_dest.token = options['token']
-            if 'public_key_path' in options:
-                dropbox_dest.pem_path = options['public_key_path']
-            dropbox_dest.file_chunk_size = options['file_chunk_kb']*1024
-            add_destination(options, dropbox_dest)
-        # Future destinations can be set up here.
+
+        for name, options in destinations.items():
+            try:
+                destination = create_destination(name, options, self.__instance_path)
+            except (ValueError, ImportError, AttributeError) as e:
+                logging.getLogger(__name__).error('Destination "%s" could not be created: %s' % (name, e))
+                raise Exception('Invalid config file')
+            if isinstance(destination, DropboxDestination):
+                self.__upload_spool = destination.spool
+                self.__upload_scheduler = destination.scheduler
+            add_destination(options, destination)
+
+        # Buffers are sized for the bitrate the encoder actually records at.
+        bitrates = {size: preroll.encoder_bitrate(configured_bitrates.get(size)) for size in sizes}
+        event_sec = self.__max_event_time + self.__padding
+        for size, size_destinations in sizes.items():
+            for destination in size_destinations:
+                destination.configure_recording(bitrates[size], event_sec)
         
         # Sort with the biggest resolution first.
         sorted_sizes = sorted(sizes.keys(), key=lambda size: size[0], reverse=True)
+
+        # Split the pre-roll memory budget across the recorders by bitrate.
+        budget_mb = app.config.get('PREROLL_MEMORY_MB')
+        self.__preroll_budget = budget_mb*1024*1024 if budget_mb is not None else None
+        buffer_sizes = preroll.buffer_sizes(self.__padding,
+                                            [bitrates[size] for size in sorted_sizes],
+                                            self.__preroll_budget)
         splitter_port = 1
         recorders = []
         camera = None
-        for size in sorted_sizes:
+        for size, buffer_size in zip(sorted_sizes, buffer_sizes):
             logging.getLogger(__name__).info('Creating recorder at %s with splitter port %d.' % (sizes[size], splitter_port))
             resize_resolution = size
             if size == sorted_sizes[0]:
@@ -121,7 +206,15 @@ class RunLoop(TerminableThread):
                     padding_sec=self.__padding,
                     destinations=sizes[size],
                     splitter_port=splitter_port,
-                    resize_resolution=resize_resolution
+                    resize_resolution=resize_resolution,
+                    batch_bytes=self.__upload_batch_bytes,
+                    batch_delay=self.__upload_batch_delay,
+                    bitrate=configured_bitrates.get(size),
+                    buffer_size=buffer_size,
+                    video_format=self.__video_format,
+                    # Only recordings saved to disk can be listed and served.
+                    index=self.__recording_index if any(isinstance(destination, DiskDestination)
+                                                        for destination in sizes[size]) else None
                 )
             )
             splitter_port += 1
@@ -133,6 +226,7 @@ class RunLoop(TerminableThread):
         recorders.append(
             MJPEGRecorder(
                 camera=camera,
+                broadcaster=self.__mjpeg_broadcaster,
                 splitter_port=mjpeg_port,
                 resize_resolution=mjpeg_size
             )
@@ -0,0 +1,153 @@
+from bisect import bisect_right
+from collections import namedtuple
+
+IndexedFrame = namedtuple('IndexedFrame', 'index frame_type timestamp start end')
+
+
+class FrameIndex:
+    """
+    Tracks the complete frames held by a circular stream using absolute byte
+    offsets. An absolute offset counts every byte ever written to the stream,
+    so it never changes as older data is evicted from the buffer. The current
+    buffer position of an offset is found by subtracting ``first_offset``,
+    the absolute offset of the oldest byte still in the buffer.
+
+    Frames are appended as the encoder completes them and trimmed as they are
+    evicted, so locating a frame's position never requires walking the
+    stream's frames. Frame timestamps and keyframes are also kept in sorted
+    lists so ``start_frame()`` can bisect them. This class is not thread safe.
+    Callers should hold the stream's lock.
+    """
+
+    def __init__(self, keyframe_type=None):
+        """
+        :param keyframe_type: the frame type that a decodable stream can start
+        on, like ``PiVideoFrameType.sps_header``. If None, ``start_frame()``
+        does not align to keyframes.
+        """
+        self.__keyframe_type = keyframe_type
+        # Every frame is numbered in the order it was appended. __frames[0]
+        # holds frame number __base and __head is the list index of the
+        # oldest frame still in the buffer.
+        self.__frames = []
+        self.__base = 0
+        self.__head = 0
+        self.__timestamps = []  # Timestamps of the frames that have one
+        self.__timestamp_numbers = []  # Frame numbers matching __timestamps
+        self.__timestamp_head = 0
+        self.__keyframe_numbers = []
+        self.__keyframe_head = 0
+        self.__first_offset = 0
+
+    def __len__(self):
+        return len(self.__frames) - self.__head
+
+    def __iter__(self):
+        for i in range(self.__head, len(self.__frames)):
+            yield self.__frames[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('frame index out of range')
+        return self.__frames[self.__head + i]
+
+    @property
+    def first_offset(self):
+        """
+        The absolute offset of the first byte in the stream's buffer.
+        """
+        return self.__first_offset
+
+    def first(self):
+        return self[0] if len(self) > 0 else None
+
+    def last(self):
+        return self[-1] if len(self) > 0 else None
+
+    def append(self, index, frame_type, timestamp, start, end):
+        """
+        Records a complete frame.
+
+        :param index: the encoder's frame index.
+        :param frame_type: the ``PiVideoFrameType`` of the frame.
+        :param timestamp: the frame's timestamp in microseconds, or None.
+        :param start: the absolute offset of the frame's first byte.
+        :param end: the absolute offset just past the frame's last byte.
+        """
+        number = self.__base + len(self.__frames)
+        self.__frames.append(IndexedFrame(index, frame_type, timestamp, start, end))
+        if timestamp is not None:
+            self.__timestamps.append(timestamp)
+            self.__timestamp_numbers.append(number)
+        if self.__keyframe_type is not None and frame_type == self.__keyframe_type:
+            self.__keyframe_numbers.append(number)
+
+    def trim(self, first_offset):
+        """
+        Drops every frame whose start is no longer held in the buffer.
+
+        :param first_offset: the new absolute offset of the first byte in the
+        stream's buffer.
+        """
+        self.__first_offset = first_offset
+        while self.__head < len(self.__frames) and \
+                self.__frames[self.__head].start < first_offset:
+            self.__head += 1
+        oldest_number = self.__base + self.__head
+        while self.__timestamp_head < len(self.__timestamp_numbers) and \
+                self.__timestamp_numbers[self.__timestamp_head] < oldest_number:
+            self.__timestamp_head += 1
+        while self.__keyframe_head < len(self.__keyframe_numbers) and \
+                self.__keyframe_numbers[self.__keyframe_head] < oldest_number:
+            self.__keyframe_head += 1
+
+        # Compact occasionally so trimming stays amortized O(1).
+        if self.__head > len(self.__frames) // 2:
+            del self.__frames[:self.__head]
+            self.__base += self.__head
+            self.__head = 0
+        if self.__timestamp_head > len(self.__timestamps) // 2:
+            del self.__timestamps[:self.__timestamp_head]
+            del self.__timestamp_numbers[:self.__timestamp_head]
+            self.__timestamp_head = 0
+        if self.__keyframe_head > len(self.__keyframe_numbers) // 2:
+            del self.__keyframe_numbers[:self.__keyframe_head]
+            self.__keyframe_head = 0
+
+    def start_frame(self, timestamp):
+        """
+        Finds the frame a recording starting at ``timestamp`` should begin on,
+        using binary searches rather than a scan of every frame.
+
+        The most recent frame at or before ``timestamp`` is found first, or the
+        oldest frame if every frame is newer. When a ``keyframe_type`` is used,
+        this then moves back to the nearest keyframe so the stream can be
+        decoded from its first byte. If the nearest keyframe was evicted, the
+        next keyframe is used instead.
+
+        :param timestamp: the start time in microseconds.
+        :return: the ``IndexedFrame`` to start on, or None if there are no
+        frames.
+        """
+        if len(self) == 0:
+            return None
+        number = self.__base + self.__head
+        i = bisect_right(self.__timestamps, timestamp, lo=self.__timestamp_head)
+        if i > self.__timestamp_head:
+            number = self.__timestamp_numbers[i-1]
+
+        if self.__keyframe_type is not None:
+            k = bisect_right(self.__keyframe_numbers, number, lo=self.__keyframe_head)
+            if k > self.__keyframe_head:
+                number = self.__keyframe_numbers[k-1]
+            elif k < len(self.__keyframe_numbers):
+                number = self.__keyframe_numbers[k]
+        return self.__frames[number - self.__base]
+
+    def position(self, offset):
+        """
+        :return: the buffer position of an absolute offset.
+        """
+        return offset - self.__first_offset
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+from urllib.parse import parse_qs, urlsplit
+from .mjpeg_streamer import parse_stream_options
+from .writer import http_writer
+from ..util.shutdown import TerminableThread
+
+SHUTDOWN_POLL_INTERVAL = 1  # In seconds
+MAX_REQUEST_HEADER_SIZE = 8*1024  # 8 KB
+
+
+class LiveStreamServer(TerminableThread):
+    """
+    A threaded class that serves live streams from a single asyncio event loop.
+    This keeps long-lived streaming connections away from the uWSGI workers,
+    which stay free to handle the Flask routes. Each viewer costs a coroutine
+    rather than a thread.
+
+    The server speaks just enough HTTP/1.1 to serve GET requests from the
+    nginx container. Routes are looked up in ``self.routes``, which maps a
+    path to a coroutine that takes the parsed query, the stream reader and the
+    stream writer. Additional live formats can be served by adding routes.
+    """
+
+    def __init__(self, mjpeg_broadcast, socket_path, default_rate, web_app_enabled=False):
+        """
+        :param mjpeg_broadcast: the ``MJPEGBroadcast`` to subscribe viewers to.
+        :param socket_path: the path of the unix socket to listen on.
+        :param default_rate: the MJPEG frame rate used when a viewer does not
+        supply an ``fps`` parameter.
+        :param web_app_enabled: if True, the web app's ``/mjpeg`` path is
+        served in addition to ``/api/internal_mjpeg``.
+        """
+        super(LiveStreamServer, self).__init__()
+        self.name = 'LiveStreamServer'
+        self.daemon = True  # Never hold up shutdown for connected viewers.
+        self.__mjpeg_broadcast = mjpeg_broadcast
+        self.__socket_path = socket_path
+        self.__default_rate = default_rate
+        self.logger = logging.getLogger(__name__)
+        self.routes = {'/api/internal_mjpeg': self.serve_mjpeg}
+        if web_app_enabled:
+            self.routes['/mjpeg'] = self.serve_mjpeg
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.__serve())
+        except Exception as e:
+            self.logger.exception('An exception occurred: %s' % e)
+        finally:
+            loop.close()
+        self.logger.debug('Thread stopped.')
+
+    async def __serve(self):
+        if os.path.exists(self.__socket_path):
+            os.remove(self.__socket_path)  # Left over from a previous run.
+        server = await asyncio.start_unix_server(self.__handle_connection,
+                                                 path=self.__socket_path,
+                                                 limit=MAX_REQUEST_HEADER_SIZE)
+        os.chmod(self.__socket_path, 0o660)
+        self.logger.info('Serving live streams at %s.' % self.__socket_path)
+        async with server:
+            while self.should_run:
+                await asyncio.sleep(SHUTDOWN_POLL_INTERVAL)
+
+    async def __handle_connection(self, reader, writer):
+        try:
+            try:
+                request = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            method, target = request.decode('latin-1').split(' ')[:2]
+            url = urlsplit(target)
+            route = self.routes.get(url.path)
+            if method != 'GET':
+                await self.__respond_empty(writer, '405 Method Not Allowed')
+            elif route is None:
+                await self.__respond_empty(writer, '404 Not Found')
+            else:
+                await route(parse_qs(url.query), reader, writer)
+        except (ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            self.logger.exception('An exception occurred serving a request: %s' % e)
+        finally:
+            writer.close()
+
+    async def __respond_empty(self, writer, status):
+        writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status).encode())
+        await writer.drain()
+
+    async def serve_mjpeg(self, query, reader, writer):
+        """
+        Streams MJPEG frames to the client until it disconnects. Supports the
+        same parameters as the Flask MJPEG routes.
+        """
+        try:
+            variant, fps = parse_stream_options({key: values[0] for key, values in query.items()},
+                                                self.__default_rate)
+        except ValueError:
+            await self.__respond_empty(writer, '422 Unprocessable Entity')
+            return
+
+        loop = asyncio.get_event_loop()
+        frame_writer = self.__mjpeg_broadcast.subscribe(variant, rate=fps, loop=loop)
+        try:
+            writer.write(('HTTP/1.1 200 OK\r\n' +
+                          'Content-Type: multipart/x-mixed-replace; boundary=' + http_writer.MULTIPART_BOUNDARY + '\r\n' +
+                          'Cache-Control: no-cache\r\n' +
+                          'Connection: close\r\n\r\n').encode())
+            while self.should_run and not reader.at_eof():
+                writer.write(await frame_writer.async_read())
+                await writer.drain()
+        finally:
+            # Unsubscribing may move the servo, which runs its own event loop.
+            await loop.run_in_executor(None, self.__mjpeg_broadcast.unsubscribe, frame_writer)
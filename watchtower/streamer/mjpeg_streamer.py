@@ -1,43 +1,124 @@
-import io
-import sys
-from .stream_saver import StreamSaver
+import logging
+from threading import Lock
+from .writer.http_writer import AsyncHTTPMultipartWriter, HTTPMultipartWriter, Variant, DEFAULT_QUEUE_DEPTH
 from ..remote.servo import Servo
 
+MAX_QUALITY = 95  # Higher JPEG qualities only inflate the frames
 
-class MJPEGStreamer(StreamSaver):
+
+def parse_stream_options(args, default_rate):
+    """
+    Parses the optional MJPEG stream parameters shared by every MJPEG route.
+
+    :param args: a mapping of parameter names to string values. Supports
+    ``encoding``, ``fps``, ``width`` and ``quality``.
+    :param default_rate: the rate used when ``fps`` is not supplied.
+    :return: a tuple of the requested ``Variant`` and frame rate.
+    :raises ValueError: if a parameter is malformed or out of range.
+    """
+    fps = float(args.get('fps', default_rate))
+    width = args.get('width')
+    width = int(width) if width is not None else None
+    quality = args.get('quality')
+    quality = int(quality) if quality is not None else None
+    if fps <= 0 or \
+            (width is not None and width <= 0) or \
+            (quality is not None and not 1 <= quality <= MAX_QUALITY):
+        raise ValueError('Invalid MJPEG stream parameters.')
+    return Variant(width, quality, args.get('encoding') == 'base64'), fps
+
+
+
+class MJPEGBroadcast:
     """
-    A streamer that captures individual JPEG frames from the camera.
+    Shares the frames of one ``HTTPMultipartBroadcaster`` among every MJPEG
+    viewer. The broadcaster is fed directly by the ``MJPEGRecorder`` as the
+    encoder produces JPEGs, so viewers are only woken when a new frame exists
+    and no thread is needed per viewer.
     """
 
-    def __init__(self, camera, byte_writers, name, servo=None, rate=1):
-        super(MJPEGStreamer, self).__init__(stream=io.BytesIO(),
-                                            byte_writers=byte_writers,
-                                            name=name,
-                                            stop_when_empty=False)
+    def __init__(self, broadcaster, camera, servo=None, max_rate=None, queue_depth=DEFAULT_QUEUE_DEPTH):
+        """
+        :param broadcaster: the ``HTTPMultipartBroadcaster`` receiving JPEGs.
+        :param camera: the camera instance supplying the frames.
+        :param servo: an optional servo that is flipped off when the last
+        viewer leaves and the camera isn't monitoring.
+        :param max_rate: the highest frames per second a viewer can request.
+        This should match the encoder's framerate.
+        :param queue_depth: the number of unread frames held for each viewer
+        before older frames are dropped.
+        """
+        self.__broadcaster = broadcaster
         self.__camera = camera
         self.__servo = servo
-        self.read_wait_time = 1/rate
+        self.__max_rate = max_rate
+        self.__queue_depth = queue_depth
+        self.__lock = Lock()
+        self.__subscriber_count = 0
+
+    @property
+    def subscriber_count(self):
+        with self.__lock:
+            return self.__subscriber_count
 
-    def read(self, position, length=None):
+    def subscribe(self, variant, rate=None, loop=None):
         """
-        Overridden to capture a new JPEG into the stream each call.
+        Registers a new viewer.
 
-        :param position: Not used. Position will always be set to 0.
-        :param length: Not used. The superclass is expected to read all the
-        JPEG data.
-        :return: The superclass data from ``read``.
+        :param variant: the ``Variant`` of the frames sent to the viewer.
+        :param rate: the frames per second requested by the viewer. Values
+        above the encoder framerate are clamped. If None, the viewer receives
+        every frame.
+        :param loop: the asyncio event loop serving the viewer, if any. When
+        supplied, an ``AsyncHTTPMultipartWriter`` is returned.
+        :return: an ``HTTPMultipartWriter`` for the viewer.
         """
-        self.stream.seek(0)  # Always reset to 0
-        self.stream.truncate(0) # Dump the old data
-        self.stream.write(self.__camera.jpeg_data)
-        return super(MJPEGStreamer, self).read(0, length=sys.maxsize)
+        if rate is not None and self.__max_rate is not None:
+            rate = min(rate, self.__max_rate)
+        if loop is not None:
+            writer = AsyncHTTPMultipartWriter(self.__broadcaster,
+                                              loop,
+                                              variant=variant,
+                                              rate=rate,
+                                              queue_depth=self.__queue_depth)
+        else:
+            writer = HTTPMultipartWriter(self.__broadcaster,
+                                         variant=variant,
+                                         rate=rate,
+                                         queue_depth=self.__queue_depth)
+        self.__broadcaster.subscribe(writer)
+        with self.__lock:
+            self.__subscriber_count += 1
+            logging.getLogger(__name__).debug('MJPEG viewer subscribed. Viewers: %d' % self.__subscriber_count)
+        return writer
 
-    def ended(self):
+    def unsubscribe(self, writer):
         """
-        Overridden to flip the servo back off if the camera is not running.
+        Removes a viewer. Once no viewers remain, the servo is flipped back off
+        if the camera is not running.
         """
-        
-        super(MJPEGStreamer, self).ended()
-        if not self.__camera.should_monitor and \
+        self.__broadcaster.unsubscribe(writer)
+        with self.__lock:
+            self.__subscriber_count -= 1
+            remaining = self.__subscriber_count
+            logging.getLogger(__name__).debug('MJPEG viewer unsubscribed after %d dropped frames. Viewers: %d' % (writer.dropped_frames, remaining))
+        if remaining == 0 and \
+                not self.__camera.should_monitor and \
                 self.__servo is not None:
             self.__servo.disable()
+
+    def stats(self):
+        """
+        :return: a dictionary describing every connected viewer.
+        """
+        return dict(
+            queue_depth=self.__queue_depth,
+            viewers=[dict(
+                base64=writer.variant.use_base64,
+                width=writer.variant.width,
+                quality=writer.variant.quality,
+                rate=writer.rate,
+                queued_frames=writer.queued_frames,
+                dropped_frames=writer.dropped_frames
+            ) for writer in self.__broadcaster.writers]
+        )
@@ -1,18 +1,19 @@
 from ..util.shutdown import TerminableThread
-from threading import Lock
-import time
+from .writer.queued_writer import QueuedWriter
+from threading import Event
 import logging
 
 
 MAX_READ_BYTES = int(1024*1024*2.5)  # 2.5 MB
-READ_DATA_WAIT_TIME = 0.3  # Wait time for the next upload if data was read
-EMPTY_WAIT_TIME = 0.5  # Wait time for next read if no data found
+POLL_INTERVAL = 0.5  # Wait time for next read if no data found
 
 
 class StreamSaver(TerminableThread):
     """
     A threaded class that loops over its stream in chunks and uploads read
-    bytes into its ``byte_writer`` instances.
+    bytes into its ``byte_writer`` instances. Each writer is fed through a
+    ``QueuedWriter`` so a slow writer never delays the others or the next
+    read from the stream.
     """
 
     def __init__(self, stream, byte_writers, name, stop_when_empty=False):
@@ -22,7 +23,8 @@ class StreamSaver(TerminableThread):
         ``PiCameraCircularIO`` type, the ``lock`` will be used to ensure the
         camera doesn't modify the stream while it is read.
         :param byte_writers: an array of instances that subclass the
-        ``ByteWriter`` class.
+        ``ByteWriter`` class. Writers that aren't a ``QueuedWriter`` are
+        wrapped in one using the default queue size and backpressure.
         :param name: should be unique for the steam. It is used for log
         statements.
         :param stop_when_empty: if True, the streamer will stop writing to the
@@ -31,19 +33,16 @@ class StreamSaver(TerminableThread):
         """
         super(StreamSaver, self).__init__()
         self.stream = stream
-        self.__byte_writers = byte_writers
-        self.__lock = Lock()
+        self.__byte_writers = [writer if isinstance(writer, QueuedWriter) else QueuedWriter(writer)
+                               for writer in byte_writers]
         self.__stop_when_empty = stop_when_empty
-        self.__stop = False
+        self.__stop_event = Event()
         self.name = name
         self.logger = logging.getLogger(__name__ + '.' + self.name)
-        self.read_wait_time = READ_DATA_WAIT_TIME
 
-    def __stop_called(self):
-        self.__lock.acquire()
-        should_stop = self.__stop
-        self.__lock.release()
-        return should_stop
+    @property
+    def stop_requested(self):
+        return self.__stop_event.is_set()
 
     def stop(self):
         """
@@ -51,9 +50,13 @@ class StreamSaver(TerminableThread):
         sent to the ``byte_writer`` instances with the ``close`` flag. 
         Finally, the thread will stop.
         """
-        self.__lock.acquire()
-        self.__stop = True
-        self.__lock.release()
+        self.__stop_event.set()
+
+    def stats(self):
+        """
+        :return: a list describing the queue of each writer.
+        """
+        return [dict(writer.stats(), stream=self.name) for writer in self.__byte_writers]
 
     def start_pos(self):
         """
@@ -77,10 +80,26 @@ class StreamSaver(TerminableThread):
             read_bytes = ''
         return read_bytes, position + len(read_bytes)
 
+    def wait_for_data(self, bytes_read):
+        """
+        Called between reads to wait until more data may be available. Should
+        return early when ``stop()`` is called. Subclasses with streams that
+        signal new data should override this.
+
+        A finite stream can hold more than one read, so the next read happens
+        immediately if bytes were read. Otherwise this polls the stream every
+        ``POLL_INTERVAL`` seconds.
+
+        :param bytes_read: the number of bytes returned by the last read.
+        """
+        if bytes_read == 0:
+            self.__stop_event.wait(POLL_INTERVAL)
+
     def run(self):
         """
         Loops over the stream and calls ``read()`` to read bytes in chunks. All
-        bytes are sent to the ``byte_writer`` instances.
+        bytes are sent to the ``byte_writer`` instances. ``wait_for_data()`` is
+        called between reads.
 
         Reading stops when one of these conditions is met:
         1) ``stop()`` is called
@@ -97,17 +116,15 @@ class StreamSaver(TerminableThread):
                 read_bytes, stream_pos = self.read(stream_pos)
                 total_bytes += len(read_bytes)
 
-                stopped = self.__stop_called() or \
+                stopped = self.stop_requested or \
                     (self.__stop_when_empty and len(read_bytes) == 0) or \
                     not self.should_run
 
                 for writer in self.__byte_writers:
                     writer.append_bytes(read_bytes, stopped)
                 self.logger.debug('Read %d bytes.' % len(read_bytes)) if len(read_bytes) > 0 else None
-                if len(read_bytes) == 0:
-                    time.sleep(EMPTY_WAIT_TIME)  # Wait for more data
-                else:
-                    time.sleep(self.read_wait_time)  # Avoid consuming the CPU
+                if not stopped:
+                    self.wait_for_data(len(read_bytes))
             self.logger.debug('Processed %d total bytes.' % total_bytes)
             if not self.should_run:
                 self.logger.debug('Thread stopped.')
@@ -120,6 +137,9 @@ class StreamSaver(TerminableThread):
             except Exception as e2:
                 self.logger.exception('Attempted to close the writer. Received an exception: %s' % e2)
         finally:
+            # Stay alive until every writer has written its queued bytes.
+            for writer in self.__byte_writers:
+                writer.join()
             self.ended()
 
     def ended(self):
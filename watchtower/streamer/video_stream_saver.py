@@ -1,90 +1,124 @@
-import io
 import time
 from .stream_saver import StreamSaver
 
+SHUTDOWN_POLL_INTERVAL = 1  # In seconds
+
 
 class VideoStreamSaver(StreamSaver):
     """
     A StreamSaver that uses a camera stream. Safely locks the camera stream
     while accessing it. Also determines the best starting point to read the
-    stream based on frame timestamps.
+    stream based on frame timestamps and keyframes, using the stream's
+    ``frame_index`` to track frame positions as the circular buffer is written
+    to.
+
+    Rather than polling, the saver sleeps on the stream's ``frame_condition``
+    and is woken by the camera as complete frames are written, so reads track
+    the encoder's output.
     """
 
-    def __init__(self, stream, byte_writers, name, start_time, stop_when_empty=False):
+    def __init__(self, stream, byte_writers, name, start_time, stop_when_empty=False, min_batch_bytes=0, max_batch_delay=0):
+        """
+        :param stream: must provide a ``lock``, a ``frame_condition`` that is
+        notified as frames are written, and a ``frame_index`` that is kept up
+        to date with those frames, like ``IndexedCircularIO``.
+        :param min_batch_bytes: the number of new bytes to wait for before
+        reading. 0 reads as soon as a frame is complete.
+        :param max_batch_delay: the most seconds to wait for
+        ``min_batch_bytes`` once new frames are available.
+        """
         super(VideoStreamSaver, self).__init__(stream, byte_writers, name, stop_when_empty)
         self.__start_time = start_time
-        self.__last_streamed_frame = None
+        self.__next_offset = None  # Absolute offset of the next byte to stream
+        self.__min_batch_bytes = min_batch_bytes
+        self.__max_batch_delay = max_batch_delay
 
     def start_pos(self):
         """
-        :return: The position of the most recent frame before ``__start_time``.
+        :return: The position of the SPS header frame preceding the most recent
+        frame before ``__start_time``. Starting on a header frame ensures every
+        byte that is saved can be decoded.
         """
         self.logger.debug('Using start timestamp %ds.' % self.__start_time)
         with self.stream.lock:
-            start_frame = None
-            for frame in self.stream.frames:
-                is_before_start_time = frame.timestamp is not None and (frame.timestamp / 1000000) <= self.__start_time
-                if start_frame is None or is_before_start_time:
-                    start_frame = frame
+            frame_index = self.stream.frame_index
+            start_frame = frame_index.start_frame(self.__start_time * 1000000)
             timestamp = (start_frame.timestamp / 1000000) if start_frame.timestamp is not None else 0
             self.logger.debug('Using frame with timestamp: %d' % timestamp)
-            self.__last_streamed_frame = start_frame
-            return start_frame.position
+            self.__next_offset = start_frame.start
+            return frame_index.position(start_frame.start)
 
     def read(self, position, length=None):
         """
-        Overridden to use the stream's ``frames`` property to locate the read
+        Overridden to use the stream's ``frame_index`` to locate the read
         position (useful if the stream is still being appended to) and compute
-        the distance to the last frame in the stream.
+        the distance to the last frame in the stream. The index tracks absolute
+        offsets, so the position of the last streamed byte is found without
+        walking the stream's frames, keeping the time the stream is locked
+        independent of the buffer's length.
+
+        The range is gathered as views over the stream's chunks with
+        ``read_range()`` while the stream is locked. The views are joined after
+        unlocking, so the requested range is copied at most once and the rest
+        of the buffer is never copied.
 
         :param position: Not used because it is recalculated using the
-        ``frames`` property of the stream.
+        ``frame_index`` property of the stream.
         :param length: Not used because the length is computed using the last
         frame in the stream.
-        :return: a tuple of the bytes read and the position where reading
-        stopped.
+        :return: a tuple of the bytes-like object read and the position where
+        reading stopped.
         """
-
-        bytes_read = None
         with self.stream.lock:
-            last_streamed_index = self.__last_streamed_frame.index
-            for frame in reversed(self.stream.frames):
-                # We have to find the frame in the updated stream each time the
-                # stream is read. In the case of a circular stream that's still
-                # being written to, the frame will likely have a new position.
-                self.__last_streamed_frame = frame
-                if frame.index == last_streamed_index:
-                    break
-            position = self.__last_streamed_frame.position
-            last_frame = next(reversed(self.stream.frames))  # Read up to the last frame
-            length = last_frame.position - self.__last_streamed_frame.position
-            self.__last_streamed_frame = last_frame
-            
-            if length < 1000000: #1 mbit
-                # Using read() uses less memory but consumes more CPU cycles.
-                # To avoid blocking, only do this when the stream is small.
-                start_time = time.time()
-                bytes_read, new_position = super(VideoStreamSaver, self).read(position, length)
-                self.logger.debug('Using read() for length of %i bytes. Time: %.2f sec' % (length, time.time() - start_time))
-                return bytes_read, new_position
-            else:
-                # Creating a copy of the stream via getvalue() and then creating
-                # a sub array will consume a large amount of memory, depending
-                # on the stream's bitrate and its total length in seconds. This
-                # is necessary because read() and copy_to() are too slow and
-                # will cause frames to drop.
-                start_time = time.time()
-                bytes_read = self.stream.getvalue()
-                self.logger.debug('Using getvalue() for length of %i bytes. Time: %.2f sec' % (len(bytes_read), time.time() - start_time))
-                # At this point, let the stream unlock. Creating a sub array can
-                # take almost as long as the call to getvalue() if we're dealing
-                # with tens of megabytes.
+            frame_index = self.stream.frame_index
+            if self.__next_offset < frame_index.first_offset:
+                # The camera overwrote data before it could be streamed.
+                self.logger.warning('Skipping %i bytes evicted from the stream.' % (frame_index.first_offset - self.__next_offset))
+                self.__next_offset = frame_index.first().start
+            position = frame_index.position(self.__next_offset)
+            last_position = frame_index.position(frame_index.last().start)  # Read up to the last frame
+            self.__next_offset = frame_index.last().start
+            views = self.stream.read_range(position, last_position)
 
+        if len(views) == 0:
+            return b'', position
+        if len(views) == 1:
+            return views[0], last_position  # No copy needed.
         start_time = time.time()
-        bytes_read = bytes_read[position:last_frame.position]
-        self.logger.debug('Time to slice array for %i bytes. Time: %.2f sec' % (len(bytes_read), time.time() - start_time))
-        return bytes_read, position + len(bytes_read)
-                
+        bytes_read = b''.join(views)
+        self.logger.debug('Joined %i chunks for %i bytes. Time: %.2f sec' % (len(views), len(bytes_read), time.time() - start_time))
+        return bytes_read, last_position
+
+    def stop(self):
+        """
+        Overridden to wake the saver if it is waiting for frames.
+        """
+        super(VideoStreamSaver, self).stop()
+        with self.stream.frame_condition:
+            self.stream.frame_condition.notify_all()
+
+    def wait_for_data(self, bytes_read):
+        """
+        Overridden to wait until the camera has written ``min_batch_bytes`` of
+        complete frames past the last read, or ``max_batch_delay`` has passed
+        since the first of those frames arrived.
+        """
+        deadline = None
+        with self.stream.frame_condition:
+            while not self.stop_requested and self.should_run:
+                last_frame = self.stream.frame_index.last()
+                available = last_frame.start - self.__next_offset if last_frame is not None else 0
+                if available > 0:
+                    if available >= self.__min_batch_bytes:
+                        return
+                    if deadline is None:
+                        deadline = time.monotonic() + self.__max_batch_delay
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        return
+                else:
+                    timeout = SHUTDOWN_POLL_INTERVAL
+                self.stream.frame_condition.wait(timeout)
 
     def ended(self):
         """
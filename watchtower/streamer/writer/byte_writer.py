@@ -13,6 +13,11 @@ class ByteWriter:
 
     @abstractmethod
     def append_bytes(self, bts, close=False):
+        """
+        :param bts: any bytes-like object, such as ``bytes`` or a
+        ``memoryview`` over a stream's buffer.
+        :param close: when True, this is the last call to the writer.
+        """
         pass
 
     def append_string(self, string, close=False):
@@ -1,21 +1,141 @@
+import ctypes
+import ctypes.util
+import logging
 import os
+import time
 from . import byte_writer
+from enum import Enum
+
+BLOCK_SIZE = 4096  # Writes are sized in multiples of the page size
+DEFAULT_FSYNC_INTERVAL = 5  # In seconds
+FALLOC_FL_KEEP_SIZE = 1  # From linux/falloc.h
+
+
+class FsyncPolicy(Enum):
+    """
+    When a ``DiskWriter`` forces its data onto the storage device.
+    """
+    never = 'never'  # Leave it to the OS.
+    interval = 'interval'  # At most every ``fsync_interval`` seconds.
+    close = 'close'  # Once, when the file is closed.
+
+
+def _load_fallocate():
+    """
+    :return: libc's ``fallocate`` with 64 bit offsets, or None if it isn't
+    available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def reserve_space(fd, offset, length):
+    """
+    Allocates disk space for a file without changing its size, so readers
+    never see the reserved space as zeros at the end of the file, even if
+    the file is never closed.
+
+    :raises OSError: if the space can't be reserved, or the file system
+    doesn't support reserving space past the end of a file.
+    """
+    if _fallocate is None:
+        raise OSError('fallocate is not available')
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
 
 
 class DiskWriter(byte_writer.ByteWriter):
     """
     A simple class that writes all supplied bytes to a file.  Will close the
     file when finished.
+
+    Bytes can optionally be collected in a buffer and written in large blocks,
+    and the file can be preallocated. Both reduce the number of small writes
+    and metadata updates reaching an SD card. This class is meant to be fed by
+    a ``QueuedWriter``, whose worker thread performs the writes.
     """
 
-    def __init__(self, full_path):
+    def __init__(self, full_path, buffer_size=0, preallocate_bytes=0, fsync_policy=FsyncPolicy.never, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        """
+        :param full_path: The full path of the file. Bytes are appended if it
+        already exists.
+        :param buffer_size: The number of bytes to collect before writing. It is
+        rounded up to a multiple of ``BLOCK_SIZE``. 0 writes every append
+        immediately.
+        :param preallocate_bytes: The expected size of the file. This much
+        space is reserved with ``reserve_space`` when the file is opened, and
+        the unused space is released when it is closed.
+        :param fsync_policy: The ``FsyncPolicy`` to use.
+        :param fsync_interval: The seconds between syncs when using
+        ``FsyncPolicy.interval``.
+        """
         super(DiskWriter, self).__init__(full_path)
         if not os.path.exists(os.path.dirname(full_path)):
             os.makedirs(os.path.dirname(full_path))
-        self.file = open(full_path, 'ab')
+        self.__buffer_size = -(-buffer_size // BLOCK_SIZE) * BLOCK_SIZE
+        self.__buffer = bytearray()
+        self.__fsync_policy = fsync_policy
+        self.__fsync_interval = fsync_interval
+        self.__last_sync = time.monotonic()
+
+        fd = os.open(full_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.__offset = os.fstat(fd).st_size
+        self.__preallocated = False
+        if preallocate_bytes > 0:
+            try:
+                reserve_space(fd, self.__offset, preallocate_bytes)
+                self.__preallocated = True
+            except OSError as e:
+                logging.getLogger(__name__).warning('Unable to preallocate %s: %s' % (full_path, e))
+        self.file = os.fdopen(fd, 'wb', buffering=0)
+        self.file.seek(self.__offset)
 
     def append_bytes(self, bts, close=False):
-        if self.file is not None:
-            self.file.write(bts) if len(bts) > 0 else None
-            if close:
-                self.file.close()
+        if self.file is None:
+            return
+        if self.__buffer_size == 0:
+            self.__write(bts)
+        else:
+            self.__buffer += bts
+            if len(self.__buffer) >= self.__buffer_size:
+                # Only write whole blocks, keeping the remainder buffered.
+                length = len(self.__buffer) - len(self.__buffer) % self.__buffer_size
+                with memoryview(self.__buffer) as view:
+                    self.__write(view[:length])
+                del self.__buffer[:length]
+
+        if close:
+            self.__write(self.__buffer)
+            self.__buffer = bytearray()
+            if self.__preallocated:
+                # Truncating to the size written frees the blocks reserved
+                # past the end of the file.
+                self.file.truncate(self.__offset)
+            if self.__fsync_policy is not FsyncPolicy.never:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+        elif self.__fsync_policy is FsyncPolicy.interval and \
+                time.monotonic() - self.__last_sync >= self.__fsync_interval:
+            os.fsync(self.file.fileno())
+            self.__last_sync = time.monotonic()
+
+    def __write(self, bts):
+        """
+        Writes every byte, since an unbuffered write can be partial.
+        """
+        with memoryview(bts) as view:
+            written = 0
+            while written < len(view):
+                written += self.file.write(view[written:])
+        self.__offset += written
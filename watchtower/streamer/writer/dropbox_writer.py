@@ -1,47 +1,62 @@
-import base64
 import dropbox
 import logging
 import os
-import queue
 import sys
 import time
-from . import byte_writer
-from collections import namedtuple
-from cryptography.fernet import Fernet
+from . import byte_writer, encryption
+from .upload_scheduler import UploadScheduler
+from collections import deque, namedtuple
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from threading import Thread, Lock
+from cryptography.hazmat.primitives import serialization
+from threading import Lock
 
-THREAD_COUNT = 2
 DEFAULT_FILE_CHUNK_SIZE = 512*1024 # 512 KB
+DEFAULT_SESSION_APPEND_SIZE = 256*1024 # 256 KB
 NumberedFile = namedtuple('NumberedFile', 'number bytes')
+FilePart = namedtuple('FilePart', 'number bytes offset last')
 
 
 class DropboxWriter(byte_writer.ByteWriter):
     """
     A class that accumulates bytes to upload to Dropbox and uploads chunks sized
     according to the ``file_chunk_size``. If the provided size is <= 0, the file
-    is not broken apart and only one upload thread is used. Otherwise, this
-    class creates additional files as the chunk size is reached.
+    is not broken apart. Otherwise, this class creates additional files as the
+    chunk size is reached. The files are uploaded by an ``UploadScheduler``
+    shared with the other writers.
     
     If the path to a public key file is supplied, the bytes will be encrypted
-    and the random symmetric encryption key used to encrypt the data will
-    itself be encrypted and prepended to the front of the file. Fernet
-    encryption is used. The key itself is encrypted using the public key.
+    with a random AES-256 key generated for this writer. The key is encrypted
+    once using the public key and stored in the header of every file, which
+    is written in the format described in ``encryption``.
+
+    Files can instead be streamed with Dropbox upload sessions. Bytes are then
+    sent as soon as ``session_append_size`` bytes are pooled and each file is
+    committed when it reaches ``file_chunk_size``, so a full chunk is never
+    held in memory.
     """
 
-    def __init__(self, full_path, dropbox_token, file_chunk_size=DEFAULT_FILE_CHUNK_SIZE, public_pem_path=None, test_dropbox_uploader=None):
+    def __init__(self, full_path, dropbox_token, file_chunk_size=DEFAULT_FILE_CHUNK_SIZE, public_pem_path=None, test_dropbox_uploader=None, upload_sessions=False, session_append_size=DEFAULT_SESSION_APPEND_SIZE, spool=None, encryption_pool=None, scheduler=None):
         """
         :param full_path: The full path of the file.
         :param dropbox_token: Token that will be supplied to Dropbox.
         :param file_chunk_size: A maximum size, in bytes, before a new file
         will be created. Actual size will be larger if encryption is used.
-        :param public_pem_path: A path to the public key to encrypt each file's
-        encryption key.
+        :param public_pem_path: A path to the public key to encrypt the
+        recording's encryption key.
         :param test_dropbox_uploader: An object that will be used in place of
         the normal Dropbox uploader. Useful for testing. Object must implement
-        the files_upload(bytes, path) method.
+        the files_upload(bytes, path) method, and the upload session methods
+        if ``upload_sessions`` is used.
+        :param upload_sessions: If True, files are streamed using upload
+        sessions.
+        :param session_append_size: The number of bytes to pool before they
+        are appended to an upload session.
+        :param spool: An optional ``UploadSpool`` that journals each whole file
+        before it is uploaded and retries failed uploads.
+        :param encryption_pool: An optional ``EncryptionPool`` that encrypts
+        the files in other processes.
+        :param scheduler: The ``UploadScheduler`` that uploads the files.
+        Defaults to the scheduler shared by the process.
         """
         super(DropboxWriter, self).__init__(full_path)
         if file_chunk_size <= 0:
@@ -50,148 +65,276 @@ class DropboxWriter(byte_writer.ByteWriter):
             self.__file_chunk_size = file_chunk_size
         
         self.__file_count = 0
-        self.__byte_pool = ''.encode()
+        self.__byte_pool = deque()  # memoryviews of the bytes not yet distributed
+        self.__pool_size = 0
 
-        dbx = None
+        self.__scheduler = scheduler if scheduler is not None else UploadScheduler.shared()
         if test_dropbox_uploader is None:
-            dbx = dropbox.Dropbox(dropbox_token)
+            dbx = self.__scheduler.client(dropbox_token)
         else:
             dbx = test_dropbox_uploader
-        public_key = None
+        event_key = None
         if public_pem_path:
             with open(public_pem_path, "rb") as public_key_file:
                 public_key = serialization.load_pem_public_key(public_key_file.read(), backend=default_backend())
-                
-        if public_key is not None:
+            event_key = encryption.EventKey(public_key)
             logging.getLogger(__name__).debug('Using encryption!')
+        self.__upload_sessions = upload_sessions
+        self.__session_append_size = session_append_size
+        self.__file_offset = 0  # Bytes of the current file sent to a session
 
         path, extension = os.path.splitext(full_path)
-        self.__uploader_threads = []
-        thread_count = THREAD_COUNT if file_chunk_size > 0 else 1
-        for i in range(thread_count):
-            uploader = DropboxFileUploader(dbx, path, extension, public_key, i)
-            self.__uploader_threads.append(uploader)
-            uploader.start()
-        self.__thread_index = 0
+        self.__uploader = DropboxFileUploader(dbx, path, extension, event_key, spool=spool, encryption_pool=encryption_pool)
+        self.__lock = Lock()
+        self.__pending_uploads = 0
+        self.__closed = False
 
     def append_bytes(self, bts, close=False):
         """
         This method will append the bytes to a small array. When enough bytes
-        have been appended, one or more chunks is broken off and distributed to
-        an uploader thread.
+        have been appended, one or more chunks is broken off and scheduled for
+        upload.
+
+        The pool is a list of the appended buffers, so appending never copies
+        the bytes already pooled. Each chunk is copied once when it is cut.
         """
-        self.__byte_pool += bts
-        logging.getLogger(__name__).debug('Byte pool length: %i bytes' % len(self.__byte_pool))
-        if len(self.__byte_pool) < self.__file_chunk_size and not close:
-            return # Wait for more data.
-        
-        # Break apart the bytes and distribute each chunk to an uploader.
-        sub_bytes = self.__byte_pool[:self.__file_chunk_size]
-        while len(sub_bytes) == self.__file_chunk_size:
-            self.__distribute_file_bytes(sub_bytes)
-            self.__byte_pool = self.__byte_pool[self.__file_chunk_size:]  # Remove the chunk.
-            sub_bytes = self.__byte_pool[:self.__file_chunk_size]  # Fetch the next chunk.
-        self.__byte_pool = sub_bytes  # The last chunk, smaller than file_chunk_size.
-        
+        view = memoryview(bts).cast('B')
+        if not view.readonly:
+            view = memoryview(bytes(view))  # The caller may reuse its buffer.
+        if len(view) > 0:
+            self.__byte_pool.append(view)
+            self.__pool_size += len(view)
+        logging.getLogger(__name__).debug('Byte pool length: %i bytes' % self.__pool_size)
+
+        if self.__upload_sessions:
+            self.__distribute_parts(close)
+        else:
+            # Break apart the bytes and distribute each chunk to an uploader.
+            while self.__pool_size >= self.__file_chunk_size:
+                self.__distribute_file_bytes(self.__take(self.__file_chunk_size))
+            if close == True and self.__pool_size > 0:
+                # Dump the remaining data.
+                self.__distribute_file_bytes(self.__take(self.__pool_size))
+
         if close == True:
-            # Dump the remaining data.
-            if len(self.__byte_pool) > 0:
-                self.__distribute_file_bytes(self.__byte_pool)
-            # Stop all threads.
-            list(map(lambda x: x.stop(), self.__uploader_threads))
+            with self.__lock:
+                self.__closed = True
+
+    def __distribute_parts(self, close):
+        """
+        Sends pooled bytes to upload sessions. A file's session is committed
+        once the file reaches ``file_chunk_size``.
+        """
+        while True:
+            remaining_in_file = self.__file_chunk_size - self.__file_offset
+            if self.__pool_size >= remaining_in_file:
+                self.__distribute_part(self.__take(remaining_in_file), last=True)
+            elif self.__pool_size >= self.__session_append_size:
+                self.__distribute_part(self.__take(self.__pool_size), last=False)
+            else:
+                break
+        if close and (self.__pool_size > 0 or self.__file_offset > 0):
+            self.__distribute_part(self.__take(self.__pool_size), last=True)
+
+    def __distribute_part(self, bts, last):
+        """
+        Schedules part of the current file. Every part of a file shares a lane
+        so they are uploaded in order.
+        """
+        part = FilePart(self.__file_count, bts, self.__file_offset, last)
+        self.__schedule(part)
+        self.__file_offset += len(bts)
+        if last:
+            self.__file_count += 1
+            self.__file_offset = 0
+
+    def __take(self, length):
+        """
+        Removes ``length`` bytes from the front of the pool. Only the buffer
+        that straddles the end of the chunk is split, by slicing its view.
+
+        :return: the removed bytes.
+        """
+        parts = []
+        remaining = length
+        while remaining > 0:
+            view = self.__byte_pool.popleft()
+            if len(view) > remaining:
+                self.__byte_pool.appendleft(view[remaining:])
+                view = view[:remaining]
+            parts.append(view)
+            remaining -= len(view)
+        self.__pool_size -= length
+        return b''.join(parts)
 
     def is_finished_writing(self):
-        for uploader_thread in self.__uploader_threads:
-            if uploader_thread.is_alive():
-                return False
-        return True
+        with self.__lock:
+            return self.__closed and self.__pending_uploads == 0
     
     def __distribute_file_bytes(self, bts):
         """
-        Creates a unique file with the supplied bytes and passes this to an
-        uploader thread in a round robin fashion.
+        Creates a unique file with the supplied bytes and schedules it.
         """
         numbered_file = NumberedFile(self.__file_count, bts)
-        self.__uploader_threads[self.__thread_index].append_file(numbered_file)
-        logging.getLogger(__name__).debug('Distributed file to DropboxFileUploader #%i' % self.__thread_index)
+        self.__schedule(numbered_file)
+        logging.getLogger(__name__).debug('Scheduled file %i' % self.__file_count)
         self.__file_count += 1
-        if self.__thread_index == len(self.__uploader_threads) - 1:
-            self.__thread_index = 0
-        else:
-            self.__thread_index += 1
 
+    def __schedule(self, numbered_file):
+        with self.__lock:
+            self.__pending_uploads += 1
+        self.__scheduler.submit((self.__uploader, numbered_file.number),
+                                lambda: self.__uploader.upload(numbered_file),
+                                len(numbered_file.bytes),
+                                self.__upload_done)
 
-class DropboxFileUploader(Thread):
+    def __upload_done(self):
+        with self.__lock:
+            self.__pending_uploads -= 1
+
+
+class DropboxFileUploader:
     """
-    Threaded class used to accumulate data that needs to be uploaded to Dropbox.
-    If a public key is supplied, this class will optionally encrypt the data
-    before uploading.
+    Uploads the files of one ``DropboxWriter``. If an event key is supplied,
+    this class will encrypt the data before uploading. If a spool is supplied,
+    each whole file is journaled in the spool before it is uploaded and failed
+    uploads are left to the spool to retry.
     """
 
-    def __init__(self, dbx: dropbox.Dropbox, path: str, extension: str, public_key=None, log_number=0):
-        super(DropboxFileUploader, self).__init__()
+    def __init__(self, dbx: dropbox.Dropbox, path: str, extension: str, event_key=None, spool=None, encryption_pool=None):
         self.__dbx = dbx
         self.__path = path
         self.__extension = extension
-        self.__public_key = public_key
-        self.__log_number = log_number
-        self.__stop = False
-        self.__lock = Lock()
-        self.__queue = queue.Queue()
+        self.__event_key = event_key
+        self.__encryption_pool = encryption_pool
+        self.__spool = spool
+        self.__sessions = {}  # Upload session IDs and offsets keyed by file number, or None once abandoned
+        self.__spool_entries = {}  # Spool entries of files uploaded with sessions, keyed by file number
+        self.__encryptors = {}  # StreamEncryptors keyed by file number
 
-    def __should_stop(self):
-        self.__lock.acquire()
-        should_stop = self.__stop
-        self.__lock.release()
-        return should_stop
-
-    def stop(self):
-        self.__lock.acquire()
-        self.__stop = True
-        self.__lock.release()
+    def upload(self, numbered_file):
+        """
+        Uploads a file. Raises an exception if the upload fails.
 
-    def append_file(self, numbered_file: NumberedFile):
-        self.__queue.put(numbered_file)
+        :param numbered_file: a ``NumberedFile`` to upload whole, or a
+        ``FilePart`` to upload with a session.
+        """
+        self.__logger().debug('Ready to process file %i' % numbered_file.number)
+        if isinstance(numbered_file, FilePart):
+            self.__upload_part(numbered_file)
+        else:
+            self.__upload(self.__encrypt(numbered_file))
 
     def __logger(self) -> logging.Logger:
-        return logging.getLogger("%s.%i" % (__name__, self.__log_number))
+        return logging.getLogger(__name__)
 
     def __encrypt(self, numbered_file: NumberedFile):
         """
-        Encrypts the supplied file's data and prepends the encrypted symmetric
-        key to that data.
+        Encrypts the supplied file's data with the event key.
         """
-        if self.__public_key is None:
+        if self.__event_key is None:
             self.__logger().debug('Skipping encryption.')
             return numbered_file
 
         start_time = time.time()
-        fernet_key = Fernet.generate_key()
-        encrypted_fernet_key = self.__public_key.encrypt(fernet_key,
-                                                         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                                      algorithm=hashes.SHA256(),
-                                                                      label=None))
-        encoded_fernet_key = base64.b64encode(encrypted_fernet_key)
-        encrypted_bytes = Fernet(fernet_key).encrypt(numbered_file.bytes)
+        encrypted_bytes = encryption.encrypt(self.__event_key, numbered_file.bytes, pool=self.__encryption_pool)
         self.__logger().debug('Done encrypting. Took %.2f sec.' % (time.time() - start_time))
-        return numbered_file._replace(bytes=str(len(encoded_fernet_key)).encode() + b' ' + encoded_fernet_key + encrypted_bytes)
+        return numbered_file._replace(bytes=encrypted_bytes)
+
+    def __encrypt_part(self, part: FilePart):
+        """
+        Encrypts part of a file. The encrypted part may be shorter or longer
+        than the supplied part, since whole records are encrypted at a time.
+        """
+        if self.__event_key is None:
+            return part.bytes
+        if part.offset == 0:
+            self.__encryptors[part.number] = encryption.StreamEncryptor(self.__event_key, pool=self.__encryption_pool)
+        encryptor = self.__encryptors[part.number]
+        if not part.last:
+            return encryptor.update(part.bytes)
+        del self.__encryptors[part.number]
+        return encryptor.update(part.bytes) + encryptor.finalize()
+
+    def __upload_part(self, part: FilePart):
+        """
+        Uploads part of a file with an upload session. A file that fits in one
+        part is uploaded directly.
+
+        If a spool is supplied, each part is appended to the file's spool entry
+        before it is sent. Once a part fails, the file's session is abandoned
+        and its remaining parts are only journaled, so the spool uploads the
+        whole file when its last part arrives.
+        """
+        full_path = self.__path + str(part.number) + self.__extension
+        bts = self.__encrypt_part(part)
+        if part.offset == 0 and part.last:
+            self.__upload(NumberedFile(part.number, bts))
+            return
+        if self.__spool is not None:
+            if part.offset == 0:
+                self.__spool_entries[part.number] = self.__spool.begin(full_path)
+                if self.__spool.backlogged:
+                    # Uploads are already failing. Queue behind the older files.
+                    self.__sessions[part.number] = None
+            self.__spool.append(self.__spool_entries[part.number], bts)
+        try:
+            if self.__sessions.get(part.number, []) is not None:
+                self.__send_part(part, bts, full_path)
+        except Exception:
+            if self.__spool is not None:
+                self.__logger().warning('Upload of \"%s\" failed and will be retried from the spool.' % full_path)
+                self.__sessions[part.number] = None
+            raise
+        finally:
+            if self.__spool is not None and part.last:
+                entry = self.__spool_entries.pop(part.number)
+                self.__spool.finish(entry)
+                if self.__sessions.pop(part.number, []) is None:
+                    self.__spool.release(entry)
+                else:
+                    self.__spool.remove(entry)
+        if part.last:
+            self.__logger().debug('Done uploading \"%s\".' % full_path)
+
+    def __send_part(self, part: FilePart, bts, full_path):
+        """
+        Sends part of a file to its upload session, starting the session with
+        the file's first part and committing it with the last.
+        """
+        if part.offset == 0:
+            self.__logger().debug('Starting upload session for \"%s\"...' % full_path)
+            self.__sessions[part.number] = [self.__dbx.files_upload_session_start(bts).session_id, len(bts)]
+        else:
+            session = self.__sessions[part.number]
+            cursor = dropbox.files.UploadSessionCursor(session[0], session[1])
+            if part.last:
+                self.__dbx.files_upload_session_finish(bts, cursor, dropbox.files.CommitInfo(path=full_path))
+                del self.__sessions[part.number]
+            elif len(bts) > 0:
+                self.__dbx.files_upload_session_append_v2(bts, cursor)
+                session[1] += len(bts)
 
     def __upload(self, numbered_file: NumberedFile):
         full_path = self.__path + str(numbered_file.number) + self.__extension
-        self.__logger().debug('Uploading file \"%s\"...' % full_path)
-        self.__dbx.files_upload(numbered_file.bytes, full_path)
-        self.__logger().debug('Done uploading \"%s\".' % full_path)
-
-    def run(self):
-        self.__logger().debug('Uploader thread running.')
-        # Only stop if the queue is also empty.
-        while not self.__should_stop() or not self.__queue.empty():
-            try:
-                numbered_file = self.__queue.get(block=True, timeout=0.5)
-                self.__logger().debug('Ready to process file %i' % numbered_file.number)
-                self.__upload(self.__encrypt(numbered_file))
-            except queue.Empty:
-                pass
-            except Exception as e:
-                logging.getLogger(__name__).debug('Exception %s.' % e)
-        self.__logger().debug('Uploader thread stopped.')
+        if self.__spool is None:
+            self.__logger().debug('Uploading file \"%s\"...' % full_path)
+            self.__dbx.files_upload(numbered_file.bytes, full_path)
+            self.__logger().debug('Done uploading \"%s\".' % full_path)
+            return
+
+        entry = self.__spool.add(full_path, numbered_file.bytes)
+        if self.__spool.backlogged:
+            # Uploads are already failing. Queue behind the older files.
+            self.__logger().debug('Spooled file \"%s\" behind the backlog.' % full_path)
+            self.__spool.release(entry)
+            return
+        try:
+            self.__logger().debug('Uploading file \"%s\"...' % full_path)
+            self.__dbx.files_upload(numbered_file.bytes, full_path)
+            self.__spool.remove(entry)
+            self.__logger().debug('Done uploading \"%s\".' % full_path)
+        except Exception:
+            self.__logger().warning('Upload of \"%s\" failed and will be retried from the spool.' % full_path)
+            self.__spool.release(entry)
+            raise
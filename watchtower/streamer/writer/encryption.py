@@ -0,0 +1,137 @@
+"""This module implements Watchtower's encrypted file format.
+
+Each recording event generates one random AES-256 data key, which is encrypted
+once with the RSA public key. Every file uploaded for the event holds the
+wrapped key in its header, followed by the data split into fixed-size records
+that are each encrypted with AES-GCM. The output is raw binary, and a file can
+be encrypted and decrypted as a stream, one record at a time.
+
+File format:
+    magic            4 bytes   b'WTE1'
+    version          1 byte    1
+    algorithm        1 byte    1 (AES-256-GCM)
+    record_size      4 bytes   plaintext bytes per record
+    wrapped_key_len  2 bytes
+    wrapped_key      RSA-OAEP (SHA-256) encrypted data key
+    nonce_prefix     8 bytes   random per file
+    records          each record_size bytes of ciphertext plus a 16 byte tag.
+                     The final record may be shorter.
+
+Integers are big-endian. Record ``i`` uses the nonce ``nonce_prefix`` followed
+by ``i`` as a 4 byte integer. The header followed by one byte, 1 for the final
+record and 0 otherwise, is authenticated with each record. This detects
+records that were reordered or truncated.
+"""
+
+import os
+import struct
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b'WTE1'
+VERSION = 1
+ALGORITHM_AES_256_GCM = 1
+RECORD_SIZE = 64*1024  # 64 KB
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+HEADER_FORMAT = '>4sBBIH'
+OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                            algorithm=hashes.SHA256(),
+                            label=None)
+
+
+def encrypt_record(aesgcm, nonce_prefix, header, index, plaintext, final):
+    """
+    :return: record ``index`` of a file, encrypted and followed by its tag.
+    """
+    nonce = nonce_prefix + struct.pack('>I', index)
+    return aesgcm.encrypt(nonce, bytes(plaintext), header + (b'\x01' if final else b'\x00'))
+
+
+class EventKey:
+    """
+    A random data key for one recording event along with its RSA-wrapped
+    form. The RSA encryption happens once, when the key is created.
+    """
+
+    def __init__(self, public_key):
+        """
+        :param public_key: the RSA public key used to wrap the data key.
+        """
+        self.key = AESGCM.generate_key(bit_length=256)
+        self.wrapped_key = public_key.encrypt(self.key, OAEP_PADDING)
+
+
+class StreamEncryptor:
+    """
+    Encrypts one file as its bytes arrive. ``update()`` returns the header and
+    every complete record. ``finalize()`` returns the final record. A full
+    record is always held back until more data arrives, since the final record
+    must be marked when it is encrypted.
+
+    If an ``EncryptionPool`` is supplied, the complete records of each update
+    are encrypted by its processes.
+    """
+
+    def __init__(self, event_key, record_size=RECORD_SIZE, pool=None):
+        self.__key = event_key.key
+        self.__aesgcm = AESGCM(event_key.key)
+        self.__pool = pool
+        self.__record_size = record_size
+        self.__nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self.__header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, ALGORITHM_AES_256_GCM,
+                                    record_size, len(event_key.wrapped_key)) + \
+            event_key.wrapped_key + self.__nonce_prefix
+        self.__header_sent = False
+        self.__pending = bytearray()
+        self.__record_index = 0
+
+    def update(self, bts):
+        """
+        :return: the encrypted bytes that are ready.
+        """
+        self.__pending += bts
+        output = self.__take_header()
+        record_count = (len(self.__pending) - 1) // self.__record_size
+        if record_count <= 0:
+            return b''.join(output)
+        length = record_count * self.__record_size
+        with memoryview(self.__pending) as view:
+            if self.__pool is not None:
+                output.append(self.__pool.encrypt_records(self.__key, self.__nonce_prefix, self.__header,
+                                                          self.__record_index, self.__record_size, view[:length]))
+                self.__record_index += record_count
+            else:
+                for offset in range(0, length, self.__record_size):
+                    output.append(self.__encrypt_record(view[offset:offset+self.__record_size], final=False))
+        del self.__pending[:length]
+        return b''.join(output)
+
+    def finalize(self):
+        """
+        :return: the remaining encrypted bytes, ending with the final record.
+        """
+        output = self.__take_header()
+        output.append(self.__encrypt_record(self.__pending, final=True))
+        self.__pending = bytearray()
+        return b''.join(output)
+
+    def __take_header(self):
+        if self.__header_sent:
+            return []
+        self.__header_sent = True
+        return [self.__header]
+
+    def __encrypt_record(self, plaintext, final):
+        record = encrypt_record(self.__aesgcm, self.__nonce_prefix, self.__header, self.__record_index, plaintext, final)
+        self.__record_index += 1
+        return record
+
+
+def encrypt(event_key, bts, record_size=RECORD_SIZE, pool=None):
+    """
+    :return: a complete encrypted file holding ``bts``.
+    """
+    encryptor = StreamEncryptor(event_key, record_size, pool)
+    return encryptor.update(bts) + encryptor.finalize()
@@ -0,0 +1,203 @@
+import atexit
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from .encryption import TAG_SIZE, encrypt_record
+
+BLOCK_SIZE_STEP = 1024*1024  # Blocks are sized in whole MB so they can be reused.
+SHARED_MEMORY_DIR = '/dev/shm'  # A tmpfs, so blocks are never written to the SD card
+
+_attached_blocks = {}  # Shared memory blocks attached by a pool process, keyed by name
+
+
+class SharedBlock:
+    """
+    A block of memory shared with the pool's processes by name. The block is
+    a file in ``SHARED_MEMORY_DIR`` mapped with ``mmap``, which, unlike
+    ``multiprocessing.shared_memory``, is available on Python 3.7.
+    """
+
+    def __init__(self, name=None, size=0):
+        """
+        :param name: the name of an existing block to attach, or None to
+        create a block.
+        :param size: the size of a created block in bytes.
+        """
+        if name is None:
+            directory = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+            fd, name = tempfile.mkstemp(prefix='watchtower_encryption_', dir=directory)
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(name, os.O_RDWR)
+        try:
+            self.size = os.fstat(fd).st_size
+            self.__map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.name = name
+
+    def view(self):
+        """
+        :return: a memoryview of the block, which must be released before the
+        block is closed.
+        """
+        return memoryview(self.__map)
+
+    def close(self):
+        self.__map.close()
+
+    def unlink(self):
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass
+
+
+def _encrypt_slice(block_name, live_blocks, key, nonce_prefix, header, first_index, record_size, plaintext_range, ciphertext_offset):
+    """
+    Runs in a pool process. Encrypts the records of the shared memory block in
+    ``plaintext_range`` and writes them to the block at ``ciphertext_offset``.
+    Blocks the pool no longer uses, which aren't in ``live_blocks``, are
+    unmapped.
+    """
+    for name in [name for name in _attached_blocks if name not in live_blocks]:
+        _attached_blocks.pop(name).close()
+    if block_name not in _attached_blocks:
+        _attached_blocks[block_name] = SharedBlock(block_name)
+    aesgcm = AESGCM(key)
+    index = first_index
+    out = ciphertext_offset
+    with _attached_blocks[block_name].view() as buf:
+        for offset in range(plaintext_range[0], plaintext_range[1], record_size):
+            end = min(offset + record_size, plaintext_range[1])
+            record = encrypt_record(aesgcm, nonce_prefix, header, index, buf[offset:end], final=False)
+            buf[out:out+len(record)] = record
+            out += len(record)
+            index += 1
+
+
+def python_executable():
+    """
+    :return: the path of a Python interpreter of the running version.
+    """
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+    version = 'python%d.%d' % sys.version_info[:2]
+    for path in [os.path.join(sys.exec_prefix, 'bin', version), os.path.join(sys.exec_prefix, 'bin', 'python3')]:
+        if os.access(path, os.X_OK):
+            return path
+    return shutil.which(version) or shutil.which('python3') or sys.executable
+
+
+class EncryptionPool:
+    """
+    A pool of processes that encrypt records for ``StreamEncryptor``s, so
+    encryption doesn't compete with the camera and streaming threads for the
+    GIL. The records of each batch are split evenly across the processes.
+
+    A batch is passed to the processes in a shared memory block. The plaintext
+    is copied into the front of the block, and each process writes its records'
+    ciphertext to its own region after the plaintext. Only the block's name and
+    offsets are sent to the processes. Blocks are kept for later batches, and
+    the processes keep them attached until they are replaced, so a batch only
+    costs the copies in and out of the block.
+
+    The processes are started by a fork server, so they don't inherit the
+    threads and locks of the app. The fork server is a Python interpreter
+    found by ``python_executable()``, since under uWSGI ``sys.executable`` is
+    the uwsgi binary.
+    """
+
+    def __init__(self, processes=None):
+        """
+        :param processes: the number of processes. Defaults to the number of
+        CPUs.
+        """
+        self.__processes = processes or os.cpu_count() or 1
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        context.set_executable(python_executable())
+        self.__executor = ProcessPoolExecutor(max_workers=self.__processes, mp_context=context)
+        self.__lock = Lock()
+        self.__free_blocks = []  # One block is in use per encrypting thread.
+        self.__blocks = []
+        atexit.register(self.shutdown)
+        logging.getLogger(__name__).info('Encrypting with %d processes.' % self.__processes)
+
+    @property
+    def processes(self):
+        return self.__processes
+
+    def encrypt_records(self, key, nonce_prefix, header, first_index, record_size, plaintext):
+        """
+        Encrypts consecutive records, none of which is the final record of its
+        file.
+
+        :param key: the AES key.
+        :param nonce_prefix: the file's nonce prefix.
+        :param header: the file's header.
+        :param first_index: the index of the first record.
+        :param record_size: the plaintext bytes per record.
+        :param plaintext: a bytes-like object holding a whole number of records.
+        :return: the encrypted records.
+        """
+        record_count = len(plaintext) // record_size
+        ciphertext_size = len(plaintext) + record_count * TAG_SIZE
+        block, live_blocks = self.__acquire_block(len(plaintext) + ciphertext_size)
+        try:
+            with block.view() as buf:
+                buf[:len(plaintext)] = plaintext
+                futures = []
+                per_process = -(-record_count // self.__processes)  # Rounded up
+                for first in range(0, record_count, per_process):
+                    last = min(first + per_process, record_count)
+                    futures.append(self.__executor.submit(_encrypt_slice, block.name, live_blocks, key, nonce_prefix,
+                                                          header, first_index + first, record_size,
+                                                          (first * record_size, last * record_size),
+                                                          len(plaintext) + first * (record_size + TAG_SIZE)))
+                for future in futures:
+                    future.result()
+                return bytes(buf[len(plaintext):len(plaintext) + ciphertext_size])
+        finally:
+            with self.__lock:
+                self.__free_blocks.append(block)
+
+    def __acquire_block(self, size):
+        """
+        :return: a tuple of a free block of at least ``size`` bytes and the
+        names of every block in use.
+        """
+        with self.__lock:
+            for block in self.__free_blocks:
+                if block.size >= size:
+                    self.__free_blocks.remove(block)
+                    return block, self.__live_blocks()
+            if len(self.__free_blocks) > 0:
+                # Replace a block that is too small. The processes unmap it
+                # when they are next sent a batch.
+                self.__free(self.__free_blocks.pop())
+            block = SharedBlock(size=-(-size // BLOCK_SIZE_STEP) * BLOCK_SIZE_STEP)
+            self.__blocks.append(block)
+            return block, self.__live_blocks()
+
+    def __live_blocks(self):
+        return frozenset(block.name for block in self.__blocks)
+
+    def __free(self, block):
+        self.__blocks.remove(block)
+        block.close()
+        block.unlink()
+
+    def shutdown(self):
+        self.__executor.shutdown()
+        with self.__lock:
+            for block in list(self.__blocks):
+                self.__free(block)
+            self.__free_blocks = []
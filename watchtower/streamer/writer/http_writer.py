@@ -1,42 +1,331 @@
+import asyncio
 import base64
-from io import BytesIO
-from . import byte_writer
+import io
 import time
-from threading import Lock, Event
+from . import byte_writer
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+from PIL import Image
+from threading import Condition, Lock
 
 
 MULTIPART_BOUNDARY = 'FRAME'
+DEFAULT_QUEUE_DEPTH = 1
+ENCODED_CACHE_SIZE = 16  # Encoded frames held across all variants
+DEFAULT_QUALITY = 75  # JPEG quality used when only a width is requested
+Frame = namedtuple('Frame', 'sequence jpeg')
+Variant = namedtuple('Variant', 'width quality use_base64')
+SOURCE_VARIANT = Variant(None, None, False)
+
+
+def multipart_frame(bts):
+    """
+    Wraps the supplied bytes in a single HTTP multipart part.
+    """
+    header = '--' + MULTIPART_BOUNDARY + '\r\n' + \
+        'Content-Type: image/jpeg\r\n' + \
+        'Content-Length: ' + str(len(bts)) + '\r\n\r\n'
+    return header.encode() + bts + b'\r\n\r\n'
 
 
-class HTTPMultipartWriter(byte_writer.ByteWriter):
+class HTTPMultipartBroadcaster(byte_writer.ByteWriter):
     """
-    A class that writes all bytes has HTTP formatted mutipart data to a BytesIO
-    stream.
+    A class that shares each JPEG it receives with any number of subscribed
+    ``HTTPMultipartWriter`` instances. Every frame is tagged with an
+    increasing sequence number so subscribers can tell whether they have
+    already received a frame. Subscribers waiting on the broadcaster's
+    ``condition`` are only woken when a new frame is appended.
+
+    Frames are encoded once per ``Variant`` and held in an LRU cache keyed by
+    sequence number and variant, so every subscriber using the same variant
+    is handed the same bytes object. A variant can downscale or recompress
+    the source JPEG and can base64 encode it.
     """
-    def __init__(self, use_base64=False):
-        super(HTTPMultipartWriter, self).__init__(None)
-        self.__bytes = b''
-        self.__lock = Lock()
-        self.__write_event = Event()
-        self.__use_base64 = use_base64
+
+    def __init__(self, cache_size=ENCODED_CACHE_SIZE):
+        """
+        :param cache_size: the number of encoded frames to keep, across all
+        variants. This should be large enough to cover the frames queued by
+        subscribers.
+        """
+        super(HTTPMultipartBroadcaster, self).__init__(None)
+        self.__condition = Condition()
+        self.__sequence = 0
+        self.__frame = None
+        self.__writers = []
+        self.__cache_lock = Lock()
+        self.__cache = OrderedDict()
+        self.__pending = {}  # Futures of the values being produced, by cache key
+        self.__cache_size = cache_size
+
+    @property
+    def condition(self) -> Condition:
+        return self.__condition
+
+    @property
+    def sequence(self):
+        with self.__condition:
+            return self.__sequence
+
+    @property
+    def writers(self):
+        with self.__condition:
+            return list(self.__writers)
+
+    def subscribe(self, writer):
+        """
+        Adds a writer that will be offered every new frame. The most recent
+        frame is offered right away so the client doesn't wait for the next
+        one.
+        """
+        with self.__condition:
+            self.__writers.append(writer)
+            if self.__frame is not None:
+                writer.offer(self.__frame)
+                self.__condition.notify_all()
+
+    def unsubscribe(self, writer):
+        with self.__condition:
+            self.__writers.remove(writer)
+
+    def encoded(self, frame, variant=SOURCE_VARIANT):
+        """
+        Returns the HTTP multipart bytes for a frame. Each frame is only
+        transcoded and encoded once per variant while it remains in the cache.
+
+        :param frame: a ``Frame`` offered by this broadcaster.
+        :param variant: the ``Variant`` describing the output.
+        """
+        def encode():
+            jpeg = self.__transcoded(frame, variant.width, variant.quality)
+            if variant.use_base64:
+                jpeg = base64.standard_b64encode(jpeg)
+            return multipart_frame(jpeg)
+        return self.__cached((frame.sequence, variant), encode)
+
+    def __transcoded(self, frame, width, quality):
+        """
+        Returns the frame's JPEG resized to ``width`` and recompressed with
+        ``quality``. Results are cached, so variants that differ only in their
+        base64 encoding share one transcode.
+        """
+        if width is None and quality is None:
+            return frame.jpeg
+
+        def transcode():
+            image = Image.open(io.BytesIO(frame.jpeg))
+            if width is not None and width < image.width:
+                height = max(1, round(image.height * width / image.width))
+                image.draft('RGB', (width, height))  # Fast DCT downscaling.
+                image = image.resize((width, height))
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=quality or DEFAULT_QUALITY)
+            return output.getvalue()
+        return self.__cached((frame.sequence, Variant(width, quality, None)), transcode)
+
+    def __cached(self, key, produce):
+        """
+        Returns the cached value for ``key``, calling ``produce`` to create it
+        if it isn't cached. The cache lock is only held to look up and insert
+        values, so a slow transcode doesn't hold up readers of other frames
+        or variants. Threads that ask for a value that is being produced wait
+        for it rather than producing it again.
+        """
+        with self.__cache_lock:
+            value = self.__cache_get(key)
+            if value is not None:
+                return value
+            future = self.__pending.get(key)
+            if future is None:
+                future = self.__pending[key] = Future()
+                producer = True
+            else:
+                producer = False
+        if not producer:
+            return future.result()
+        try:
+            value = produce()
+        except BaseException as e:
+            with self.__cache_lock:
+                del self.__pending[key]
+            future.set_exception(e)
+            raise
+        with self.__cache_lock:
+            self.__cache_put(key, value)
+            del self.__pending[key]
+        future.set_result(value)
+        return value
+
+    def __cache_get(self, key):
+        value = self.__cache.get(key)
+        if value is not None:
+            self.__cache.move_to_end(key)
+        return value
+
+    def __cache_put(self, key, value):
+        self.__cache[key] = value
+        if len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last=False)
 
     def append_bytes(self, bts, close=False):
-        if self.__use_base64:
-            bts = base64.standard_b64encode(bts)
-        payload = '--' + MULTIPART_BOUNDARY + '\r\n' + \
-            'Content-Type: image/jpeg\r\n' + \
-            'Content-Length: ' + str(len(bts)) + '\r\n\r\n'
-        bts = payload.encode() + bts + b'\r\n\r\n'
-        with self.__lock:
-            self.__bytes += bts
-        self.__write_event.set()
+        if len(bts) == 0:
+            return
+        with self.__condition:
+            self.__sequence += 1
+            self.__frame = Frame(self.__sequence, bts)
+            for writer in self.__writers:
+                writer.offer(self.__frame)
+            self.__condition.notify_all()
+
+
+class HTTPMultipartWriter:
+    """
+    A subscriber of an ``HTTPMultipartBroadcaster``. Each instance represents
+    one client and holds a bounded queue of frames that have not yet been
+    read by that client. When the queue is full, the oldest frame is dropped
+    in favor of the newest one, so a slow client stays near real time and
+    uses a fixed amount of memory. A queue depth of 1 always serves the latest
+    frame.
+    """
+
+    def __init__(self, broadcaster, variant=SOURCE_VARIANT, rate=None, queue_depth=DEFAULT_QUEUE_DEPTH):
+        """
+        :param broadcaster: the ``HTTPMultipartBroadcaster`` to read from.
+        :param variant: the ``Variant`` of each frame sent to the client.
+        :param rate: the maximum frames per second returned to the client. If
+        None, every frame appended to the broadcaster is queued.
+        :param queue_depth: the maximum number of unread frames held for the
+        client.
+        """
+        self.__broadcaster = broadcaster
+        self.__variant = variant
+        self.__rate = rate
+        self.__interval = 1/rate if rate else 0
+        self.__queue = deque(maxlen=max(1, queue_depth))
+        self.__sequence = 0
+        self.__last_offer_time = 0
+        self.__dropped_frames = 0
+
+    @property
+    def variant(self):
+        return self.__variant
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    @property
+    def dropped_frames(self):
+        """
+        The number of frames that were queued for the client but replaced by
+        newer frames before the client read them.
+        """
+        with self.__broadcaster.condition:
+            return self.__dropped_frames
+
+    @property
+    def queued_frames(self):
+        with self.__broadcaster.condition:
+            return len(self.__queue)
 
+    def offer(self, frame):
+        """
+        Called by the broadcaster, with its ``condition`` held, for each new
+        frame. Frames that were already queued or that arrive before the
+        client's frame interval has passed are ignored.
+        :return: True if the frame was queued.
+        """
+        if frame.sequence <= self.__sequence:
+            return False
+        now = time.monotonic()
+        if now - self.__last_offer_time < self.__interval:
+            return False
+        self.__last_offer_time = now
+        if len(self.__queue) == self.__queue.maxlen:
+            self.__dropped_frames += 1
+        self.__queue.append(frame)
+        self.__sequence = frame.sequence
+        return True
+
+    def read(self):
+        """
+        Returns immediately with the queued frames.
+        :return: the HTTP multipart bytes for every queued frame, or None if
+        no frames are queued.
+        """
+        with self.__broadcaster.condition:
+            frames = self.__take_queue()
+        return self.__encode(frames)
 
     def blocking_read(self):
-        self.__write_event.wait()
-        with self.__lock:
-            payload = self.__bytes
-            self.__bytes = b''
-        self.__write_event.clear()
-        return payload
+        """
+        Blocks until at least one frame is queued for this client.
+        :return: the HTTP multipart bytes for every queued frame.
+        """
+        condition = self.__broadcaster.condition
+        with condition:
+            condition.wait_for(lambda: len(self.__queue) > 0)
+            frames = self.__take_queue()
+        return self.__encode(frames)
+
+    def __take_queue(self):
+        """
+        Empties the queue. Must be called with the broadcaster's ``condition``
+        held.
+        """
+        frames = list(self.__queue)
+        self.__queue.clear()
+        return frames
+
+    def __encode(self, frames):
+        """
+        Encodes frames outside of the broadcaster's ``condition`` so that a
+        transcode never delays new frames from being appended.
+        """
+        if len(frames) == 0:
+            return None
+        payloads = [self.__broadcaster.encoded(frame, self.__variant) for frame in frames]
+        return payloads[0] if len(payloads) == 1 else b''.join(payloads)
+
+
+class AsyncHTTPMultipartWriter(HTTPMultipartWriter):
+    """
+    An ``HTTPMultipartWriter`` for clients served by an asyncio event loop.
+    Instead of blocking a thread, a client awaits ``async_read()``. The
+    broadcaster's thread wakes the client through the event loop whenever a
+    frame is queued.
+    """
+
+    def __init__(self, broadcaster, loop, variant=SOURCE_VARIANT, rate=None, queue_depth=DEFAULT_QUEUE_DEPTH):
+        """
+        :param loop: the asyncio event loop that calls ``async_read()``.
+        """
+        super(AsyncHTTPMultipartWriter, self).__init__(broadcaster,
+                                                       variant=variant,
+                                                       rate=rate,
+                                                       queue_depth=queue_depth)
+        self.__loop = loop
+        self.__event = asyncio.Event()
+
+    def offer(self, frame):
+        queued = super(AsyncHTTPMultipartWriter, self).offer(frame)
+        if queued:
+            self.__loop.call_soon_threadsafe(self.__event.set)
+        return queued
 
+    async def async_read(self):
+        """
+        Waits, without blocking the event loop, until at least one frame is
+        queued for this client.
+        :return: the HTTP multipart bytes for every queued frame.
+        """
+        while True:
+            if self.variant == SOURCE_VARIANT:
+                payload = self.read()
+            else:
+                # Transcoding is too slow to run on the event loop.
+                payload = await self.__loop.run_in_executor(None, self.read)
+            if payload is not None:
+                return payload
+            await self.__event.wait()
+            self.__event.clear()
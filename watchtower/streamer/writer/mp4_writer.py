@@ -0,0 +1,229 @@
+import logging
+import struct
+from . import byte_writer
+
+START_CODE = b'\x00\x00\x01'
+TIMESCALE = 90000  # The standard clock rate for video
+TRACK_ID = 1
+
+# NAL unit types
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# Sample flags used in the trun box
+SYNC_SAMPLE_FLAGS = 0x02000000  # Depends on no other samples
+NON_SYNC_SAMPLE_FLAGS = 0x01010000  # Depends on other samples, not a sync sample
+
+HIGH_PROFILES = (100, 110, 122, 144)
+
+MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def box(box_type, *payloads):
+    """
+    :return: an ISO BMFF box containing the payloads.
+    """
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+def full_box(box_type, version, flags, *payloads):
+    """
+    :return: an ISO BMFF full box, which adds a version and flags to a box.
+    """
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def sample_entry(sps, pps, width, height):
+    """
+    :return: the avc1 box describing an H.264 track's samples.
+    """
+    avcc = box(b'avcC',
+               bytes([1, sps[1], sps[2], sps[3], 0xFF, 0xE1]),  # 4 byte NAL lengths, 1 SPS
+               struct.pack('>H', len(sps)), sps,
+               b'\x01', struct.pack('>H', len(pps)), pps,
+               # High profiles also describe the chroma format and bit depth.
+               # The camera's encoder always produces 8 bit 4:2:0 video.
+               b'\xfd\xf8\xf8\x00' if sps[1] in HIGH_PROFILES else b'')
+    return box(b'avc1',
+               bytes(6), struct.pack('>H', 1),  # Data reference index
+               bytes(16),
+               struct.pack('>HHIIIH', width, height, 0x00480000, 0x00480000, 0, 1),
+               bytes(32),  # Compressor name
+               struct.pack('>Hh', 0x0018, -1),
+               avcc)
+
+
+def init_segment(sps, pps, width, height):
+    """
+    :return: the ftyp and moov boxes that begin a fragmented MP4 with a single
+    H.264 track. The moov box holds no samples. They follow in fragments.
+    """
+    stbl = box(b'stbl',
+               full_box(b'stsd', 0, 0, struct.pack('>I', 1), sample_entry(sps, pps, width, height)),
+               full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+               full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+    minf = box(b'minf',
+               full_box(b'vmhd', 0, 1, bytes(8)),
+               box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+               stbl)
+    mdia = box(b'mdia',
+               full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0, 0x55C4, 0)),  # Language 'und'
+               full_box(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'vide'), bytes(12), b'VideoHandler\x00'),
+               minf)
+    trak = box(b'trak',
+               full_box(b'tkhd', 0, 0x3,  # Enabled and in the movie
+                        struct.pack('>IIIII', 0, 0, TRACK_ID, 0, 0), bytes(8),
+                        struct.pack('>hhhH', 0, 0, 0, 0), MATRIX,
+                        struct.pack('>II', width << 16, height << 16)),
+               mdia)
+    moov = box(b'moov',
+               full_box(b'mvhd', 0, 0,
+                        struct.pack('>IIIIIH', 0, 0, TIMESCALE, 0, 0x00010000, 0x0100), bytes(10),
+                        MATRIX, bytes(24), struct.pack('>I', TRACK_ID + 1)),
+               trak,
+               box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', TRACK_ID, 1, 0, 0, 0))))
+    ftyp = box(b'ftyp', b'iso5', struct.pack('>I', 512), b'iso5', b'iso6', b'avc1', b'mp41')
+    return ftyp + moov
+
+
+def fragment(sequence, decode_time, duration, samples):
+    """
+    :param sequence: the fragment's sequence number, starting at 1.
+    :param decode_time: the decode time of the first sample in ``TIMESCALE``
+    units.
+    :param duration: the duration of every sample in ``TIMESCALE`` units.
+    :param samples: a list of tuples of a sample's bytes and whether it is a
+    sync sample.
+    :return: the moof and mdat boxes of one fragment.
+    """
+    def moof(data_offset):
+        entries = b''.join(struct.pack('>III', duration, len(data), SYNC_SAMPLE_FLAGS if sync else NON_SYNC_SAMPLE_FLAGS)
+                           for data, sync in samples)
+        return box(b'moof',
+                   full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+                   box(b'traf',
+                       full_box(b'tfhd', 0, 0x020000, struct.pack('>I', TRACK_ID)),  # Offsets from the moof
+                       full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                       full_box(b'trun', 0, 0x000701,  # Data offset, durations, sizes and flags
+                                struct.pack('>Ii', len(samples), data_offset), entries)))
+    # The data offset points past the moof and the mdat header. The moof's
+    # size doesn't depend on the offset's value.
+    header = moof(len(moof(0)) + 8)
+    return header + box(b'mdat', *[data for data, sync in samples])
+
+
+class FragmentedMP4Writer(byte_writer.ByteWriter):
+    """
+    A ``ByteWriter`` that wraps the H.264 byte stream from the camera in a
+    fragmented MP4 and passes the MP4 to another ``ByteWriter``. The output
+    can be played as it is written, with no post-processing.
+
+    The stream is split into NAL units on their start codes and grouped into
+    access units, one per frame. Each group of pictures becomes one fragment,
+    written when the next IDR frame arrives. Frames before the first SPS, PPS
+    and IDR frame are dropped, since they can't be decoded. The byte stream
+    carries no timestamps, so frames are assumed to arrive at a constant
+    ``framerate``.
+    """
+
+    def __init__(self, writer, resolution, framerate):
+        """
+        :param writer: the ``ByteWriter`` receiving the MP4.
+        :param resolution: a tuple of the video's width and height.
+        :param framerate: the video's frames per second.
+        """
+        super(FragmentedMP4Writer, self).__init__(writer.full_path)
+        self.__writer = writer
+        self.__width, self.__height = resolution
+        self.__duration = int(round(TIMESCALE / float(framerate)))
+        self.__pending = bytearray()  # Bytes not yet split into NAL units
+        self.__search_pos = 0
+        self.__sps = None
+        self.__pps = None
+        self.__access_unit = []  # NAL units of the frame being assembled
+        self.__has_picture = False
+        self.__samples = []  # Frames of the fragment being assembled
+        self.__started = False
+        self.__sequence = 1
+        self.__decode_time = 0
+        self.logger = logging.getLogger(__name__)
+
+    def append_bytes(self, bts, close=False):
+        self.__pending += bts
+        output = []
+        start = self.__pending.find(START_CODE)
+        if start >= 0:
+            while True:
+                end = self.__pending.find(START_CODE, max(start + 3, self.__search_pos))
+                if end < 0:
+                    break
+                self.__handle_nal(bytes(self.__pending[start+3:end]).rstrip(b'\x00'), output)
+                start = end
+            del self.__pending[:start]
+            self.__search_pos = max(len(self.__pending) - 2, 0)  # A start code may span appends.
+        else:
+            del self.__pending[:-2]  # Not yet at the first start code.
+
+        if close:
+            if len(self.__pending) > 3:
+                self.__handle_nal(bytes(self.__pending[3:]).rstrip(b'\x00'), output)
+            self.__pending = bytearray()
+            self.__finish_access_unit(output)
+            self.__finish_fragment(output)
+        if len(output) > 0 or close:
+            self.__writer.append_bytes(b''.join(output), close)
+
+    def __handle_nal(self, nal, output):
+        if len(nal) == 0:
+            return
+        nal_type = nal[0] & 0x1F
+        if nal_type in (NAL_SPS, NAL_PPS, NAL_AUD, NAL_SEI):
+            # These precede the slices of the next frame.
+            self.__finish_access_unit(output)
+            if nal_type == NAL_SPS:
+                self.__sps = nal
+            elif nal_type == NAL_PPS:
+                self.__pps = nal
+            elif nal_type == NAL_SEI:
+                self.__access_unit.append(nal)
+        elif nal_type in (NAL_SLICE, NAL_IDR_SLICE):
+            # first_mb_in_slice is an Exp-Golomb number that is 0, encoded as a
+            # single set bit, only for the first slice of a frame.
+            if len(nal) > 1 and nal[1] & 0x80:
+                self.__finish_access_unit(output)
+            self.__access_unit.append(nal)
+            self.__has_picture = True
+        else:
+            self.__access_unit.append(nal)
+
+    def __finish_access_unit(self, output):
+        if not self.__has_picture:
+            return
+        nals = self.__access_unit
+        self.__access_unit = []
+        self.__has_picture = False
+        sync = any(nal[0] & 0x1F == NAL_IDR_SLICE for nal in nals)
+        if not self.__started:
+            if not sync or self.__sps is None or self.__pps is None:
+                return  # Can't be decoded
+            output.append(init_segment(self.__sps, self.__pps, self.__width, self.__height))
+            self.__started = True
+            self.logger.debug('Started MP4 for %s.' % self.full_path)
+        elif sync:
+            self.__finish_fragment(output)
+        self.__samples.append((b''.join(struct.pack('>I', len(nal)) + nal for nal in nals), sync))
+
+    def __finish_fragment(self, output):
+        if len(self.__samples) == 0:
+            return
+        output.append(fragment(self.__sequence, self.__decode_time, self.__duration, self.__samples))
+        self.__sequence += 1
+        self.__decode_time += len(self.__samples) * self.__duration
+        self.__samples = []
@@ -0,0 +1,176 @@
+import logging
+import time
+from . import byte_writer
+from collections import deque, namedtuple
+from enum import Enum
+from threading import Condition, Thread
+
+DEFAULT_MAX_QUEUED_BYTES = 32*1024*1024  # 32 MB
+QueuedChunk = namedtuple('QueuedChunk', 'bts close queued_at')
+
+
+class Backpressure(Enum):
+    """
+    What a ``QueuedWriter`` does when bytes arrive while its queue is full.
+    """
+    block = 'block'  # Wait for the writer to catch up. Nothing is lost.
+    drop_oldest = 'drop_oldest'  # Discard the oldest queued bytes.
+    disconnect = 'disconnect'  # Discard everything and close the writer.
+
+
+class QueuedWriter(byte_writer.ByteWriter):
+    """
+    A ``ByteWriter`` that feeds another ``ByteWriter`` from its own bounded
+    queue and worker thread. ``append_bytes`` only enqueues, so a writer that
+    is slow to accept bytes, like one uploading over the network, does not hold
+    up the ``StreamSaver`` or the other writers it feeds.
+
+    The queue is bounded by the number of bytes it holds. When it is full, the
+    ``Backpressure`` policy decides whether the caller waits, the oldest bytes
+    are dropped, or the writer is abandoned. The final call with ``close`` is
+    always delivered so the wrapped writer can finish its file.
+    """
+
+    def __init__(self, writer, max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES, backpressure=Backpressure.block):
+        """
+        :param writer: the ``ByteWriter`` to feed.
+        :param max_queued_bytes: the number of bytes that can wait in the queue
+        before the ``backpressure`` policy applies. A single append larger
+        than this is still accepted once the queue is empty.
+        :param backpressure: the ``Backpressure`` policy used when the queue
+        is full.
+        """
+        super(QueuedWriter, self).__init__(writer.full_path)
+        self.__writer = writer
+        self.__max_queued_bytes = max_queued_bytes
+        self.__backpressure = backpressure
+        self.__condition = Condition()
+        self.__queue = deque()
+        self.__queued_bytes = 0
+        self.__written_bytes = 0
+        self.__dropped_bytes = 0
+        self.__blocked_time = 0
+        self.__disconnected = False
+        self.__closed = False
+        self.__worker = None
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def writer(self) -> byte_writer.ByteWriter:
+        return self.__writer
+
+    @property
+    def backpressure(self) -> Backpressure:
+        return self.__backpressure
+
+    def append_bytes(self, bts, close=False):
+        """
+        Queues the bytes for the worker thread. Depending on the backpressure
+        policy, this may wait for room in the queue.
+        """
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = close
+            if self.__worker is None:
+                # Started on first use so writers that are never fed don't
+                # leave a thread waiting for bytes.
+                self.__worker = Thread(target=self.__drain, name='QueuedWriter %s' % self.full_path)
+                self.__worker.start()
+
+            if self.__disconnected:
+                self.__dropped_bytes += len(bts)
+                return
+
+            if not self.__has_room(len(bts)):
+                if self.__backpressure is Backpressure.block:
+                    start_time = time.monotonic()
+                    while not self.__has_room(len(bts)):
+                        self.__condition.wait()
+                    self.__blocked_time += time.monotonic() - start_time
+                elif self.__backpressure is Backpressure.drop_oldest:
+                    while not self.__has_room(len(bts)):
+                        self.__dropped_bytes += len(self.__pop().bts)
+                    self.logger.warning('Dropped queued bytes for %s. Total dropped: %d bytes.' % (self.full_path, self.__dropped_bytes))
+                else:
+                    self.__disconnect()
+                    self.__dropped_bytes += len(bts)
+                    return
+
+            self.__queue.append(QueuedChunk(bts, close, time.monotonic()))
+            self.__queued_bytes += len(bts)
+            self.__condition.notify_all()
+
+    def __has_room(self, length):
+        return len(self.__queue) == 0 or \
+            self.__queued_bytes + length <= self.__max_queued_bytes
+
+    def __pop(self):
+        chunk = self.__queue.popleft()
+        self.__queued_bytes -= len(chunk.bts)
+        return chunk
+
+    def __disconnect(self):
+        """
+        Discards the queue and stops accepting bytes. The writer is still sent
+        a final close so it can release its resources.
+        """
+        self.logger.error('%s fell too far behind and was disconnected.' % self.full_path)
+        while len(self.__queue) > 0:
+            self.__dropped_bytes += len(self.__pop().bts)
+        self.__disconnected = True
+        self.__queue.append(QueuedChunk(b'', True, time.monotonic()))
+        self.__condition.notify_all()
+
+    def __drain(self):
+        """
+        The worker loop. Passes queued bytes to the writer until the close
+        chunk is written.
+        """
+        close = False
+        while not close:
+            with self.__condition:
+                while len(self.__queue) == 0:
+                    self.__condition.wait()
+                chunk = self.__pop()
+                self.__condition.notify_all()  # Room was made for the producer.
+            close = chunk.close
+            try:
+                self.__writer.append_bytes(chunk.bts, close)
+                with self.__condition:
+                    self.__written_bytes += len(chunk.bts)
+            except Exception as e:
+                self.logger.exception('An exception occurred writing to %s: %s' % (self.full_path, e))
+                if not close:
+                    with self.__condition:
+                        self.__disconnect()
+        self.logger.debug('Worker for %s finished.' % self.full_path)
+
+    def join(self, timeout=None):
+        """
+        Waits for the worker to write the close chunk.
+        """
+        with self.__condition:
+            worker = self.__worker
+        if worker is not None:
+            worker.join(timeout)
+
+    def stats(self):
+        """
+        :return: a dictionary describing how far behind the writer is.
+        """
+        with self.__condition:
+            oldest = self.__queue[0].queued_at if len(self.__queue) > 0 else None
+            return dict(
+                path=self.full_path,
+                writer=type(self.__writer).__name__,
+                backpressure=self.__backpressure.value,
+                max_queued_bytes=self.__max_queued_bytes,
+                queued_bytes=self.__queued_bytes,
+                queued_chunks=len(self.__queue),
+                lag_seconds=(time.monotonic() - oldest) if oldest is not None else 0,
+                written_bytes=self.__written_bytes,
+                dropped_bytes=self.__dropped_bytes,
+                blocked_seconds=self.__blocked_time,
+                disconnected=self.__disconnected
+            )
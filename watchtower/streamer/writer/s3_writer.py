@@ -0,0 +1,333 @@
+import datetime
+import hashlib
+import hmac
+import logging
+import requests
+import time
+from . import byte_writer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from threading import BoundedSemaphore, Lock
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+DEFAULT_PART_SIZE = 8*1024*1024  # 8 MB
+MIN_PART_SIZE = 5*1024*1024  # S3's minimum for every part except the last
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_REGION = 'us-east-1'
+MAX_ATTEMPTS = 4
+RETRY_DELAY = 0.5  # In seconds, doubled after each failed attempt
+REQUEST_TIMEOUT = 60  # In seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+ALGORITHM = 'AWS4-HMAC-SHA256'
+
+
+class S3Error(Exception):
+    """
+    Raised when the object store rejects a request.
+    """
+
+    def __init__(self, status, code, message):
+        super(S3Error, self).__init__('%d %s: %s' % (status, code, message))
+        self.status = status
+        self.code = code
+
+
+def sign_request(method, url, headers, payload_hash, access_key, secret_key, region, now):
+    """
+    Adds the AWS Signature Version 4 headers for an S3 request to ``headers``.
+
+    :param url: the request's URL. Its path and query must already be
+    URI-encoded.
+    :param now: the request's time as a UTC ``datetime``.
+    """
+    parts = urlsplit(url)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = amz_date[:8]
+    headers['host'] = parts.netloc
+    headers['x-amz-content-sha256'] = payload_hash
+    headers['x-amz-date'] = amz_date
+    signed_headers = sorted(name.lower() for name in headers)
+    lowered = {name.lower(): str(value).strip() for name, value in headers.items()}
+    query = '&'.join(sorted(pair if '=' in pair else pair + '=' for pair in parts.query.split('&') if pair))
+    canonical_request = '\n'.join([method, parts.path or '/', query,
+                                   ''.join('%s:%s\n' % (name, lowered[name]) for name in signed_headers),
+                                   ';'.join(signed_headers), payload_hash])
+    scope = '%s/%s/s3/aws4_request' % (date, region)
+    string_to_sign = '\n'.join([ALGORITHM, amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+    key = ('AWS4' + secret_key).encode()
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers['Authorization'] = '%s Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+        ALGORITHM, access_key, scope, ';'.join(signed_headers), signature)
+
+
+def find_text(element, name):
+    """
+    :return: the text of the first element named ``name``, ignoring XML
+    namespaces, or None.
+    """
+    for child in element.iter():
+        if child.tag == name or child.tag.endswith('}' + name):
+            return child.text
+    return None
+
+
+class S3Client:
+    """
+    Sends requests for one bucket of an S3-compatible object store. Requests
+    share a pool of ``max_connections`` HTTP connections, and the parts of
+    multipart uploads are uploaded in parallel on as many threads. Failed
+    requests are retried with exponential backoff.
+
+    The bucket is addressed path-style, as ``{endpoint}/{bucket}/{key}``,
+    which every S3-compatible store supports.
+    """
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region=DEFAULT_REGION,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, retry_delay=RETRY_DELAY):
+        """
+        :param endpoint: the store's URL, like ``https://s3.us-east-1.amazonaws.com``.
+        :param bucket: the bucket's name.
+        :param access_key: the access key ID.
+        :param secret_key: the secret access key.
+        :param region: the region used to sign requests.
+        :param max_connections: the most requests sent at once.
+        :param retry_delay: the seconds to wait before the first retry of a
+        request.
+        """
+        self.__endpoint = endpoint.rstrip('/')
+        self.__bucket = bucket
+        self.__access_key = access_key
+        self.__secret_key = secret_key
+        self.__region = region
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        self.__executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='S3Upload')
+        self.__max_connections = max_connections
+        self.__retry_delay = retry_delay
+        self.__lock = Lock()
+        self.__uploaded_bytes = 0
+        self.__retried_requests = 0
+        self.__failed_requests = 0
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def max_connections(self):
+        return self.__max_connections
+
+    def submit(self, function, *args):
+        """
+        Runs a function on the client's upload threads.
+
+        :return: a ``Future`` holding the function's result.
+        """
+        return self.__executor.submit(function, *args)
+
+    def create_multipart_upload(self, key):
+        """
+        :return: the new upload's ID.
+        """
+        response = self.request('POST', key, 'uploads')
+        return find_text(ElementTree.fromstring(response.content), 'UploadId')
+
+    def upload_part(self, key, upload_id, number, bts):
+        """
+        :return: the part's ETag.
+        """
+        query = 'partNumber=%d&uploadId=%s' % (number, quote(upload_id, safe=''))
+        return self.request('PUT', key, query, bts).headers['ETag']
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        """
+        :param etags: the ETag of every part, in order.
+        """
+        body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number, etag)
+            for number, etag in enumerate(etags, 1))
+        self.request('POST', key, 'uploadId=%s' % quote(upload_id, safe=''), body.encode())
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request('DELETE', key, 'uploadId=%s' % quote(upload_id, safe=''))
+
+    def put_object(self, key, bts):
+        self.request('PUT', key, '', bts)
+
+    def request(self, method, key, query='', body=b''):
+        """
+        Sends a signed request, retrying it if the store is unavailable.
+
+        :return: the ``requests.Response``.
+        """
+        url = '%s/%s/%s' % (self.__endpoint, self.__bucket, quote(key, safe='/-_.~'))
+        if query:
+            url += '?' + query
+        payload_hash = hashlib.sha256(body).hexdigest()
+        delay = self.__retry_delay
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            headers = {}
+            sign_request(method, url, headers, payload_hash, self.__access_key, self.__secret_key,
+                         self.__region, datetime.datetime.now(datetime.timezone.utc))
+            try:
+                response = self.__session.request(method, url, data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+                error = self.__error(response)
+            except requests.exceptions.RequestException as e:
+                error = e
+                response = None
+            if error is None:
+                with self.__lock:
+                    self.__uploaded_bytes += len(body)
+                return response
+            retry = response is None or response.status_code in RETRY_STATUSES
+            if not retry or attempt == MAX_ATTEMPTS:
+                with self.__lock:
+                    self.__failed_requests += 1
+                raise error
+            with self.__lock:
+                self.__retried_requests += 1
+            self.logger.warning('Retrying %s of "%s" in %.1f seconds: %s' % (method, key, delay, error))
+            time.sleep(delay)
+            delay *= 2
+
+    def stats(self):
+        """
+        :return: a dictionary describing the client's requests.
+        """
+        with self.__lock:
+            return dict(
+                uploaded_bytes=self.__uploaded_bytes,
+                retried_requests=self.__retried_requests,
+                failed_requests=self.__failed_requests
+            )
+
+    def __error(self, response):
+        """
+        :return: an ``S3Error`` if the response describes an error, which
+        CompleteMultipartUpload may do after sending a 200 status.
+        """
+        if response.status_code < 300 and b'<Error>' not in response.content[:512]:
+            return None
+        try:
+            root = ElementTree.fromstring(response.content)
+            code, message = find_text(root, 'Code'), find_text(root, 'Message')
+        except ElementTree.ParseError:
+            code, message = 'Unknown', response.text[:200]
+        return S3Error(response.status_code, code, message)
+
+
+class S3Writer(byte_writer.ByteWriter):
+    """
+    A ``ByteWriter`` that uploads a file to an S3-compatible object store with
+    a multipart upload. Each ``part_size`` bytes appended become one part,
+    which is uploaded on the client's threads while more bytes arrive. At most
+    ``max_parts_in_flight`` parts are held in memory. Further appends wait
+    for a part to finish uploading. Files smaller than one part are uploaded
+    with a single request when the writer is closed.
+
+    If an upload fails after its retries, the multipart upload is aborted so
+    the store doesn't keep its parts, and the rest of the file is discarded.
+    """
+
+    def __init__(self, full_path, client, part_size=DEFAULT_PART_SIZE, max_parts_in_flight=None):
+        """
+        :param full_path: the object's key.
+        :param client: the ``S3Client`` used for the upload.
+        :param part_size: the bytes in each part but the last.
+        :param max_parts_in_flight: the most parts uploading at once. Defaults
+        to the client's number of connections.
+        """
+        super(S3Writer, self).__init__(full_path)
+        self.__key = full_path.lstrip('/')
+        self.__client = client
+        self.__part_size = part_size
+        self.__in_flight = BoundedSemaphore(max_parts_in_flight or client.max_connections)
+        self.__byte_pool = deque()  # memoryviews of the bytes not yet in a part
+        self.__pool_size = 0
+        self.__upload_id = None
+        self.__parts = []  # Futures holding each part's ETag
+        self.__failed = False
+        self.__finished = False
+        self.logger = logging.getLogger(__name__)
+
+    def append_bytes(self, bts, close=False):
+        if self.__failed:
+            return
+        try:
+            view = memoryview(bts).cast('B')
+            if not view.readonly:
+                view = memoryview(bytes(view))  # The caller may reuse its buffer.
+            if len(view) > 0:
+                self.__byte_pool.append(view)
+                self.__pool_size += len(view)
+            while self.__pool_size >= self.__part_size:
+                self.__upload_part(self.__take(self.__part_size))
+            if close:
+                self.__complete()
+        except Exception as e:
+            self.logger.error('Upload of "%s" failed: %s' % (self.__key, e))
+            self.__abort()
+        if close:
+            self.__finished = True
+
+    def is_finished_writing(self):
+        return self.__finished
+
+    def __take(self, length):
+        """
+        Removes ``length`` bytes from the front of the pool, like
+        ``DropboxWriter`` does, so each part is copied once when it is cut.
+
+        :return: the removed bytes.
+        """
+        parts = []
+        remaining = length
+        while remaining > 0:
+            view = self.__byte_pool.popleft()
+            if len(view) > remaining:
+                self.__byte_pool.appendleft(view[remaining:])
+                view = view[:remaining]
+            parts.append(view)
+            remaining -= len(view)
+        self.__pool_size -= length
+        return b''.join(parts)
+
+    def __upload_part(self, bts):
+        for future in self.__parts:
+            if future.done():
+                future.result()  # Raises the exception of a failed part.
+        if self.__upload_id is None:
+            self.__upload_id = self.__client.create_multipart_upload(self.__key)
+            self.logger.debug('Started multipart upload of "%s".' % self.__key)
+        self.__in_flight.acquire()
+        future = self.__client.submit(self.__client.upload_part, self.__key, self.__upload_id, len(self.__parts) + 1, bts)
+        future.add_done_callback(lambda f: self.__in_flight.release())
+        self.__parts.append(future)
+
+    def __complete(self):
+        if self.__upload_id is None:
+            self.__client.put_object(self.__key, self.__take(self.__pool_size))
+        else:
+            if self.__pool_size > 0:
+                self.__upload_part(self.__take(self.__pool_size))
+            etags = [future.result() for future in self.__parts]
+            self.__client.complete_multipart_upload(self.__key, self.__upload_id, etags)
+        self.logger.debug('Done uploading "%s".' % self.__key)
+
+    def __abort(self):
+        self.__failed = True
+        self.__byte_pool.clear()
+        self.__pool_size = 0
+        if self.__upload_id is None:
+            return
+        for future in self.__parts:
+            future.cancel()
+        # Parts still uploading would outlive the abort.
+        wait(self.__parts)
+        try:
+            self.__client.abort_multipart_upload(self.__key, self.__upload_id)
+        except Exception as e:
+            self.logger.error('Abort of "%s" failed: %s' % (self.__key, e))
@@ -0,0 +1,241 @@
+import dropbox
+import logging
+import time
+from collections import deque, namedtuple
+from threading import Condition, Lock
+from ...util.shutdown import TerminableThread
+
+DEFAULT_MIN_UPLOADS = 1
+DEFAULT_MAX_UPLOADS = 6
+DEFAULT_INITIAL_UPLOADS = 2
+ADJUST_INTERVAL = 10  # In seconds
+ERROR_RATE_THRESHOLD = 0.1  # The fraction of failed uploads that halves the concurrency
+MIN_THROUGHPUT_GAIN = 0.05  # The gain an extra upload must bring to be kept
+SHUTDOWN_POLL_INTERVAL = 1  # In seconds
+UploadTask = namedtuple('UploadTask', 'upload size done')
+
+
+class UploadScheduler:
+    """
+    Runs the uploads of every ``DropboxWriter`` on one set of threads, sharing
+    one pool of HTTP connections.
+
+    Uploads are grouped into lanes, usually one per file. A lane's uploads run
+    one at a time in the order they were submitted, so the parts of a file
+    sent with an upload session stay in order, while different lanes upload
+    in parallel.
+
+    The number of uploads running at once adapts to the network. Every
+    ``adjust_interval`` seconds in which uploads waited for a free slot, the
+    throughput is compared with the previous interval. One more concurrent
+    upload is allowed while that keeps raising the throughput, and the last
+    one is taken away when it doesn't. When many uploads fail, the
+    concurrency is halved.
+    """
+
+    __shared = None
+    __shared_lock = Lock()
+
+    @classmethod
+    def shared(cls, max_uploads=None):
+        """
+        :param max_uploads: the most uploads to run at once, used when the
+        shared scheduler is created. Defaults to ``DEFAULT_MAX_UPLOADS``.
+        :return: the scheduler shared by the whole process.
+        """
+        with cls.__shared_lock:
+            if cls.__shared is None:
+                cls.__shared = UploadScheduler(max_uploads=max_uploads or DEFAULT_MAX_UPLOADS)
+            elif max_uploads is not None and max_uploads != cls.__shared.max_uploads:
+                logging.getLogger(__name__).warning('The shared upload scheduler already runs %d uploads at most. '
+                                                    'Ignoring max_uploads of %d.'
+                                                    % (cls.__shared.max_uploads, max_uploads))
+            return cls.__shared
+
+    def __init__(self, min_uploads=DEFAULT_MIN_UPLOADS, max_uploads=DEFAULT_MAX_UPLOADS,
+                 initial_uploads=DEFAULT_INITIAL_UPLOADS, adjust_interval=ADJUST_INTERVAL):
+        """
+        :param min_uploads: the fewest uploads to run at once.
+        :param max_uploads: the most uploads to run at once. This many threads
+        and HTTP connections are used.
+        :param initial_uploads: the uploads to run at once before any
+        adjustment.
+        :param adjust_interval: the seconds between adjustments.
+        """
+        self.__min_uploads = min_uploads
+        self.__max_uploads = max_uploads
+        self.__concurrency = max(min_uploads, min(initial_uploads, max_uploads))
+        self.__adjust_interval = adjust_interval
+        self.__condition = Condition()
+        self.__lanes = {}  # Queued tasks keyed by lane
+        self.__ready = deque()  # Lanes with queued tasks that aren't uploading
+        self.__running = set()  # Lanes that are uploading
+        self.__workers = []
+        self.__session = None
+        self.__clients = {}
+        self.__last_change = 0
+        self.__last_throughput = None
+        self.__uploaded_bytes = 0
+        self.__failed_uploads = 0
+        self.__reset_window(time.monotonic())
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def max_uploads(self):
+        return self.__max_uploads
+
+    def client(self, token):
+        """
+        :return: a ``Dropbox`` client for the token that uses the scheduler's
+        HTTP connections.
+        """
+        with self.__condition:
+            if self.__session is None:
+                self.__session = dropbox.create_session(max_connections=self.__max_uploads)
+            if token not in self.__clients:
+                self.__clients[token] = dropbox.Dropbox(token, session=self.__session)
+            return self.__clients[token]
+
+    def submit(self, lane, upload, size, done=None):
+        """
+        Queues an upload.
+
+        :param lane: a hashable key. Uploads with the same key run in order.
+        :param upload: a function that uploads and raises an exception if the
+        upload fails.
+        :param size: the number of bytes uploaded.
+        :param done: an optional function called after the upload, whether or
+        not it succeeded.
+        """
+        with self.__condition:
+            if len(self.__workers) == 0:
+                for i in range(self.__max_uploads):
+                    worker = UploadWorker(self, i)
+                    self.__workers.append(worker)
+                    worker.start()
+            if lane not in self.__lanes:
+                self.__lanes[lane] = deque()
+                if lane not in self.__running:
+                    self.__ready.append(lane)
+            self.__lanes[lane].append(UploadTask(upload, size, done))
+            self.__condition.notify()
+
+    def stats(self):
+        """
+        :return: a dictionary describing the scheduler's uploads.
+        """
+        with self.__condition:
+            return dict(
+                concurrency=self.__concurrency,
+                running_uploads=len(self.__running),
+                queued_uploads=sum(len(tasks) for tasks in self.__lanes.values()),
+                throughput=self.__last_throughput,
+                uploaded_bytes=self.__uploaded_bytes,
+                failed_uploads=self.__failed_uploads
+            )
+
+    def next_task(self, timeout):
+        """
+        Waits for an upload that may start.
+
+        :return: a tuple of the task's lane and the task, or None if no upload
+        could start before the timeout.
+        """
+        with self.__condition:
+            if len(self.__ready) == 0 or len(self.__running) >= self.__concurrency:
+                if len(self.__ready) > 0:
+                    self.__window_waited = True
+                self.__condition.wait(timeout)
+                if len(self.__ready) == 0 or len(self.__running) >= self.__concurrency:
+                    return None
+            lane = self.__ready.popleft()
+            tasks = self.__lanes[lane]
+            task = tasks.popleft()
+            if len(tasks) == 0:
+                del self.__lanes[lane]
+            self.__running.add(lane)
+            return lane, task
+
+    def finish_task(self, lane, task, succeeded):
+        """
+        Records the result of an upload and releases its lane.
+        """
+        with self.__condition:
+            self.__running.discard(lane)
+            if lane in self.__lanes:
+                self.__ready.append(lane)
+            self.__window_uploads += 1
+            if succeeded:
+                self.__window_bytes += task.size
+                self.__uploaded_bytes += task.size
+            else:
+                self.__window_errors += 1
+                self.__failed_uploads += 1
+            self.__adjust(time.monotonic())
+            self.__condition.notify_all()
+
+    def __reset_window(self, now):
+        self.__window_start = now
+        self.__window_bytes = 0
+        self.__window_uploads = 0
+        self.__window_errors = 0
+        self.__window_waited = False
+
+    def __adjust(self, now):
+        elapsed = now - self.__window_start
+        if elapsed < self.__adjust_interval or elapsed <= 0:
+            return
+        throughput = self.__window_bytes / elapsed
+        previous = self.__concurrency
+        if self.__window_errors > self.__window_uploads * ERROR_RATE_THRESHOLD:
+            self.__concurrency = max(self.__min_uploads, self.__concurrency // 2)
+            self.__last_change = 0
+            self.__last_throughput = None
+        elif self.__window_waited:
+            if self.__last_throughput is None or throughput > self.__last_throughput * (1 + MIN_THROUGHPUT_GAIN):
+                if self.__concurrency < self.__max_uploads:
+                    self.__concurrency += 1
+                    self.__last_change = 1
+                else:
+                    self.__last_change = 0
+            elif self.__last_change > 0:
+                # The last upload added didn't help.
+                self.__concurrency = max(self.__min_uploads, self.__concurrency - 1)
+                self.__last_change = 0
+            self.__last_throughput = throughput
+        if self.__concurrency != previous:
+            self.logger.info('Uploading %d files at once. Throughput was %d KB/s with %d of %d uploads failing.'
+                             % (self.__concurrency, throughput / 1024, self.__window_errors, self.__window_uploads))
+        self.__reset_window(now)
+
+
+class UploadWorker(TerminableThread):
+    """
+    One of an ``UploadScheduler``'s upload threads.
+    """
+
+    def __init__(self, scheduler, number):
+        super(UploadWorker, self).__init__()
+        self.name = 'UploadWorker-%d' % number
+        self.daemon = True  # Files that aren't uploaded are retried from the spool.
+        self.__scheduler = scheduler
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        self.logger.debug('Upload thread running.')
+        while self.should_run:
+            next_task = self.__scheduler.next_task(SHUTDOWN_POLL_INTERVAL)
+            if next_task is None:
+                continue
+            lane, task = next_task
+            succeeded = False
+            try:
+                task.upload()
+                succeeded = True
+            except Exception as e:
+                self.logger.error('Upload failed: %s' % e)
+            finally:
+                self.__scheduler.finish_task(lane, task, succeeded)
+                if task.done is not None:
+                    task.done()
+        self.logger.debug('Thread stopped.')
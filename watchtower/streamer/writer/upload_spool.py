@@ -0,0 +1,222 @@
+import dropbox
+import logging
+import os
+import struct
+import time
+from threading import Condition
+from ...util.shutdown import TerminableThread
+
+ENTRY_EXTENSION = '.upload'
+TEMP_EXTENSION = '.tmp'
+BASE_RETRY_DELAY = 1  # In seconds
+MAX_RETRY_DELAY = 5*60  # 5 minutes
+SHUTDOWN_POLL_INTERVAL = 1  # In seconds
+
+
+class UploadSpool(TerminableThread):
+    """
+    A directory journaling the files waiting to be uploaded to Dropbox, and a
+    thread that retries failed uploads.
+
+    Uploaders ``add()`` each file before uploading it and ``remove()`` it once
+    the upload succeeds. A file whose upload fails is ``release()``d to this
+    thread, which retries the oldest released file with exponential backoff.
+    Only one file is read into memory at a time, so memory use stays flat no
+    matter how long the network is down. Files left in the directory when
+    Watchtower stops are uploaded when it starts again.
+
+    Files uploaded with upload sessions are journaled part by part with
+    ``begin()``, ``append()`` and ``finish()``, so they never have to be held
+    in memory whole.
+
+    Each entry holds the length of the Dropbox path, the path itself, and the
+    file's bytes, already encrypted if encryption is used.
+    """
+
+    def __init__(self, directory, dbx, base_delay=BASE_RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+        """
+        :param directory: the directory to journal files in. It is created if
+        it doesn't exist.
+        :param dbx: the ``Dropbox`` instance used for retries.
+        :param base_delay: the seconds to wait after the first failed retry.
+        The delay doubles with each consecutive failure.
+        :param max_delay: the most seconds to wait between retries.
+        """
+        super(UploadSpool, self).__init__()
+        self.name = 'UploadSpool'
+        self.daemon = True  # Pending files are resumed on the next start.
+        self.__directory = directory
+        self.__dbx = dbx
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+        self.__condition = Condition()
+        self.__claimed = set()  # Entries being uploaded by another thread
+        self.__entry_count = 0
+        self.__counter = 0
+        self.__delay = 0
+        self.__last_error = None
+        self.logger = logging.getLogger(__name__)
+
+        os.makedirs(directory, exist_ok=True)
+        self.__pending_bytes = 0
+        for name in os.listdir(directory):
+            entry = os.path.join(directory, name)
+            if name.endswith(TEMP_EXTENSION):
+                os.remove(entry)  # Never completely written
+            elif name.endswith(ENTRY_EXTENSION):
+                self.__entry_count += 1
+                self.__pending_bytes += os.path.getsize(entry)
+        if self.__entry_count > 0:
+            self.logger.info('Resuming %d pending uploads.' % self.__entry_count)
+
+    @property
+    def backlogged(self):
+        """
+        True while failed uploads are waiting to be retried. New files should
+        be added and released without an upload attempt until this clears.
+        """
+        with self.__condition:
+            return self.__delay > 0
+
+    def add(self, path, bts):
+        """
+        Durably journals a file. The entry is claimed by the caller until it is
+        removed or released.
+
+        :param path: the file's Dropbox path.
+        :param bts: the file's bytes.
+        :return: the entry.
+        """
+        entry = self.begin(path)
+        self.append(entry, bts)
+        self.finish(entry)
+        return entry
+
+    def begin(self, path):
+        """
+        Starts journaling a file whose bytes are appended as they are
+        uploaded. The entry is claimed by the caller, and isn't retried until
+        it is finished and released.
+
+        :param path: the file's Dropbox path.
+        :return: the entry.
+        """
+        with self.__condition:
+            self.__counter += 1
+            name = '%020d-%06d' % (time.time_ns(), self.__counter)
+            entry = os.path.join(self.__directory, name + ENTRY_EXTENSION)
+            # Claimed before it is in the directory, so the spool's thread
+            # never sees it unclaimed.
+            self.__claimed.add(entry)
+        encoded_path = path.encode()
+        with open(self.__temp_path(entry), 'wb') as f:
+            f.write(struct.pack('>H', len(encoded_path)))
+            f.write(encoded_path)
+        return entry
+
+    def append(self, entry, bts):
+        """
+        Appends bytes to an entry that isn't finished.
+        """
+        with open(self.__temp_path(entry), 'ab') as f:
+            f.write(bts)
+
+    def finish(self, entry):
+        """
+        Durably writes an entry once all of its file's bytes are appended. The
+        entry stays claimed by the caller.
+        """
+        temp_path = self.__temp_path(entry)
+        with open(temp_path, 'ab') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, entry)
+        with self.__condition:
+            self.__entry_count += 1
+            self.__pending_bytes += os.path.getsize(entry)
+
+    def remove(self, entry):
+        """
+        Deletes an entry after its file was uploaded.
+        """
+        size = os.path.getsize(entry)
+        os.remove(entry)
+        with self.__condition:
+            self.__claimed.discard(entry)
+            self.__entry_count -= 1
+            self.__pending_bytes -= size
+
+    def release(self, entry):
+        """
+        Hands an entry to the spool's thread to be retried.
+        """
+        with self.__condition:
+            self.__claimed.discard(entry)
+            self.__condition.notify_all()
+
+    def read(self, entry):
+        """
+        :return: a tuple of the entry's Dropbox path and bytes.
+        """
+        with open(entry, 'rb') as f:
+            path_length = struct.unpack('>H', f.read(2))[0]
+            path = f.read(path_length).decode()
+            return path, f.read()
+
+    def stats(self):
+        """
+        :return: a dictionary describing the upload backlog.
+        """
+        with self.__condition:
+            return dict(
+                pending_files=self.__entry_count,
+                pending_bytes=self.__pending_bytes,
+                retry_delay=self.__delay,
+                last_error=self.__last_error
+            )
+
+    def __temp_path(self, entry):
+        return entry[:-len(ENTRY_EXTENSION)] + TEMP_EXTENSION
+
+    def __next_entry(self):
+        """
+        Claims the oldest unclaimed entry.
+        """
+        names = sorted(name for name in os.listdir(self.__directory) if name.endswith(ENTRY_EXTENSION))
+        with self.__condition:
+            for name in names:
+                entry = os.path.join(self.__directory, name)
+                if entry not in self.__claimed:
+                    self.__claimed.add(entry)
+                    return entry
+        return None
+
+    def run(self):
+        self.logger.debug('Spool thread running.')
+        while self.should_run:
+            entry = self.__next_entry()
+            if entry is None:
+                with self.__condition:
+                    self.__condition.wait(SHUTDOWN_POLL_INTERVAL)
+                continue
+            try:
+                path, bts = self.read(entry)
+                # Overwrite in case an earlier attempt succeeded without a reply.
+                self.__dbx.files_upload(bts, path, mode=dropbox.files.WriteMode.overwrite)
+                self.remove(entry)
+                with self.__condition:
+                    if self.__delay > 0:
+                        self.logger.info('Uploads recovered.')
+                    self.__delay = 0
+                    self.__last_error = None
+                self.logger.debug('Uploaded spooled file "%s".' % path)
+            except Exception as e:
+                self.release(entry)
+                with self.__condition:
+                    self.__delay = min(self.__max_delay, self.__delay * 2 or self.__base_delay)
+                    self.__last_error = str(e)
+                    delay = self.__delay
+                self.logger.warning('Retrying upload in %d seconds: %s' % (delay, e))
+                retry_time = time.monotonic() + delay
+                while self.should_run and time.monotonic() < retry_time:
+                    time.sleep(min(SHUTDOWN_POLL_INTERVAL, retry_time - time.monotonic()))
+        self.logger.debug('Thread stopped.')
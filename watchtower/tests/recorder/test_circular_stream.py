@@ -0,0 +1,123 @@
+import picamera
+import pytest
+from watchtower.recorder.circular_stream import IndexedCircularIO
+
+BUFFER_SIZE = 1000
+FRAME_SIZE = 150
+CHUNK_SIZES = [100, 50]  # Each frame is written in two chunks, like the encoder does
+
+
+def test_index_matches_retained_bytes(camera, stream):
+    """
+    Ensures the frame index and ranges read from the buffer match the bytes
+    the buffer retains as frames are written past its size, including frames
+    whose first chunk is only partly evicted.
+    """
+    written = b''
+    for i in range(20):
+        written += write_frame(camera, stream, i)
+        retained = min(len(written), BUFFER_SIZE)
+        first_offset = len(written) - retained
+        assert(stream.buffered_bytes == retained)
+        assert(stream.frame_index.first_offset == first_offset)
+
+        # Only frames that start within the buffer are indexed.
+        expected = [n for n in range(i + 1) if n * FRAME_SIZE >= first_offset]
+        assert([frame.index for frame in stream.frame_index] == expected)
+        for frame in stream.frame_index:
+            assert(frame.start == frame.index * FRAME_SIZE and frame.end == frame.start + FRAME_SIZE)
+            assert(read(stream, frame.start, frame.end) == frame_bytes(frame.index))
+
+        assert(read(stream, first_offset, len(written)) == written[first_offset:])
+
+    # The first retained chunk was trimmed partway through frame 13, which is
+    # no longer indexed, though its tail can still be read.
+    assert(stream.frame_index.first_offset == 2000)
+    assert(stream.frame_index.first().index == 14)
+    assert(read(stream, 2000, 2100) == frame_bytes(13)[50:])
+
+def test_read_range_returns_views_of_chunks(camera, stream):
+    """
+    Ensures ranges are returned as views of the buffer's chunks, split at
+    chunk boundaries, that stay valid after their chunks are evicted.
+    """
+    for i in range(3):
+        write_frame(camera, stream, i)
+    position = stream.frame_index.position
+    views = stream.read_range(position(120), position(330))
+    assert(all(isinstance(view, memoryview) for view in views))
+    assert([len(view) for view in views] == [30, 100, 50, 30])
+
+    for i in range(3, 20):
+        write_frame(camera, stream, i)
+    assert(stream.frame_index.first_offset > 330)
+    assert(b''.join(views) == (frame_bytes(0) + frame_bytes(1) + frame_bytes(2))[120:330])
+
+def test_keyframes_are_sps_headers(camera, stream):
+    """
+    Ensures recordings start on the SPS header at or before the requested
+    time, or on the next one when that header was evicted.
+    """
+    for i in range(20):
+        write_frame(camera, stream, i)
+    assert(stream.frame_index.start_frame(timestamp(14)).index == 15)
+    assert(stream.frame_index.start_frame(timestamp(16)).index == 15)
+    assert(stream.frame_index.start_frame(timestamp(15)).index == 15)
+
+# ---- Helpers
+
+def frame_bytes(index):
+    return bytes([index]) * FRAME_SIZE
+
+def timestamp(index):
+    return index * 33333
+
+def write_frame(camera, stream, index):
+    """
+    Writes a frame to the stream the way the camera does, with the encoder's
+    frame only marked complete for the chunk that ends it. Every third frame
+    is an SPS header.
+    """
+    data = frame_bytes(index)
+    frame_type = picamera.PiVideoFrameType.sps_header if index % 3 == 0 else picamera.PiVideoFrameType.frame
+    offset = 0
+    for n, size in enumerate(CHUNK_SIZES):
+        camera._encoders[1].frame = picamera.PiVideoFrame(index=index,
+                                                          frame_type=frame_type,
+                                                          frame_size=offset + size,
+                                                          video_size=None,
+                                                          split_size=None,
+                                                          timestamp=timestamp(index),
+                                                          complete=n == len(CHUNK_SIZES) - 1)
+        stream.write(data[offset:offset+size])
+        offset += size
+    return data
+
+def read(stream, start, end):
+    position = stream.frame_index.position
+    return b''.join(stream.read_range(position(start), position(end)))
+
+# ---- Fixtures
+
+@pytest.fixture
+def camera():
+    return MockCamera()
+
+@pytest.fixture
+def stream(camera):
+    return IndexedCircularIO(camera, size=BUFFER_SIZE)
+
+# ---- Mock objects
+
+class MockCamera():
+    """
+    Mock object to be used in place of a PiCamera. ``PiCameraCircularIO``
+    reads the metadata of each chunk from the ``frame`` of the encoder on its
+    splitter port.
+    """
+    def __init__(self):
+        self._encoders = {1: MockEncoder()}
+
+class MockEncoder():
+    def __init__(self):
+        self.frame = None
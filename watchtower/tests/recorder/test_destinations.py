@@ -0,0 +1,60 @@
+import pytest
+from watchtower.recorder.destinations import (Destination, DiskDestination, S3Destination,
+                                              create_destination, register_destination)
+from watchtower.streamer.writer.upload_scheduler import UploadScheduler
+
+
+def test_destination_types(tmp_path):
+    """
+    Ensures each config entry creates the destination named by its type,
+    which defaults to the entry's name.
+    """
+    disk = create_destination('disk', {'size': [640, 480]}, str(tmp_path))
+    backup = create_destination('backup', dict(S3_OPTIONS, type='s3'), str(tmp_path))
+    assert(isinstance(disk, DiskDestination))
+    assert(isinstance(backup, S3Destination))
+    assert(repr(backup) == '<Destination.backup>')
+    with pytest.raises(ValueError):
+        create_destination('ftp', {}, str(tmp_path))
+
+def test_plugin_destinations(tmp_path):
+    """
+    Ensures destinations can be registered or imported by their module path.
+    """
+    register_destination('memory', MemoryDestination)
+    assert(isinstance(create_destination('memory', {}, str(tmp_path)), MemoryDestination))
+    imported = create_destination('other', {'type': __name__ + '.MemoryDestination'}, str(tmp_path))
+    assert(isinstance(imported, MemoryDestination))
+
+def test_dropbox_destinations_share_scheduler(tmp_path):
+    """
+    Ensures every Dropbox destination uploads on the process's scheduler, so
+    the upload limit applies to all of them, while each keeps its own spool.
+    """
+    dropbox = create_destination('dropbox', dict(DROPBOX_OPTIONS, spool=True), str(tmp_path))
+    backup = create_destination('backup', dict(DROPBOX_OPTIONS, type='dropbox', spool=True), str(tmp_path))
+    assert(dropbox.scheduler is UploadScheduler.shared())
+    assert(backup.scheduler is dropbox.scheduler)
+    assert(sorted(path.name for path in tmp_path.iterdir()) == ['upload_spool', 'upload_spool_backup'])
+
+# ---- Fixtures
+
+DROPBOX_OPTIONS = {
+    'token': 'token',
+    'file_chunk_kb': 512,
+    'size': [640, 480]
+}
+
+S3_OPTIONS = {
+    'endpoint': 'http://127.0.0.1:9000',
+    'bucket': 'recordings',
+    'access_key': 'access',
+    'secret_key': 'secret',
+    'size': [640, 480]
+}
+
+# ---- Mock objects
+
+class MemoryDestination(Destination):
+    def create_byte_writer(self, path, camera_name, video):
+        return None
@@ -0,0 +1,25 @@
+from watchtower.recorder import preroll
+
+
+def test_unbudgeted_buffers_hold_padding_at_encoder_bitrate():
+    """
+    Ensures that without a budget every buffer holds the whole padding at the
+    bitrate its encoder records at, including recorders that use the
+    encoder's default bitrate.
+    """
+    bitrates = [preroll.encoder_bitrate(None), preroll.encoder_bitrate(4000000)]
+    assert(bitrates == [preroll.DEFAULT_BITRATE, 4000000])
+    sizes = preroll.buffer_sizes(8, bitrates)
+    assert([size * 8 / bitrate for size, bitrate in zip(sizes, bitrates)] == [8, 8])
+
+def test_buffers_within_budget_hold_padding():
+    sizes = preroll.buffer_sizes(8, [16000000, 4000000], budget_bytes=100*1000*1000)
+    assert(sizes == [16000000, 4000000])
+
+def test_buffers_over_budget_split_by_bitrate():
+    """
+    Ensures buffers that would exceed the budget share it in proportion to
+    their bitrates.
+    """
+    sizes = preroll.buffer_sizes(8, [16000000, 4000000], budget_bytes=10*1000*1000)
+    assert(sizes == [8000000, 2000000])
@@ -0,0 +1,83 @@
+import pytest
+from watchtower.streamer.frame_index import FrameIndex
+
+
+def test_positions_follow_evictions(frame_index):
+    """
+    Ensures the buffer position of a frame moves back as older data is evicted
+    while its absolute offset stays the same.
+    """
+    frame = frame_index[4]
+    assert(frame_index.position(frame.start) == 400)
+
+    frame_index.trim(250)
+    assert(frame_index[1] == frame)
+    assert(frame_index.position(frame.start) == 150)
+
+def test_trim_drops_partially_evicted_frames(frame_index):
+    frame_index.trim(150)
+    assert(len(frame_index) == 8)
+    assert(frame_index.first().index == 2)
+    assert(frame_index.last().index == 9)
+
+def test_trim_everything(frame_index):
+    frame_index.trim(1000)
+    assert(len(frame_index) == 0)
+    assert(frame_index.first() is None)
+
+    frame_index.append(index=10, frame_type=None, timestamp=10, start=1000, end=1100)
+    assert(frame_index.first().index == 10)
+    assert(frame_index.position(1000) == 0)
+
+def test_start_frame_uses_timestamps(frame_index):
+    assert(frame_index.start_frame(timestamp=4).index == 4)
+    assert(frame_index.start_frame(timestamp=100).index == 9)
+    assert(frame_index.start_frame(timestamp=-1).index == 0)
+
+def test_start_frame_snaps_to_keyframe(keyframe_index):
+    """
+    Ensures the start frame moves back to the nearest keyframe, or forward to
+    the next keyframe if the nearest one was evicted.
+    """
+    assert(keyframe_index.start_frame(timestamp=5).index == 3)
+    assert(keyframe_index.start_frame(timestamp=6).index == 6)
+
+    keyframe_index.trim(400)
+    assert(keyframe_index.start_frame(timestamp=5).index == 6)
+    assert(keyframe_index.start_frame(timestamp=100).index == 9)
+
+def test_start_frame_without_keyframes():
+    frame_index = FrameIndex(keyframe_type=SPS_HEADER)
+    frame_index.append(index=0, frame_type=None, timestamp=None, start=0, end=100)
+    frame_index.append(index=1, frame_type=None, timestamp=1, start=100, end=200)
+    assert(frame_index.start_frame(timestamp=0).index == 0)
+    assert(frame_index.start_frame(timestamp=1).index == 1)
+
+    frame_index.trim(200)
+    assert(frame_index.start_frame(timestamp=1) is None)
+
+# ---- Fixtures
+
+SPS_HEADER = 'sps_header'
+
+
+@pytest.fixture
+def frame_index():
+    """
+    Ten 100 byte frames.
+    """
+    frame_index = FrameIndex()
+    for i in range(10):
+        frame_index.append(index=i, frame_type=None, timestamp=i, start=i*100, end=(i+1)*100)
+    return frame_index
+
+@pytest.fixture
+def keyframe_index():
+    """
+    Ten 100 byte frames with an SPS header every third frame.
+    """
+    frame_index = FrameIndex(keyframe_type=SPS_HEADER)
+    for i in range(10):
+        frame_type = SPS_HEADER if i % 3 == 0 else None
+        frame_index.append(index=i, frame_type=frame_type, timestamp=i, start=i*100, end=(i+1)*100)
+    return frame_index
@@ -0,0 +1,70 @@
+import os
+import pytest
+import socket
+import time
+from watchtower.streamer.live_server import LiveStreamServer
+from watchtower.streamer.mjpeg_streamer import MJPEGBroadcast
+from watchtower.streamer.writer import http_writer
+
+
+def test_streams_mjpeg_frames(server, broadcaster):
+    """
+    Ensures a client connected to the live server receives the multipart
+    response headers followed by framed JPEGs as they are appended.
+    """
+    client = connect(server, b'GET /api/internal_mjpeg?fps=30 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    broadcaster.append_bytes(b'frame 1')
+
+    response = read_until(client, http_writer.multipart_frame(b'frame 1'))
+    assert(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+    assert(b'multipart/x-mixed-replace; boundary=FRAME' in response)
+
+    time.sleep(0.1)
+    broadcaster.append_bytes(b'frame 2')
+    assert(read_until(client, http_writer.multipart_frame(b'frame 2')).endswith(http_writer.multipart_frame(b'frame 2')))
+    client.close()
+
+def test_unknown_path(server):
+    client = connect(server, b'GET /api/recordings HTTP/1.1\r\n\r\n')
+    assert(read_until(client, b'\r\n\r\n').startswith(b'HTTP/1.1 404 Not Found'))
+    client.close()
+
+def test_web_app_path_disabled(server):
+    client = connect(server, b'GET /mjpeg HTTP/1.1\r\n\r\n')
+    assert(read_until(client, b'\r\n\r\n').startswith(b'HTTP/1.1 404 Not Found'))
+    client.close()
+
+# ---- Helpers
+
+def connect(socket_path, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(2)
+    client.connect(socket_path)
+    client.sendall(request)
+    return client
+
+def read_until(client, suffix):
+    data = b''
+    while not data.endswith(suffix):
+        data += client.recv(1024)
+    return data
+
+# ---- Fixtures
+
+@pytest.fixture
+def broadcaster():
+    return http_writer.HTTPMultipartBroadcaster()
+
+@pytest.fixture
+def server(broadcaster, tmp_path):
+    socket_path = os.path.join(tmp_path, 'live.sock')
+    broadcast = MJPEGBroadcast(broadcaster, MockCamera(), max_rate=30)
+    LiveStreamServer(broadcast, socket_path=socket_path, default_rate=4).start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    return socket_path
+
+# ---- Mock objects
+
+class MockCamera:
+    should_monitor = True
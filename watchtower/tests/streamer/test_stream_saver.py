@@ -0,0 +1,23 @@
+import io
+import os
+import time
+from watchtower.streamer.stream_saver import StreamSaver
+from watchtower.streamer.writer.disk_writer import DiskWriter
+
+
+def test_finite_stream_closes_without_waiting(tmpdir):
+    """
+    Ensures a saver with ``stop_when_empty`` writes a finite stream and closes
+    its writers as soon as the stream is exhausted.
+    """
+    data = os.urandom(4096)
+    path = os.path.join(tmpdir, 'trigger.jpg')
+    saver = StreamSaver(io.BytesIO(data), [DiskWriter(path)], 'test saver', stop_when_empty=True)
+
+    start_time = time.monotonic()
+    saver.start()
+    saver.join(timeout=1)
+    assert(not saver.is_alive())
+    assert(time.monotonic() - start_time < 0.25)
+    with open(path, 'rb') as f:
+        assert(f.read() == data)
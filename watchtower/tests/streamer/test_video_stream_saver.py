@@ -3,7 +3,7 @@ import os
 import picamera
 import pytest
 import time
-from threading import Lock
+from threading import Condition, RLock, Thread
 
 simulated_time = time.time()
 
@@ -84,6 +84,34 @@ def test_read_from_middle(stream_saver):
     assert(bytes_read == stream_saver.stream.getvalue()[read_position:last_frame.position])
     assert(new_position == (read_position + len(bytes_read)))
 
+def test_wait_for_data_wakes_on_new_frame(stream_saver):
+    """
+    Ensures a saver that has read every frame waits until a new frame is
+    written, rather than polling.
+    """
+    stream = stream_saver.stream
+    stream_saver.read(stream_saver.start_pos())
+    waiter = Thread(target=stream_saver.wait_for_data, args=(0,))
+    waiter.start()
+    waiter.join(timeout=0.1)
+    assert(waiter.is_alive())
+
+    with stream.frame_condition:
+        stream.seek(0, io.SEEK_END)
+        stream.write(os.urandom(64))
+        stream.frames.append(MockFrame(position=1024, index=len(stream.frames), timestamp=0))
+        stream.frame_condition.notify_all()
+    waiter.join(timeout=1)
+    assert(not waiter.is_alive())
+
+def test_stop_wakes_waiting_saver(stream_saver):
+    stream_saver.read(stream_saver.start_pos())
+    waiter = Thread(target=stream_saver.wait_for_data, args=(0,))
+    waiter.start()
+    stream_saver.stop()
+    waiter.join(timeout=1)
+    assert(not waiter.is_alive())
+
 # ---- Fixtures
 
 @pytest.fixture
@@ -106,13 +134,35 @@ def disk_writer(tmpdir):
 
 class MockPiCameraCircularIO(io.BytesIO):
     """
-    This mock object is used because the real PiCameraCircularIO requires a
+    This mock object is used because the real IndexedCircularIO requires a
     camera instance.
     """
     def __init__(self, initial_bytes):
         self.frames = None
-        self.lock = Lock()
+        self.lock = RLock()
+        self.frame_condition = Condition(self.lock)
         super(MockPiCameraCircularIO, self).__init__(initial_bytes)
+
+    @property
+    def frame_index(self):
+        """
+        Builds a FrameIndex from the simulated frames, as IndexedCircularIO
+        would while the frames were written.
+        """
+        from watchtower.streamer.frame_index import FrameIndex
+        frame_index = FrameIndex()
+        total_size = len(self.getvalue())
+        for i, frame in enumerate(self.frames):
+            end = self.frames[i+1].position if i+1 < len(self.frames) else total_size
+            frame_index.append(index=frame.index,
+                               frame_type=None,
+                               timestamp=frame.timestamp,
+                               start=frame.position,
+                               end=end)
+        return frame_index
+
+    def read_range(self, start, end):
+        return [memoryview(self.getvalue())[start:end]]
     
     def simulate_frames(self, frame_count):
         """
@@ -1,6 +1,6 @@
 import os
 import pytest
-from watchtower.streamer.writer.disk_writer import DiskWriter
+from watchtower.streamer.writer.disk_writer import DiskWriter, FsyncPolicy
 
 TEST_FILE_NAME = 'test_file.bin'
 
@@ -25,6 +25,44 @@ def test_multiple_append_bytes(writer, random_data, tmp_path):
     assert(written_data == random_data)
     pass
 
+def test_buffered_writes_whole_blocks(random_data, tmp_path):
+    """
+    Ensures a buffered writer only writes full buffers until it is closed.
+    """
+    path = os.path.join(tmp_path, TEST_FILE_NAME)
+    writer = DiskWriter(path, buffer_size=4096)
+    writer.append_bytes(random_data[:3000])
+    assert(os.path.getsize(path) == 0)
+    writer.append_bytes(random_data[3000:5000])
+    assert(os.path.getsize(path) == 4096)
+
+    writer.append_bytes(random_data[5000:], close=True)
+    with open(path, 'rb') as f:
+        assert(f.read() == random_data)
+
+def test_preallocated_file_is_truncated(random_data, tmp_path):
+    path = os.path.join(tmp_path, TEST_FILE_NAME)
+    writer = DiskWriter(path,
+                        buffer_size=4096,
+                        preallocate_bytes=len(random_data)*4,
+                        fsync_policy=FsyncPolicy.close)
+    writer.append_bytes(memoryview(random_data), close=True)
+    with open(path, 'rb') as f:
+        assert(f.read() == random_data)
+
+def test_preallocation_keeps_file_size(random_data, tmp_path):
+    """
+    Ensures the space reserved for a recording isn't part of the file while it
+    is being written, so an unclosed recording doesn't end with zeros.
+    """
+    path = os.path.join(tmp_path, TEST_FILE_NAME)
+    writer = DiskWriter(path, preallocate_bytes=1024*1024)
+    writer.append_bytes(random_data)
+    assert(os.path.getsize(path) == len(random_data))
+    writer.append_bytes(random_data, close=True)
+    with open(path, 'rb') as f:
+        assert(f.read() == random_data * 2)
+
 # ---- Fixtures
 
 @pytest.fixture
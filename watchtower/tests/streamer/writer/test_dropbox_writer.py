@@ -40,6 +40,55 @@ def test_dropbox_writer_integration(writer, random_data, tmp_path):
     # Assert the writer's input data is identical to the data output to disk.
     assert(written_data == random_data)
 
+def test_dropbox_writer_encrypted_session_integration(tmp_path, random_data, installation_path):
+    """
+    Ensures encrypted files can be streamed with upload sessions and decrypted
+    by decrypt.py.
+    """
+    uploader = MockDropboxUploader()
+    writer = dropbox_writer.DropboxWriter(os.path.join(tmp_path, 'test_file.bin'),
+                                          dropbox_token="",
+                                          file_chunk_size=SESSION_FILE_CHUNK_SIZE,
+                                          public_pem_path=write_key_pair(tmp_path),
+                                          test_dropbox_uploader=uploader,
+                                          upload_sessions=True)
+    append_count = 20
+    amount_to_read = len(random_data)//append_count
+    for i in range(append_count):
+        writer.append_bytes(random_data[i*amount_to_read:(i+1) * amount_to_read], close=(i == append_count-1))
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+
+    files, written_data = decrypt_files(tmp_path, installation_path)
+    assert(len(files) == math.ceil(len(random_data)/SESSION_FILE_CHUNK_SIZE))
+    assert(written_data == random_data)
+    assert(len(uploader.sessions) == 0)
+
+def test_decrypt_reads_fernet_files(tmp_path, installation_path):
+    """
+    Ensures decrypt.py still reads files in the format written before the
+    record format was introduced.
+    """
+    import base64
+    from cryptography.fernet import Fernet
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization, hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    with open(write_key_pair(tmp_path), 'rb') as public_key_file:
+        public_key = serialization.load_pem_public_key(public_key_file.read(), backend=default_backend())
+    data = os.urandom(100000)
+    fernet_key = Fernet.generate_key()
+    encoded_key = base64.b64encode(public_key.encrypt(fernet_key,
+                                                      padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                                                   algorithm=hashes.SHA256(),
+                                                                   label=None)))
+    with open(os.path.join(tmp_path, 'test_file0.bin'), 'wb') as f:
+        f.write(str(len(encoded_key)).encode() + b' ' + encoded_key + Fernet(fernet_key).encrypt(data))
+
+    files, written_data = decrypt_files(tmp_path, installation_path)
+    assert(written_data == data)
+
 def test_dropbox_writer_encrypted_integration(encrypted_writer, random_data, tmp_path, installation_path):
     """
     Integration test to feed a DropboxWriter chunks of data, decrypt the
@@ -62,36 +111,112 @@ def test_dropbox_writer_encrypted_integration(encrypted_writer, random_data, tmp
     while not encrypted_writer.is_finished_writing():
         time.sleep(0.05)
 
-    # The installation path is one directory up from the package path.
+    files, written_data = decrypt_files(tmp_path, installation_path)
+
+    # Assert that multiple files were written to disk.
+    assert(len(files) > 1)
+    assert(len(files) == math.ceil(len(random_data)/dropbox_writer.DEFAULT_FILE_CHUNK_SIZE))
+    # Assert the writer's input data is identical to the data output to disk.
+    assert(written_data == random_data)
+    # Every file holds the same wrapped key, encrypted once for the recording.
+    header_size = 12 + 256  # The fixed header and a key wrapped with a 2048 bit RSA key
+    with open(os.path.join(tmp_path, 'test_file0.bin'), 'rb') as first, open(os.path.join(tmp_path, 'test_file1.bin'), 'rb') as second:
+        assert(first.read(header_size) == second.read(header_size))
+
+def test_dropbox_writer_session_integration(session_writer, session_uploader, random_data, tmp_path):
+    """
+    Ensures upload sessions stream each file before it is complete and the
+    committed files hold the input data.
+    """
+    uploader = session_uploader
+    append_count = 20
+    amount_to_read = len(random_data)//append_count
+    for i in range(append_count):
+        data = random_data[i*amount_to_read:(i+1) * amount_to_read]
+        session_writer.append_bytes(data, close=(i == append_count-1))
+        if i == 0:
+            # Bytes are sent before the first file chunk is complete.
+            deadline = time.time() + 1
+            while len(uploader.sessions) == 0 and time.time() < deadline:
+                time.sleep(0.01)
+            assert(len(uploader.sessions) == 1)
+
+    while not session_writer.is_finished_writing():
+        time.sleep(0.05)
+
+    files = os.listdir(tmp_path)
+    files.sort(key=lambda name: int(name.strip('test_file').strip('.bin')))
+    written_data = b''
+    for file_name in files:
+        with open(os.path.join(tmp_path, file_name), 'rb') as f:
+            written_data += f.read()
+    assert(len(files) == math.ceil(len(random_data)/SESSION_FILE_CHUNK_SIZE))
+    assert(written_data == random_data)
+    assert(len(uploader.sessions) == 0)
+
+# ---- Helpers
+
+def write_key_pair(tmp_path):
+    """
+    Generates a private and public key and saves these in the tmp_path.
+
+    :return: the path to the public key.
+    """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    private_pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                            format=serialization.PrivateFormat.PKCS8,
+                                            encryption_algorithm=serialization.NoEncryption())
+    with open(os.path.join(tmp_path, 'private.pem'), 'wb') as private_out:
+        private_out.write(private_pem)
+    public_pem = private_key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                                       format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    with open(os.path.join(tmp_path, 'public.pem'), 'wb') as public_out:
+        public_out.write(public_pem)
+    return os.path.join(tmp_path, 'public.pem')
+
+def decrypt_files(tmp_path, installation_path):
+    """
+    Decrypts each file output by a DropboxWriter using the decrypt.py program.
+
+    :return: a tuple of the sorted file names and their decrypted data.
+    """
     private_key_path = os.path.join(tmp_path, 'private.pem')
     decrypt_script_path = os.path.join(installation_path, 'ancillary', 'decryption', 'decrypt.py')
 
-    # Read in all of the data that the DropboxWriter output to disk. Ignore the .pem files.
+    # Ignore the .pem files.
     files = list(filter(lambda name: name.endswith('.bin'), os.listdir(tmp_path)))
     files.sort(key=lambda name: int(name.strip('test_file').strip('.bin'))) # Sort them into [test_file0.bin, test_file1.bin, ...]
-    written_data = ''.encode()
+    written_data = b''
     for file_name in files:
-        in_path = os.path.join(tmp_path, file_name)
         out_path = os.path.join(tmp_path, file_name + '.dec')
-
-        # Decrypt each file using the decrypt.py program.
-        subprocess.call(['python', decrypt_script_path,
-                        '-k', private_key_path,
-                        '-i', in_path,
-                        '-o', out_path])
-        
-        # Append the decrypted data.
+        subprocess.check_call(['python', decrypt_script_path,
+                               '-k', private_key_path,
+                               '-i', os.path.join(tmp_path, file_name),
+                               '-o', out_path])
         with open(out_path, 'rb') as f:
             written_data += f.read()
-            
-    # Assert that multiple files were written to disk.
-    assert(len(files) > 1)
-    assert(len(files) == math.ceil(len(random_data)/dropbox_writer.DEFAULT_FILE_CHUNK_SIZE))
-    # Assert the writer's input data is identical to the data output to disk.
-    assert(written_data == random_data)
+    return files, written_data
 
 # ---- Fixtures
 
+SESSION_FILE_CHUNK_SIZE = 4*1024*1024
+
+@pytest.fixture
+def session_uploader():
+    return MockDropboxUploader()
+
+@pytest.fixture
+def session_writer(tmp_path, session_uploader):
+    return dropbox_writer.DropboxWriter(os.path.join(tmp_path, 'test_file.bin'),
+                                        dropbox_token="",
+                                        file_chunk_size=SESSION_FILE_CHUNK_SIZE,
+                                        test_dropbox_uploader=session_uploader,
+                                        upload_sessions=True)
+
 @pytest.fixture
 def writer(tmp_path):
     return dropbox_writer.DropboxWriter(os.path.join(tmp_path, 'test_file.bin'),
@@ -100,26 +225,9 @@ def writer(tmp_path):
 
 @pytest.fixture
 def encrypted_writer(tmp_path):
-    from cryptography.hazmat.backends import default_backend
-    from cryptography.hazmat.primitives import serialization, hashes
-    from cryptography.hazmat.primitives.asymmetric import rsa, padding
-
-    # Generate a private and public key and save these in the tmp_path.
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
-    private_pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
-                                            format=serialization.PrivateFormat.PKCS8,
-                                            encryption_algorithm=serialization.NoEncryption())
-    with open(os.path.join(tmp_path, 'private.pem'), 'wb') as private_out:
-        private_out.write(private_pem)
-    public_key = private_key.public_key()
-    public_pem = public_key.public_bytes(encoding=serialization.Encoding.PEM,
-                                         format=serialization.PublicFormat.SubjectPublicKeyInfo)
-    with open(os.path.join(tmp_path, 'public.pem'), 'wb') as public_out:
-        public_out.write(public_pem)
-    
     return dropbox_writer.DropboxWriter(os.path.join(tmp_path, 'test_file.bin'),
                                         dropbox_token="",
-                                        public_pem_path=os.path.join(tmp_path, 'public.pem'),
+                                        public_pem_path=write_key_pair(tmp_path),
                                         test_dropbox_uploader=MockDropboxUploader())
 
 # ---- Mock objects
@@ -129,6 +237,26 @@ class MockDropboxUploader():
     Mock object to be used in place of a dropbox object. Each call to
     files_upload will create a new file on disk.
     """
+    def __init__(self):
+        self.sessions = {}
+
     def files_upload(self, bts, path):
         writer = DiskWriter(path)
         writer.append_bytes(bts, close=True)
+
+    def files_upload_session_start(self, bts):
+        session_id = str(len(self.sessions)) + str(time.time())
+        self.sessions[session_id] = bytes(bts)
+        return MockSessionStartResult(session_id)
+
+    def files_upload_session_append_v2(self, bts, cursor):
+        assert(len(self.sessions[cursor.session_id]) == cursor.offset)
+        self.sessions[cursor.session_id] += bts
+
+    def files_upload_session_finish(self, bts, cursor, commit):
+        self.files_upload_session_append_v2(bts, cursor)
+        self.files_upload(self.sessions.pop(cursor.session_id), commit.path)
+
+class MockSessionStartResult():
+    def __init__(self, session_id):
+        self.session_id = session_id
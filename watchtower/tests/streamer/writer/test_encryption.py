@@ -0,0 +1,55 @@
+import os
+import pytest
+import struct
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from watchtower.streamer.writer import encryption
+
+
+def test_streamed_encryption_round_trip(event_key):
+    """
+    Ensures a file encrypted in appends of any size decrypts to the input, and
+    only the records plus one header are added to its size.
+    """
+    data = os.urandom(10 * RECORD_SIZE + 123)
+    for append_size in [1000, RECORD_SIZE, 3 * RECORD_SIZE + 7]:
+        encryptor = encryption.StreamEncryptor(event_key, RECORD_SIZE)
+        encrypted = b''.join(encryptor.update(data[i:i+append_size]) for i in range(0, len(data), append_size))
+        encrypted += encryptor.finalize()
+        header_size = struct.calcsize(encryption.HEADER_FORMAT) + len(event_key.wrapped_key) + encryption.NONCE_PREFIX_SIZE
+        assert(len(encrypted) == header_size + len(data) + 11 * encryption.TAG_SIZE)
+        assert(decrypt(event_key, encrypted) == data)
+
+def test_truncated_file_is_rejected(event_key):
+    """
+    Ensures a file that lost its final record fails to decrypt.
+    """
+    encrypted = encryption.encrypt(event_key, os.urandom(3 * RECORD_SIZE), RECORD_SIZE)
+    with pytest.raises(InvalidTag):
+        decrypt(event_key, encrypted[:-(RECORD_SIZE + encryption.TAG_SIZE)])
+
+# ---- Helpers
+
+RECORD_SIZE = 1024
+
+def decrypt(event_key, encrypted):
+    header_size = struct.calcsize(encryption.HEADER_FORMAT)
+    magic, version, algorithm, record_size, key_size = struct.unpack(encryption.HEADER_FORMAT, encrypted[:header_size])
+    header_size += key_size + encryption.NONCE_PREFIX_SIZE
+    header = encrypted[:header_size]
+    nonce_prefix = header[-encryption.NONCE_PREFIX_SIZE:]
+    aesgcm = AESGCM(event_key.key)
+    records = [encrypted[i:i+record_size+encryption.TAG_SIZE]
+               for i in range(header_size, len(encrypted), record_size + encryption.TAG_SIZE)]
+    return b''.join(aesgcm.decrypt(nonce_prefix + struct.pack('>I', index), record,
+                                   header + (b'\x01' if index == len(records) - 1 else b'\x00'))
+                    for index, record in enumerate(records))
+
+# ---- Fixtures
+
+@pytest.fixture(scope='module')
+def event_key():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    return encryption.EventKey(private_key.public_key())
@@ -0,0 +1,83 @@
+import os
+import pytest
+import struct
+import sys
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from watchtower.streamer.writer import encryption, encryption_pool
+from watchtower.streamer.writer.encryption_pool import EncryptionPool, SharedBlock, python_executable
+
+
+def test_pooled_encryption_round_trip(pool, event_key):
+    """
+    Ensures records encrypted by the pool's processes decrypt to the input,
+    for batches that don't divide evenly across the processes.
+    """
+    for record_count in [1, 2, 5]:
+        data = os.urandom(record_count * RECORD_SIZE + 1)
+        encryptor = encryption.StreamEncryptor(event_key, RECORD_SIZE, pool)
+        encrypted = encryptor.update(data) + encryptor.finalize()
+        assert(decrypt(event_key, encrypted) == data)
+
+def test_replaced_blocks_are_unmapped(event_key):
+    """
+    Ensures a pool process unmaps the blocks the pool no longer uses when it
+    is sent a batch in another block.
+    """
+    small, large = SharedBlock(size=4096), SharedBlock(size=8192)
+    try:
+        for block in [small, large]:
+            with block.view() as buf:
+                buf[:RECORD_SIZE] = os.urandom(RECORD_SIZE)
+            encryption_pool._encrypt_slice(block.name, frozenset([block.name]), event_key.key, bytes(encryption.NONCE_PREFIX_SIZE), b'header',
+                                           0, RECORD_SIZE, (0, RECORD_SIZE), RECORD_SIZE)
+            assert(list(encryption_pool._attached_blocks) == [block.name])
+    finally:
+        for block in [small, large]:
+            block.close()
+            block.unlink()
+        for name in list(encryption_pool._attached_blocks):
+            encryption_pool._attached_blocks.pop(name).close()
+
+def test_python_executable(monkeypatch):
+    """
+    Ensures the pool's processes are started with a Python interpreter when
+    the app runs in another executable, like uWSGI.
+    """
+    interpreter = python_executable()
+    monkeypatch.setattr(sys, 'executable', '/usr/local/bin/uwsgi')
+    assert(os.path.basename(python_executable()).startswith('python'))
+    assert(os.access(python_executable(), os.X_OK))
+    monkeypatch.setattr(sys, 'executable', interpreter)
+    assert(python_executable() == interpreter)
+
+# ---- Helpers
+
+RECORD_SIZE = 1024
+
+def decrypt(event_key, encrypted):
+    header_size = struct.calcsize(encryption.HEADER_FORMAT)
+    key_size = struct.unpack(encryption.HEADER_FORMAT, encrypted[:header_size])[4]
+    header_size += key_size + encryption.NONCE_PREFIX_SIZE
+    header = encrypted[:header_size]
+    nonce_prefix = header[-encryption.NONCE_PREFIX_SIZE:]
+    aesgcm = AESGCM(event_key.key)
+    records = [encrypted[i:i+RECORD_SIZE+encryption.TAG_SIZE]
+               for i in range(header_size, len(encrypted), RECORD_SIZE + encryption.TAG_SIZE)]
+    return b''.join(aesgcm.decrypt(nonce_prefix + struct.pack('>I', index), record,
+                                   header + (b'\x01' if index == len(records) - 1 else b'\x00'))
+                    for index, record in enumerate(records))
+
+# ---- Fixtures
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = EncryptionPool(processes=2)
+    yield pool
+    pool.shutdown()
+
+@pytest.fixture(scope='module')
+def event_key():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    return encryption.EventKey(private_key.public_key())
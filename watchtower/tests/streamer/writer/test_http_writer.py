@@ -0,0 +1,178 @@
+import base64
+import io
+import pytest
+import time
+from PIL import Image
+from threading import Event, Thread
+from watchtower.streamer.writer import http_writer
+
+
+def test_subscribers_share_framed_bytes(broadcaster):
+    """
+    Ensures every subscriber receives the identical framed bytes object rather
+    than its own copy.
+    """
+    first = subscribe(broadcaster)
+    second = subscribe(broadcaster)
+    broadcaster.append_bytes(b'jpeg data')
+
+    first_payload = first.blocking_read()
+    second_payload = second.blocking_read()
+
+    assert(first_payload is second_payload)
+    assert(first_payload == http_writer.multipart_frame(b'jpeg data'))
+
+def test_new_subscriber_receives_current_frame(broadcaster):
+    broadcaster.append_bytes(b'jpeg data')
+    writer = subscribe(broadcaster)
+    assert(writer.blocking_read() == http_writer.multipart_frame(b'jpeg data'))
+
+def test_subscriber_waits_for_new_frame(broadcaster):
+    """
+    Ensures a subscriber that already read the latest frame blocks until a new
+    frame is appended.
+    """
+    writer = subscribe(broadcaster)
+    broadcaster.append_bytes(b'frame 1')
+    assert(writer.blocking_read() == http_writer.multipart_frame(b'frame 1'))
+
+    payloads = []
+    reader = Thread(target=lambda: payloads.append(writer.blocking_read()))
+    reader.start()
+    reader.join(timeout=0.1)
+    assert(reader.is_alive())
+
+    broadcaster.append_bytes(b'frame 2')
+    reader.join(timeout=1)
+    assert(payloads == [http_writer.multipart_frame(b'frame 2')])
+
+def test_rate_skips_frames_within_interval(broadcaster):
+    """
+    Ensures a rate limited subscriber ignores frames that arrive within its
+    frame interval.
+    """
+    writer = subscribe(broadcaster, rate=10)
+    broadcaster.append_bytes(b'frame 1')
+    broadcaster.append_bytes(b'frame 2')
+    assert(writer.blocking_read() == http_writer.multipart_frame(b'frame 1'))
+
+    time.sleep(0.15)
+    broadcaster.append_bytes(b'frame 3')
+    assert(writer.blocking_read() == http_writer.multipart_frame(b'frame 3'))
+    assert(writer.dropped_frames == 0)
+
+def test_slow_subscriber_drops_stale_frames(broadcaster):
+    """
+    Ensures a subscriber that doesn't keep up only holds the newest frames up
+    to its queue depth and counts the frames it dropped.
+    """
+    latest = subscribe(broadcaster)
+    queued = subscribe(broadcaster, queue_depth=2)
+    for i in range(5):
+        broadcaster.append_bytes(b'frame %d' % i)
+
+    assert(latest.queued_frames == 1)
+    assert(latest.dropped_frames == 4)
+    assert(latest.blocking_read() == http_writer.multipart_frame(b'frame 4'))
+
+    assert(queued.queued_frames == 2)
+    assert(queued.dropped_frames == 3)
+    assert(queued.blocking_read() == http_writer.multipart_frame(b'frame 3') + http_writer.multipart_frame(b'frame 4'))
+
+def test_base64_subscribers_share_encoded_bytes(broadcaster):
+    """
+    Ensures base64 subscribers share one encoding of each frame, separate from
+    the raw encoding.
+    """
+    first = subscribe(broadcaster, variant=BASE64_VARIANT)
+    second = subscribe(broadcaster, variant=BASE64_VARIANT)
+    raw = subscribe(broadcaster)
+    broadcaster.append_bytes(b'jpeg data')
+
+    expected = http_writer.multipart_frame(base64.standard_b64encode(b'jpeg data'))
+    first_payload = first.blocking_read()
+    assert(first_payload == expected)
+    assert(second.blocking_read() is first_payload)
+    assert(raw.blocking_read() == http_writer.multipart_frame(b'jpeg data'))
+
+def test_resized_variant_is_shared(broadcaster):
+    """
+    Ensures a downscaled variant is produced once and shared by every
+    subscriber requesting it, while other subscribers receive the source.
+    """
+    variant = http_writer.Variant(width=80, quality=50, use_base64=False)
+    first = subscribe(broadcaster, variant=variant)
+    second = subscribe(broadcaster, variant=variant)
+    source = subscribe(broadcaster)
+    jpeg = sample_jpeg((320, 240))
+    broadcaster.append_bytes(jpeg)
+
+    payload = first.blocking_read()
+    assert(second.blocking_read() is payload)
+    assert(source.blocking_read() == http_writer.multipart_frame(jpeg))
+
+    resized = Image.open(io.BytesIO(payload.split(b'\r\n\r\n')[1]))
+    assert(resized.size == (80, 60))
+
+def test_transcode_runs_outside_cache_lock(broadcaster, monkeypatch):
+    """
+    Ensures a slow transcode doesn't hold up subscribers of other variants,
+    and that subscribers waiting on the same transcode share its result
+    instead of transcoding again.
+    """
+    opened = Event()
+    release = Event()
+    image_open = Image.open
+    calls = []
+
+    def slow_open(*args, **kwargs):
+        calls.append(args)
+        opened.set()
+        release.wait(timeout=5)
+        return image_open(*args, **kwargs)
+    monkeypatch.setattr(http_writer.Image, 'open', slow_open)
+
+    variant = http_writer.Variant(width=80, quality=50, use_base64=False)
+    first = subscribe(broadcaster, variant=variant)
+    second = subscribe(broadcaster, variant=variant)
+    source = subscribe(broadcaster)
+    broadcaster.append_bytes(sample_jpeg((320, 240)))
+
+    payloads = []
+    readers = [Thread(target=lambda w=w: payloads.append(w.blocking_read())) for w in [first, second]]
+    readers[0].start()
+    assert(opened.wait(timeout=1))
+    readers[1].start()
+
+    source_payloads = []
+    source_reader = Thread(target=lambda: source_payloads.append(source.blocking_read()))
+    source_reader.start()
+    source_reader.join(timeout=1)
+    assert(not source_reader.is_alive())
+    assert(len(source_payloads) == 1)
+
+    release.set()
+    for reader in readers:
+        reader.join(timeout=1)
+    assert(len(calls) == 1)
+    assert(len(payloads) == 2 and payloads[0] is payloads[1])
+
+# ---- Helpers
+
+BASE64_VARIANT = http_writer.Variant(width=None, quality=None, use_base64=True)
+
+def sample_jpeg(size):
+    output = io.BytesIO()
+    Image.new('RGB', size, color='blue').save(output, format='JPEG')
+    return output.getvalue()
+
+def subscribe(broadcaster, **kwargs):
+    writer = http_writer.HTTPMultipartWriter(broadcaster, **kwargs)
+    broadcaster.subscribe(writer)
+    return writer
+
+# ---- Fixtures
+
+@pytest.fixture
+def broadcaster():
+    return http_writer.HTTPMultipartBroadcaster()
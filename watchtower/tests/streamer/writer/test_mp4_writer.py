@@ -0,0 +1,101 @@
+import pytest
+import struct
+from watchtower.streamer.writer.byte_writer import ByteWriter
+from watchtower.streamer.writer.mp4_writer import FragmentedMP4Writer, TIMESCALE
+
+SPS = b'\x67\x64\x00\x28\xac\x2b\x40'
+PPS = b'\x68\xee\x3c\x80'
+IDR = b'\x65\x88\x84\x00\x21'
+P_FRAME = b'\x41\x9a\x02\x1c\x33'
+
+
+def test_fragment_per_gop(mp4_writer, memory_writer):
+    """
+    Ensures each group of pictures becomes one fragment holding one sample
+    per frame, with the sample data in AVC format.
+    """
+    stream = gop(3) + gop(2) + gop(4)
+    for i in range(0, len(stream), 7):  # Split NAL units across appends
+        mp4_writer.append_bytes(stream[i:i+7])
+    mp4_writer.append_bytes(b'', close=True)
+
+    assert(memory_writer.closed)
+    boxes = parse_boxes(memory_writer.data)
+    assert([box_type for box_type, _ in boxes] == [b'ftyp', b'moov'] + [b'moof', b'mdat']*3)
+    assert(b'avcC' in boxes[1][1])
+
+    decode_time = 0
+    for (_, moof), (_, mdat), frame_count in zip(boxes[2::2], boxes[3::2], [3, 2, 4]):
+        count, data_offset, samples, base_time = parse_moof(moof)
+        assert(count == frame_count)
+        assert(base_time == decode_time)
+        assert(data_offset == len(moof) + 16)  # Past the moof and mdat headers
+        assert(sum(size for _, size, _ in samples) == len(mdat))
+        assert(samples[0][2] == 0x02000000)  # Only the IDR frame is a sync sample
+        assert(all(flags == 0x01010000 for _, _, flags in samples[1:]))
+        assert(mdat[:4 + len(IDR)] == struct.pack('>I', len(IDR)) + IDR)
+        decode_time += frame_count * TIMESCALE // 30
+
+def test_frames_before_keyframe_are_dropped(mp4_writer, memory_writer):
+    mp4_writer.append_bytes(nal(P_FRAME) + nal(P_FRAME) + gop(2), close=True)
+    boxes = parse_boxes(memory_writer.data)
+    assert([box_type for box_type, _ in boxes] == [b'ftyp', b'moov', b'moof', b'mdat'])
+    assert(parse_moof(boxes[2][1])[0] == 2)
+
+def test_no_output_without_keyframe(mp4_writer, memory_writer):
+    mp4_writer.append_bytes(nal(P_FRAME), close=True)
+    assert(memory_writer.data == b'')
+    assert(memory_writer.closed)
+
+# ---- Helpers
+
+def nal(data):
+    return b'\x00\x00\x00\x01' + data
+
+def gop(frame_count):
+    return nal(SPS) + nal(PPS) + nal(IDR) + nal(P_FRAME) * (frame_count - 1)
+
+def parse_boxes(data):
+    boxes = []
+    position = 0
+    while position < len(data):
+        size, box_type = struct.unpack('>I4s', data[position:position+8])
+        boxes.append((box_type, data[position+8:position+size]))
+        position += size
+    return boxes
+
+def parse_moof(moof):
+    """
+    :return: the sample count, data offset, sample entries and base decode
+    time of a moof box's payload.
+    """
+    traf = dict(parse_boxes(moof))[b'traf']
+    traf_boxes = dict(parse_boxes(traf))
+    base_time = struct.unpack('>Q', traf_boxes[b'tfdt'][4:12])[0]
+    trun = traf_boxes[b'trun']
+    count, data_offset = struct.unpack('>Ii', trun[4:12])
+    samples = [struct.unpack('>III', trun[12+i*12:24+i*12]) for i in range(count)]
+    return count, data_offset, samples, base_time
+
+# ---- Fixtures
+
+@pytest.fixture
+def memory_writer():
+    return MockByteWriter()
+
+@pytest.fixture
+def mp4_writer(memory_writer):
+    return FragmentedMP4Writer(memory_writer, resolution=(640, 480), framerate=30)
+
+# ---- Mock objects
+
+class MockByteWriter(ByteWriter):
+
+    def __init__(self):
+        super(MockByteWriter, self).__init__('mock')
+        self.data = b''
+        self.closed = False
+
+    def append_bytes(self, bts, close=False):
+        self.data += bts
+        self.closed = close
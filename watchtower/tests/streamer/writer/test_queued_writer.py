@@ -0,0 +1,113 @@
+import pytest
+import time
+from threading import Event, Thread
+from watchtower.streamer.writer.byte_writer import ByteWriter
+from watchtower.streamer.writer.queued_writer import QueuedWriter, Backpressure
+
+
+def test_bytes_are_written_in_order(memory_writer):
+    writer = QueuedWriter(memory_writer)
+    for i in range(5):
+        writer.append_bytes(b'%d' % i)
+    writer.append_bytes(b'end', close=True)
+    writer.join(timeout=1)
+
+    assert(memory_writer.data == b'01234end')
+    assert(memory_writer.closed)
+    assert(writer.stats()['written_bytes'] == 8)
+
+def test_slow_writer_does_not_block_caller(memory_writer):
+    """
+    Ensures appending returns immediately while the wrapped writer is stalled,
+    and the queued bytes are reported as lag.
+    """
+    memory_writer.gate.clear()
+    writer = QueuedWriter(memory_writer, max_queued_bytes=100)
+    start_time = time.monotonic()
+    for _ in range(5):
+        writer.append_bytes(b'0123456789')
+    assert(time.monotonic() - start_time < 0.1)
+
+    time.sleep(0.05)
+    stats = writer.stats()
+    assert(stats['queued_bytes'] >= 40)
+    assert(stats['lag_seconds'] > 0)
+
+    memory_writer.gate.set()
+    writer.append_bytes(b'', close=True)
+    writer.join(timeout=1)
+    assert(memory_writer.data == b'0123456789'*5)
+
+def test_block_waits_for_room(memory_writer):
+    memory_writer.gate.clear()
+    writer = QueuedWriter(memory_writer, max_queued_bytes=10, backpressure=Backpressure.block)
+    writer.append_bytes(b'0123456789')  # Taken by the stalled worker
+    writer.append_bytes(b'0123456789')  # Fills the queue
+
+    producer = Thread(target=writer.append_bytes, args=(b'abc', True))
+    producer.start()
+    producer.join(timeout=0.1)
+    assert(producer.is_alive())
+
+    memory_writer.gate.set()
+    producer.join(timeout=1)
+    writer.join(timeout=1)
+    assert(memory_writer.data == b'01234567890123456789abc')
+    assert(writer.stats()['blocked_seconds'] > 0)
+
+def test_drop_oldest_keeps_newest_bytes(memory_writer):
+    memory_writer.gate.clear()
+    writer = QueuedWriter(memory_writer, max_queued_bytes=10, backpressure=Backpressure.drop_oldest)
+    writer.append_bytes(b'first')  # Taken by the stalled worker
+    time.sleep(0.05)
+    for chunk in [b'aaaaa', b'bbbbb', b'ccccc']:
+        writer.append_bytes(chunk)
+    writer.append_bytes(b'', close=True)
+
+    memory_writer.gate.set()
+    writer.join(timeout=1)
+    assert(memory_writer.data == b'firstbbbbbccccc')
+    assert(writer.stats()['dropped_bytes'] == 5)
+
+def test_disconnect_closes_writer(memory_writer):
+    memory_writer.gate.clear()
+    writer = QueuedWriter(memory_writer, max_queued_bytes=10, backpressure=Backpressure.disconnect)
+    writer.append_bytes(b'first')
+    time.sleep(0.05)
+    writer.append_bytes(b'0123456789')
+    writer.append_bytes(b'overflow')
+    writer.append_bytes(b'ignored', close=True)
+
+    memory_writer.gate.set()
+    writer.join(timeout=1)
+    stats = writer.stats()
+    assert(stats['disconnected'])
+    assert(stats['dropped_bytes'] == 25)
+    assert(memory_writer.data == b'first')
+    assert(memory_writer.closed)
+
+# ---- Fixtures
+
+@pytest.fixture
+def memory_writer():
+    return MockByteWriter()
+
+# ---- Mock objects
+
+class MockByteWriter(ByteWriter):
+    """
+    Collects appended bytes. Writing waits while ``gate`` is cleared, to
+    simulate a slow destination.
+    """
+
+    def __init__(self):
+        super(MockByteWriter, self).__init__('mock')
+        self.data = b''
+        self.closed = False
+        self.gate = Event()
+        self.gate.set()
+
+    def append_bytes(self, bts, close=False):
+        self.gate.wait()
+        self.data += bts
+        self.closed = close
@@ -0,0 +1,68 @@
+import os
+import pytest
+from watchtower.streamer.writer.s3_writer import S3Client, S3Writer
+from watchtower.util.local_s3 import LocalS3Server
+
+
+def test_multipart_upload(server, client):
+    """
+    Ensures a file larger than a part is uploaded in parts and assembled in
+    order.
+    """
+    data = os.urandom(10 * PART_SIZE + 123)
+    write(S3Writer('/camera/day/video.h264', client, part_size=PART_SIZE), data)
+    assert(server.objects == {'camera/day/video.h264': data})
+    assert(server.operations.count('UploadPart') == 11)
+    assert(server.uploads == {})
+
+def test_small_file_is_put(server, client):
+    """
+    Ensures a file smaller than a part is uploaded with a single request.
+    """
+    write(S3Writer('/camera/day/trigger.jpg', client, part_size=PART_SIZE), b'jpeg data')
+    assert(server.objects == {'camera/day/trigger.jpg': b'jpeg data'})
+    assert(server.operations == ['PutObject'])
+
+def test_failed_parts_are_retried(server, client):
+    """
+    Ensures parts that fail with a server error are uploaded again.
+    """
+    server.fail_requests(3, status=503, operation='UploadPart')
+    data = os.urandom(4 * PART_SIZE)
+    write(S3Writer('/camera/day/video.h264', client, part_size=PART_SIZE), data)
+    assert(server.objects['camera/day/video.h264'] == data)
+    assert(client.stats()['retried_requests'] == 3)
+
+def test_failed_upload_is_aborted(server, client):
+    """
+    Ensures an upload whose parts keep failing is aborted and leaves no
+    object or open upload behind.
+    """
+    server.fail_requests(100, operation='UploadPart')
+    writer = S3Writer('/camera/day/video.h264', client, part_size=PART_SIZE)
+    write(writer, os.urandom(4 * PART_SIZE))
+    assert(writer.is_finished_writing())
+    assert(server.objects == {})
+    assert(server.uploads == {})
+    assert('AbortMultipartUpload' in server.operations)
+
+# ---- Helpers
+
+PART_SIZE = 64*1024
+
+def write(writer, data, append_size=50*1024):
+    for i in range(0, len(data), append_size):
+        writer.append_bytes(data[i:i+append_size], close=(i + append_size >= len(data)))
+
+# ---- Fixtures
+
+@pytest.fixture
+def server():
+    server = LocalS3Server(bucket='recordings', min_part_size=PART_SIZE)
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def client(server):
+    return S3Client(server.endpoint, 'recordings', 'access', 'secret', max_connections=4, retry_delay=0.01)
@@ -0,0 +1,85 @@
+import pytest
+import time
+from threading import Lock
+from watchtower.streamer.writer.upload_scheduler import UploadScheduler
+
+
+def test_lanes_upload_in_order(recorder):
+    """
+    Ensures the uploads of a lane run one at a time in the order they were
+    submitted, while other lanes upload alongside them.
+    """
+    scheduler = UploadScheduler(max_uploads=4, initial_uploads=4)
+    for part in range(5):
+        for lane in ['a', 'b']:
+            scheduler.submit(lane, recorder.upload(lane, part), size=1, done=recorder.done)
+    wait_for(lambda: recorder.done_count == 10)
+    for lane in ['a', 'b']:
+        assert([part for upload_lane, part in recorder.uploads if upload_lane == lane] == list(range(5)))
+    assert(recorder.max_running == 2)  # One upload per lane
+
+def test_concurrency_rises_with_throughput(recorder):
+    """
+    Ensures uploads are added while they raise the throughput.
+    """
+    scheduler = UploadScheduler(max_uploads=4, initial_uploads=1, adjust_interval=0.1)
+    for part in range(400):
+        scheduler.submit(part, recorder.upload(part, part), size=1024)
+    wait_for(lambda: scheduler.stats()['concurrency'] == 4)
+
+def test_concurrency_drops_on_errors():
+    """
+    Ensures the concurrency is halved when uploads fail.
+    """
+    scheduler = UploadScheduler(max_uploads=4, initial_uploads=4, adjust_interval=0.05)
+    for part in range(40):
+        scheduler.submit(part, failing_upload, size=1024)
+    wait_for(lambda: scheduler.stats()['concurrency'] == 1)
+    assert(scheduler.stats()['failed_uploads'] > 0)
+
+# ---- Helpers
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    assert(condition())
+
+def failing_upload():
+    time.sleep(0.01)
+    raise ConnectionError('Network is unreachable')
+
+# ---- Fixtures
+
+@pytest.fixture
+def recorder():
+    return UploadRecorder()
+
+# ---- Mock objects
+
+class UploadRecorder():
+    """
+    Creates uploads that take 10 ms each and records the order they ran in and
+    how many ran at once.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.uploads = []
+        self.running = 0
+        self.max_running = 0
+        self.done_count = 0
+
+    def upload(self, lane, part):
+        def upload():
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(0.01)
+            with self.lock:
+                self.running -= 1
+                self.uploads.append((lane, part))
+        return upload
+
+    def done(self):
+        with self.lock:
+            self.done_count += 1
@@ -0,0 +1,146 @@
+import os
+import pytest
+import sys
+import time
+from watchtower.streamer.writer import dropbox_writer
+from watchtower.streamer.writer.upload_scheduler import UploadScheduler
+from watchtower.streamer.writer.upload_spool import UploadSpool
+
+
+def test_failed_uploads_are_retried(tmp_path, flaky_uploader, scheduler):
+    """
+    Ensures files that fail to upload stay in the spool and are uploaded, in
+    order, once the network recovers.
+    """
+    spool = UploadSpool(str(tmp_path / 'spool'), flaky_uploader, base_delay=0.05, max_delay=0.1)
+    spool.start()
+    flaky_uploader.failures = sys.maxsize
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token='',
+                                          file_chunk_size=1024,
+                                          test_dropbox_uploader=flaky_uploader,
+                                          spool=spool,
+                                          scheduler=scheduler)
+    data = os.urandom(4096)
+    writer.append_bytes(data, close=True)
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+    assert(spool.stats()['pending_files'] == 4)
+
+    flaky_uploader.failures = 0
+    wait_for(lambda: spool.stats()['pending_files'] == 0)
+    assert(spool.stats()['pending_bytes'] == 0)
+    assert(flaky_uploader.uploads == ['/camera/video%d.h264' % i for i in range(4)])
+    assert(b''.join(flaky_uploader.files[path] for path in flaky_uploader.uploads) == data)
+    assert(os.listdir(tmp_path / 'spool') == [])
+
+def test_failed_session_parts_are_spooled(tmp_path, flaky_uploader, scheduler):
+    """
+    Ensures a file streamed with an upload session is uploaded whole from the
+    spool when one of its parts fails, and that files whose sessions succeed
+    aren't uploaded again.
+    """
+    spool = UploadSpool(str(tmp_path / 'spool'), flaky_uploader, base_delay=0.05, max_delay=0.1)
+    spool.start()
+    flaky_uploader.append_failures = 1
+    writer = dropbox_writer.DropboxWriter('/camera/video.h264',
+                                          dropbox_token='',
+                                          file_chunk_size=4096,
+                                          test_dropbox_uploader=flaky_uploader,
+                                          upload_sessions=True,
+                                          session_append_size=1024,
+                                          spool=spool,
+                                          scheduler=scheduler)
+    data = os.urandom(8192)
+    for i in range(0, len(data), 1024):
+        writer.append_bytes(data[i:i+1024], close=i + 1024 == len(data))
+    while not writer.is_finished_writing():
+        time.sleep(0.05)
+
+    wait_for(lambda: spool.stats()['pending_files'] == 0)
+    assert(sorted(flaky_uploader.uploads) == ['/camera/video0.h264', '/camera/video1.h264'])
+    assert(flaky_uploader.files['/camera/video0.h264'] + flaky_uploader.files['/camera/video1.h264'] == data)
+    assert(flaky_uploader.sessions == {})
+    assert(os.listdir(tmp_path / 'spool') == [])
+
+def test_pending_uploads_resume(tmp_path, flaky_uploader):
+    """
+    Ensures files journaled before a restart are uploaded by a new spool and
+    partially written entries are discarded.
+    """
+    directory = str(tmp_path / 'spool')
+    previous = UploadSpool(directory, flaky_uploader)
+    previous.add('/camera/trigger.jpg', b'jpeg data')
+    with open(os.path.join(directory, 'partial.tmp'), 'wb') as f:
+        f.write(b'partial')
+
+    spool = UploadSpool(directory, flaky_uploader)
+    assert(spool.stats()['pending_files'] == 1)
+    assert(not os.path.exists(os.path.join(directory, 'partial.tmp')))
+    spool.start()
+    wait_for(lambda: spool.stats()['pending_files'] == 0)
+    assert(flaky_uploader.files == {'/camera/trigger.jpg': b'jpeg data'})
+
+# ---- Helpers
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    assert(condition())
+
+# ---- Fixtures
+
+@pytest.fixture
+def flaky_uploader():
+    return MockFlakyUploader()
+
+@pytest.fixture
+def scheduler():
+    # One upload at a time, so files are spooled in order.
+    return UploadScheduler(max_uploads=1, initial_uploads=1)
+
+# ---- Mock objects
+
+class MockFlakyUploader():
+    """
+    Mock object to be used in place of a dropbox object. Fails the first
+    ``failures`` uploads and the first ``append_failures`` session appends,
+    and stores the rest in ``files`` and the order of their paths in
+    ``uploads``.
+    """
+    def __init__(self):
+        self.failures = 0
+        self.append_failures = 0
+        self.files = {}
+        self.uploads = []
+        self.sessions = {}
+
+    def files_upload(self, bts, path, mode=None):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('Network is unreachable')
+        assert(path not in self.files)
+        self.files[path] = bytes(bts)
+        self.uploads.append(path)
+
+    def files_upload_session_start(self, bts):
+        session_id = str(len(self.sessions)) + str(time.time())
+        self.sessions[session_id] = bytes(bts)
+        return MockSessionStartResult(session_id)
+
+    def files_upload_session_append_v2(self, bts, cursor):
+        if self.append_failures > 0:
+            self.append_failures -= 1
+            del self.sessions[cursor.session_id]
+            raise ConnectionError('Network is unreachable')
+        assert(len(self.sessions[cursor.session_id]) == cursor.offset)
+        self.sessions[cursor.session_id] += bts
+
+    def files_upload_session_finish(self, bts, cursor, commit):
+        self.files_upload_session_append_v2(bts, cursor)
+        self.files_upload(self.sessions.pop(cursor.session_id), commit.path)
+
+class MockSessionStartResult():
+    def __init__(self, session_id):
+        self.session_id = session_id
@@ -0,0 +1,150 @@
+import os
+import pytest
+import types
+import watchtower
+from flask import Flask
+
+DAY = '2021-01-01'
+TIME = '12.00.00'
+
+
+def test_recording_video_validates_path_first(app, client, monkeypatch):
+    """
+    Ensures a recording path that doesn't match the directory formats is
+    rejected before it is used to look for files.
+    """
+    isfile = os.path.isfile
+    checked = []
+    monkeypatch.setattr(watchtower.os.path, 'isfile', lambda path: checked.append(path) or isfile(path))
+    add_recording(app, 'video.mp4', b'mp4 data', day='../..')
+
+    response = client.get('/api/recordings/../../%s/video' % TIME)
+    assert(response.status_code == 422)
+    assert(checked == [])
+
+def test_recording_video_prefers_mp4(app, client):
+    add_recording(app, 'video.h264', b'h264 data')
+    response = client.get('/api/recordings/%s/%s/video' % (DAY, TIME))
+    assert(response.headers['X-Accel-Redirect'] == '/recordings/%s/%s/video.h264' % (DAY, TIME))
+
+    add_recording(app, 'video.mp4', b'mp4 data')
+    response = client.get('/api/recordings/%s/%s/video' % (DAY, TIME))
+    assert(response.headers['X-Accel-Redirect'] == '/recordings/%s/%s/video.mp4' % (DAY, TIME))
+
+def test_mp4_range_requests(app, client):
+    """
+    Ensures a Range request for a remuxed MP4 is answered with a 206 holding
+    the requested bytes, and an unsatisfiable range with a 416.
+    """
+    add_recording(app, 'video.h264', H264)
+    response = client.get(mp4_url())
+    assert(response.status_code == 200)
+    assert(response.headers['Accept-Ranges'] == 'bytes')
+    data = response.data
+    assert(int(response.headers['Content-Length']) == len(data))
+
+    response = client.get(mp4_url(), headers={'Range': 'bytes=10-19'})
+    assert(response.status_code == 206)
+    assert(response.headers['Content-Range'] == 'bytes 10-19/%d' % len(data))
+    assert(response.headers['Content-Length'] == '10')
+    assert(response.data == data[10:20])
+
+    response = client.get(mp4_url(), headers={'Range': 'bytes=%d-' % len(data)})
+    assert(response.status_code == 416)
+    assert(response.headers['Content-Range'] == 'bytes */%d' % len(data))
+
+def test_mp4_conditional_requests(app, client):
+    """
+    Ensures a range is only sent if the client's copy is current, and a
+    client with the current copy is told it hasn't changed.
+    """
+    add_recording(app, 'video.h264', H264)
+    response = client.get(mp4_url())
+    etag = response.headers['ETag']
+    data = response.data
+
+    response = client.get(mp4_url(), headers={'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+    assert(response.status_code == 200)
+    assert('Content-Range' not in response.headers)
+    assert(response.data == data)
+
+    response = client.get(mp4_url(), headers={'Range': 'bytes=10-19', 'If-Range': etag})
+    assert(response.status_code == 206)
+    assert(response.data == data[10:20])
+
+    response = client.get(mp4_url(), headers={'If-None-Match': etag})
+    assert(response.status_code == 304)
+    assert(response.headers['ETag'] == etag)
+    assert(response.data == b'')
+
+def test_recordings_are_handed_off_to_nginx(app, client):
+    """
+    Ensures recording files are sent by nginx with an X-Accel-Redirect header
+    when RECORDINGS_ACCEL_PATH is set, rather than read by the app.
+    """
+    add_recording(app, 'trigger.jpg', b'jpeg data')
+    response = client.get('/api/recordings/%s/%s/trigger' % (DAY, TIME))
+    assert(response.status_code == 200)
+    assert(response.headers['X-Accel-Redirect'] == '/recordings/%s/%s/trigger.jpg' % (DAY, TIME))
+    assert(response.headers['Content-Type'] == 'image/jpeg')
+    assert(response.headers['Content-Disposition'].startswith('attachment'))
+    assert(response.data == b'')
+
+    add_recording(app, 'video.mp4', b'mp4 data')
+    response = client.get(mp4_url())
+    assert(response.headers['X-Accel-Redirect'] == '/recordings/%s/%s/video.mp4' % (DAY, TIME))
+    assert(response.headers['Content-Disposition'].startswith('inline'))
+
+    response = client.get('/api/recordings/%s/12.00.01/trigger' % DAY)
+    assert(response.status_code == 404)
+
+# ---- Helpers
+
+def add_recording(app, name, data, day=DAY, time=TIME):
+    directory = os.path.join(app.instance_path, 'recordings', day, time)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), 'wb') as f:
+        f.write(data)
+
+def mp4_url():
+    return '/api/recordings/%s/%s/video.mp4' % (DAY, TIME)
+
+def nal(data):
+    return b'\x00\x00\x00\x01' + data
+
+def gop(frame_count):
+    return nal(SPS) + nal(PPS) + nal(IDR) + nal(P_FRAME) * (frame_count - 1)
+
+# ---- Fixtures
+
+SPS = b'\x67\x64\x00\x28\xac\x2c\xa8\x06\x70\x26\xf9\x74'  # 1640x1232
+PPS = b'\x68\xee\x3c\x80'
+IDR = b'\x65\x88\x84\x00\x21'
+P_FRAME = b'\x41\x9a\x02\x1c\x33'
+H264 = gop(3) + gop(3)
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__, instance_path=str(tmp_path / 'instance'))
+    app.config.from_mapping(DIR_DAY_FORMAT='%Y-%m-%d',
+                            DIR_TIME_FORMAT='%H.%M.%S',
+                            VIDEO_FRAMERATE=30,
+                            RECORDINGS_ACCEL_PATH='/recordings')
+    watchtower.add_api_routes(app, MockMainLoop())
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# ---- Mock objects
+
+class MockMainLoop():
+    """
+    Mock object to be used in place of a RunLoop. The recording routes don't
+    use the camera or the recording index.
+    """
+    def __init__(self):
+        self.camera = None
+        self.recording_index = None
+        self.mjpeg_broadcast = None
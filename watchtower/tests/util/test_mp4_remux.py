@@ -0,0 +1,206 @@
+import os
+import pytest
+import struct
+from io import BytesIO
+from watchtower.streamer.writer.disk_writer import DiskWriter
+from watchtower.streamer.writer.mp4_writer import TIMESCALE
+from watchtower.util.mp4_remux import RemuxedMP4, SampleIndexWriter, INDEX_SUFFIX, nal_units, sps_resolution
+
+
+def test_sps_resolution():
+    """
+    Ensures the resolution is read from SPS NAL units, including cropping and
+    emulation prevention bytes.
+    """
+    assert(sps_resolution(make_sps(1640, 1232)) == (1640, 1232))
+    assert(sps_resolution(make_sps(1920, 1080)) == (1920, 1080))
+    assert(sps_resolution(make_sps(640, 480, profile=66)) == (640, 480))
+    assert(sps_resolution(b'\x67\x64\x00\x00\x03' + make_sps(800, 600, level=0)[4:]) == (800, 600))
+    with pytest.raises(ValueError):
+        sps_resolution(make_sps(1920, 1080)[:6])
+
+def test_nal_units_across_chunks():
+    """
+    Ensures NAL units are found, without trailing zeros, when start codes
+    span the chunks read from the file.
+    """
+    stream = b'\x00\x00\x01\x09\x10\x00' + nal(SPS) + nal(IDR) + b'\x00\x00' + nal(P_FRAME) + bytes(9)
+    expected = list(nal_units(BytesIO(stream)))
+    assert(expected == [(3, 2), (10, len(SPS)), (14 + len(SPS), len(IDR)),
+                        (20 + len(SPS) + len(IDR), len(P_FRAME))])
+    for chunk_size in range(1, 9):
+        assert(list(nal_units(BytesIO(stream), chunk_size)) == expected)
+
+def test_remux(tmp_path):
+    """
+    Ensures the MP4 holds one sample per frame, with each start code replaced
+    by the NAL unit's length, and describes the video's resolution, duration
+    and keyframes.
+    """
+    h264_path = write_h264(tmp_path, nal(P_FRAME) + gop(3) + gop(2) + nal(SEI) + gop(4))
+    mp4 = RemuxedMP4(h264_path, framerate=30)
+    data = b''.join(mp4.iter_bytes())
+    assert(len(data) == mp4.size)
+
+    boxes = parse_boxes(data)
+    assert([box_type for box_type, _ in boxes] == [b'ftyp', b'moov', b'mdat'])
+    moov = boxes[1][1]
+    assert(find_box(moov, b'tkhd')[-8:] == struct.pack('>II', 1640 << 16, 1232 << 16))
+    assert(find_box(moov, b'stts')[4:] == struct.pack('>III', 1, 9, TIMESCALE // 30))
+    assert(find_box(moov, b'stss')[4:] == struct.pack('>IIII', 3, 1, 4, 6))
+    sizes = struct.unpack('>9I', find_box(moov, b'stsz')[12:])
+    chunk_offset = struct.unpack('>Q', find_box(moov, b'co64')[8:])[0]
+    mdat = boxes[2][1]
+    assert(data[chunk_offset:] == mdat)
+    assert(sum(sizes) == len(mdat))
+    assert(sizes[0] == 4 + len(IDR))
+    assert(sizes[5] == 8 + len(SEI) + len(IDR))  # The SEI belongs to the next frame.
+    assert(mdat[:4 + len(IDR) + 4] == struct.pack('>I', len(IDR)) + IDR + struct.pack('>I', len(P_FRAME)))
+
+def test_ranges(tmp_path):
+    """
+    Ensures any byte range of the MP4 can be read on its own.
+    """
+    h264_path = write_h264(tmp_path, gop(5) + gop(5))
+    mp4 = RemuxedMP4(h264_path, framerate=30)
+    data = b''.join(mp4.iter_bytes(chunk_size=7))
+    header_size = data.index(b'mdat') + 4
+    for start, stop in [(0, 10), (header_size - 3, header_size + 6), (header_size + 2, mp4.size),
+                        (mp4.size - 1, mp4.size), (50, 40), (0, mp4.size * 2)]:
+        assert(b''.join(mp4.iter_bytes(start, stop, chunk_size=7)) == data[start:stop])
+    # Bytes read from the recording are sent in bounded chunks after the header.
+    assert(all(len(chunk) <= 7 + 4 for chunk in list(mp4.iter_bytes(chunk_size=7))[1:]))
+
+def test_cached_index(tmp_path):
+    """
+    Ensures the sample index is cached next to the recording and rebuilt
+    when the recording changes. Zeros preallocated after a recording that is
+    still being written are ignored.
+    """
+    h264_path = write_h264(tmp_path, gop(3))
+    mp4 = RemuxedMP4(h264_path, framerate=30)
+    index_path = h264_path + INDEX_SUFFIX
+    assert(os.path.isfile(index_path))
+    index_mtime = os.stat(index_path).st_mtime_ns
+    assert(RemuxedMP4(h264_path, framerate=30).etag == mp4.etag)
+    assert(os.stat(index_path).st_mtime_ns == index_mtime)
+    assert(b''.join(RemuxedMP4(h264_path, framerate=30).iter_bytes()) == b''.join(mp4.iter_bytes()))
+
+    with open(h264_path, 'ab') as f:
+        f.write(gop(2) + bytes(200*1024))
+    grown = RemuxedMP4(h264_path, framerate=30)
+    assert(grown.etag != mp4.etag)
+    assert(struct.unpack('>I', find_box(parse_boxes(b''.join(grown.iter_bytes()))[1][1], b'stsz')[8:12])[0] == 5)
+
+def test_index_written_on_close(tmp_path):
+    """
+    Ensures a recording is listed as being written until its writer closes,
+    and that its index is then cached so requests don't scan it.
+    """
+    h264_path = os.path.join(str(tmp_path), 'video.h264')
+    writer = SampleIndexWriter(DiskWriter(h264_path, preallocate_bytes=1024*1024))
+    writer.append_bytes(gop(3))
+    assert(SampleIndexWriter.is_writing(h264_path))
+    assert(not os.path.exists(h264_path + INDEX_SUFFIX))
+    writer.append_bytes(gop(2), close=True)
+    assert(not SampleIndexWriter.is_writing(h264_path))
+    index_mtime = os.stat(h264_path + INDEX_SUFFIX).st_mtime_ns
+    mp4 = RemuxedMP4(h264_path, framerate=30)
+    assert(os.stat(h264_path + INDEX_SUFFIX).st_mtime_ns == index_mtime)
+    assert(struct.unpack('>I', find_box(parse_boxes(b''.join(mp4.iter_bytes()))[1][1], b'stsz')[8:12])[0] == 5)
+
+def test_undecodable_recordings(tmp_path):
+    with pytest.raises(ValueError):
+        RemuxedMP4(write_h264(tmp_path, nal(P_FRAME) * 3), framerate=30)
+    with pytest.raises(ValueError):
+        RemuxedMP4(write_h264(tmp_path, b''), framerate=30)
+
+# ---- Helpers
+
+class BitWriter:
+    def __init__(self):
+        self.bits = ''
+
+    def write(self, value, count):
+        self.bits += format(value, '0%db' % count) if count > 0 else ''
+
+    def ue(self, value):
+        code = format(value + 1, 'b')
+        self.bits += '0' * (len(code) - 1) + code
+
+    def rbsp(self):
+        bits = self.bits + '1'  # rbsp_stop_one_bit
+        bits += '0' * (-len(bits) % 8)
+        return bytes(int(bits[i:i+8], 2) for i in range(0, len(bits), 8))
+
+def make_sps(width, height, profile=100, level=40):
+    """
+    :return: an SPS NAL unit like the camera's encoder writes.
+    """
+    writer = BitWriter()
+    writer.write(profile, 8)
+    writer.write(0, 8)  # Constraint flags
+    writer.write(level, 8)
+    writer.ue(0)  # seq_parameter_set_id
+    if profile == 100:
+        writer.ue(1)  # 4:2:0
+        writer.ue(0)
+        writer.ue(0)
+        writer.write(0, 1)
+        writer.write(0, 1)  # No scaling matrices
+    writer.ue(4)  # log2_max_frame_num_minus4
+    writer.ue(0)  # pic_order_cnt_type
+    writer.ue(4)
+    writer.ue(1)  # max_num_ref_frames
+    writer.write(0, 1)
+    width_mbs, height_mbs = (width + 15) // 16, (height + 15) // 16
+    writer.ue(width_mbs - 1)
+    writer.ue(height_mbs - 1)
+    writer.write(1, 1)  # frame_mbs_only_flag
+    writer.write(1, 1)  # direct_8x8_inference_flag
+    crop_right, crop_bottom = (width_mbs * 16 - width) // 2, (height_mbs * 16 - height) // 2
+    writer.write(1 if crop_right or crop_bottom else 0, 1)
+    if crop_right or crop_bottom:
+        writer.ue(0)
+        writer.ue(crop_right)
+        writer.ue(0)
+        writer.ue(crop_bottom)
+    writer.write(0, 1)  # No VUI parameters
+    return b'\x67' + writer.rbsp()
+
+def nal(data):
+    return b'\x00\x00\x00\x01' + data
+
+def gop(frame_count):
+    return nal(SPS) + nal(PPS) + nal(IDR) + nal(P_FRAME) * (frame_count - 1)
+
+def write_h264(tmp_path, data):
+    path = os.path.join(str(tmp_path), 'video%d.h264' % len(os.listdir(str(tmp_path))))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def parse_boxes(data):
+    boxes = []
+    position = 0
+    while position < len(data):
+        size, box_type = struct.unpack('>I4s', data[position:position+8])
+        boxes.append((box_type, data[position+8:position+size]))
+        position += size
+    return boxes
+
+def find_box(data, box_type):
+    """
+    :return: the payload of the first box of a type within ``data``.
+    """
+    position = data.index(box_type) - 4
+    size = struct.unpack('>I', data[position:position+4])[0]
+    return data[position+8:position+size]
+
+# ---- Fixtures
+
+SPS = make_sps(1640, 1232)
+PPS = b'\x68\xee\x3c\x80'
+SEI = b'\x06\x05\x01\x80'
+IDR = b'\x65\x88\x84\x00\x21'
+P_FRAME = b'\x41\x9a\x02\x1c\x33'
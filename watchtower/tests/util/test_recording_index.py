@@ -0,0 +1,158 @@
+import os
+import pytest
+from watchtower.util import file_system as fs
+from watchtower.util.recording_index import RecordingIndex
+
+
+def test_rebuild_matches_file_system(tmp_path):
+    """
+    Ensures a new index lists the recordings directory like
+    file_system.all_recordings, newest first.
+    """
+    recordings_path = make_recordings(tmp_path, RECORDINGS)
+    index = create_index(tmp_path)
+    expected = fs.all_recordings(recordings_path, DAY_FORMAT, TIME_FORMAT)
+    assert(index.all_recordings() == expected)
+    assert(index.recording_days() == ['13-01-2021', '07-09-2020', '06-09-2020'])
+    assert(index.recording_times_for_day('06-09-2020') == ['18.21.52', '10.21.05'])
+    assert(index.recording_times_for_day('01-01-2020') == [])
+
+def test_incremental_updates(tmp_path):
+    """
+    Ensures added and deleted recordings are indexed without a rebuild, and
+    that the index persists across instances.
+    """
+    recordings_path = make_recordings(tmp_path, RECORDINGS)
+    index = create_index(tmp_path)
+    assert(index.add('13-01-2021', '23.59.59'))
+    assert(not index.add('2021-01-13', '23.59.59'))
+    assert(fs.delete_recording(recordings_path, '06-09-2020', '18.21.52', index=index))
+    assert(fs.delete_recording(recordings_path, '07-09-2020', index=index))
+    index.close()
+
+    index = create_index(tmp_path)
+    assert(index.all_recordings() == [
+        {'day': '13-01-2021', 'times': ['23.59.59', '08.00.00']},
+        {'day': '06-09-2020', 'times': ['10.21.05']}
+    ])
+
+def test_stale_index(tmp_path):
+    """
+    Ensures recordings removed outside of Watchtower can be deleted from the
+    index, and that rebuilding picks up changed directories.
+    """
+    recordings_path = make_recordings(tmp_path, RECORDINGS)
+    index = create_index(tmp_path)
+    fs.delete_recording(recordings_path, '13-01-2021')
+    assert(index.recording_times_for_day('13-01-2021') == ['08.00.00'])
+    assert(not fs.delete_recording(recordings_path, '13-01-2021', '08.00.00', index=index))
+    assert(index.recording_times_for_day('13-01-2021') == [])
+
+    os.makedirs(os.path.join(recordings_path, '01-02-2021', '12.00.00'))
+    assert(index.rebuild() == 5)
+    assert(index.recording_days()[0] == '01-02-2021')
+
+def test_format_change_rebuilds(tmp_path):
+    """
+    Ensures an index made for other directory formats is rebuilt.
+    """
+    make_recordings(tmp_path, RECORDINGS)
+    create_index(tmp_path).close()
+    index = RecordingIndex(os.path.join(str(tmp_path), 'recordings'),
+                           os.path.join(str(tmp_path), 'index.sqlite'),
+                           '%Y-%m-%d',
+                           TIME_FORMAT)
+    assert(index.all_recordings() == [])
+
+def test_pages(tmp_path):
+    """
+    Ensures paged listings add up to the full listing, and that cursors stay
+    valid when recordings are added.
+    """
+    make_recordings(tmp_path, RECORDINGS)
+    index = create_index(tmp_path)
+    page, cursor = index.recordings_page(limit=2)
+    assert(page == [
+        {'day': '13-01-2021', 'times': ['08.00.00']},
+        {'day': '07-09-2020', 'times': ['12.25.43']}
+    ])
+    index.add('14-01-2021', '09.00.00')
+    page, cursor = index.recordings_page(cursor=cursor, limit=2)
+    assert(page == [
+        {'day': '07-09-2020', 'times': ['12.13.12']},
+        {'day': '06-09-2020', 'times': ['18.21.52']}
+    ])
+    page, cursor = index.recordings_page(cursor=cursor, limit=2)
+    assert(page == [{'day': '06-09-2020', 'times': ['10.21.05']}])
+    assert(cursor is None)
+
+    times, cursor = index.recording_times_page('07-09-2020', limit=1)
+    assert(times == ['12.25.43'])
+    assert(index.recording_times_page('07-09-2020', cursor=cursor) == (['12.13.12'], None))
+    with pytest.raises(ValueError):
+        index.recordings_page(cursor='not a cursor')
+
+def test_date_range(tmp_path):
+    """
+    Ensures listings can be limited to a range of days, compared as dates
+    rather than as text.
+    """
+    make_recordings(tmp_path, RECORDINGS)
+    index = create_index(tmp_path)
+    assert([day['day'] for day in index.recordings_page(since='07-09-2020')[0]] == ['13-01-2021', '07-09-2020'])
+    assert([day['day'] for day in index.recordings_page(until='07-09-2020')[0]] == ['07-09-2020', '06-09-2020'])
+    assert(index.recordings_page(since='01-01-2021', until='31-12-2021')[0] == [
+        {'day': '13-01-2021', 'times': ['08.00.00']}
+    ])
+    with pytest.raises(ValueError):
+        index.recordings_page(since='2020-09-07')
+
+def test_etag(tmp_path):
+    """
+    Ensures the ETag changes only when recordings change, and differs between
+    rebuilt databases.
+    """
+    make_recordings(tmp_path, RECORDINGS)
+    index = create_index(tmp_path)
+    etag = index.etag
+    index.add('13-01-2021', '08.00.00')
+    index.remove('01-01-2020')
+    assert(index.etag == etag)
+    index.add('13-01-2021', '09.00.00')
+    assert(index.etag != etag)
+    etag = index.etag
+    index.close()
+    assert(create_index(tmp_path).etag == etag)
+
+    os.remove(os.path.join(str(tmp_path), 'index.sqlite'))
+    assert(create_index(tmp_path).etag != etag)
+
+# ---- Helpers
+
+def make_recordings(tmp_path, recordings):
+    recordings_path = os.path.join(str(tmp_path), 'recordings')
+    for day, times in recordings.items():
+        for time in times:
+            os.makedirs(os.path.join(recordings_path, day, time))
+    # Entries that don't match the formats aren't recordings.
+    os.makedirs(os.path.join(recordings_path, 'lost+found'))
+    os.makedirs(os.path.join(recordings_path, '07-09-2020', 'thumbnails'))
+    return recordings_path
+
+def create_index(tmp_path):
+    return RecordingIndex(os.path.join(str(tmp_path), 'recordings'),
+                          os.path.join(str(tmp_path), 'index.sqlite'),
+                          DAY_FORMAT,
+                          TIME_FORMAT)
+
+# ---- Fixtures
+
+# A day format that doesn't sort as text.
+DAY_FORMAT = '%d-%m-%Y'
+TIME_FORMAT = '%H.%M.%S'
+
+RECORDINGS = {
+    '06-09-2020': ['10.21.05', '18.21.52'],
+    '07-09-2020': ['12.13.12', '12.25.43'],
+    '13-01-2021': ['08.00.00']
+}
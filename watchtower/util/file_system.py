@@ -8,7 +8,8 @@ watcthower/
          YYYY-mm-dd/        <- Contains all recordings for that day.
             HH.MM.SS/       <- Contains a single recording triggered at that timestamp.
                trigger.jpg  <- The motion frame that triggered the recording.
-               video.h264   <- The full recording video.
+               video.h264   <- The full recording video. Named video.mp4
+                               when VIDEO_FORMAT is mp4.
 """
 
 import os
@@ -62,19 +63,24 @@ def all_recording_times_for_day(path, day_dirname, time_format):
     dirpath, dirnames, filenames = next(os.walk(path))
     return __dirnames_matching_format(dirnames, time_format)
 
-def delete_recording(path, day_dirname, time_dirname=None):
+def delete_recording(path, day_dirname, time_dirname=None, index=None):
     """
     If a time_dirname is supplied, this will delete the time directory within
     the provided day directory. Otherwise if just a day_dirname is supplied,
-    the day's whole directory tree will be deleted.
+    the day's whole directory tree will be deleted. The recording is also
+    removed from the RecordingIndex when one is supplied, including when its
+    directory no longer exists.
     """
     path = os.path.join(path, day_dirname)
     if time_dirname is not None:
         path = os.path.join(path, time_dirname)
+    deleted = False
     if os.path.exists(os.path.dirname(path)):
         try:
             shutil.rmtree(path)
-            return True
+            deleted = True
         except Exception as ex:
             print(ex)
-    return False
+    if index is not None and (deleted or not os.path.exists(path)):
+        index.remove(day_dirname, time_dirname)
+    return deleted
@@ -0,0 +1,185 @@
+"""An in-process stand-in for an S3-compatible object store.
+
+``LocalS3Server`` implements the requests used by ``S3Writer``: PutObject,
+GetObject and the multipart upload requests. It keeps objects in memory, so
+the S3 destination can be tested and benchmarked without a network or an
+account. Requests can be slowed down to emulate a remote store, and failures
+can be injected to exercise retries and aborts.
+
+Signatures aren't verified, but every request must be signed and its body
+must match the ``x-amz-content-sha256`` header.
+"""
+
+import hashlib
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+
+MIN_PART_SIZE = 5*1024*1024  # S3's minimum for every part except the last
+
+
+def error_body(code, message):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Error><Code>%s</Code><Message>%s</Message></Error>' % (code, message)).encode()
+
+
+class LocalS3Server:
+    """
+    Serves one bucket on a local port from a background thread.
+    """
+
+    def __init__(self, bucket='watchtower', min_part_size=MIN_PART_SIZE, latency=0):
+        """
+        :param bucket: the only bucket served.
+        :param min_part_size: the smallest part allowed before the last part
+        of a multipart upload.
+        :param latency: seconds added to every request.
+        """
+        self.bucket = bucket
+        self.min_part_size = min_part_size
+        self.latency = latency
+        self.objects = {}  # Object bytes keyed by key
+        self.uploads = {}  # Parts of open multipart uploads, keyed by upload ID
+        self.operations = []  # The operation of every request received
+        self.__failures = []  # Injected failures as lists of [count, status, operation]
+        self.__lock = Lock()
+        self.__server = None
+
+    @property
+    def endpoint(self):
+        host, port = self.__server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        """
+        Starts serving on a free port.
+
+        :return: the server's endpoint URL.
+        """
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler_class())
+        self.__server.daemon_threads = True
+        Thread(target=self.__server.serve_forever, name='LocalS3Server', daemon=True).start()
+        return self.endpoint
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def fail_requests(self, count, status=500, operation=None):
+        """
+        Makes the next ``count`` requests fail.
+
+        :param status: the HTTP status of the failures.
+        :param operation: if supplied, only requests for this operation, like
+        ``UploadPart``, fail.
+        """
+        with self.__lock:
+            self.__failures.append([count, status, operation])
+
+    def __injected_failure(self, operation):
+        with self.__lock:
+            self.operations.append(operation)
+            for failure in self.__failures:
+                if failure[0] > 0 and failure[2] in (None, operation):
+                    failure[0] -= 1
+                    return failure[1]
+        return None
+
+    def handle(self, method, path, query, headers, body):
+        """
+        :return: a tuple of the response's status, headers and body.
+        """
+        query = parse_qs(query, keep_blank_values=True)
+        bucket, _, key = unquote(path).lstrip('/').partition('/')
+        operation = self.__operation(method, query)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        status = self.__injected_failure(operation)
+        if status is not None:
+            return status, {}, error_body('InternalError', 'Injected failure.')
+        if not headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 '):
+            return 403, {}, error_body('AccessDenied', 'The request is not signed.')
+        if headers.get('x-amz-content-sha256') != hashlib.sha256(body).hexdigest():
+            return 400, {}, error_body('XAmzContentSHA256Mismatch', 'The body does not match its hash.')
+        if bucket != self.bucket:
+            return 404, {}, error_body('NoSuchBucket', 'The bucket does not exist.')
+
+        with self.__lock:
+            upload_id = query.get('uploadId', [None])[0]
+            if upload_id is not None and upload_id not in self.uploads:
+                return 404, {}, error_body('NoSuchUpload', 'The upload does not exist.')
+            if operation == 'PutObject':
+                self.objects[key] = body
+                return 200, {'ETag': '"%s"' % hashlib.md5(body).hexdigest()}, b''
+            elif operation == 'GetObject':
+                if key not in self.objects:
+                    return 404, {}, error_body('NoSuchKey', 'The key does not exist.')
+                return 200, {}, self.objects[key]
+            elif operation == 'CreateMultipartUpload':
+                upload_id = uuid.uuid4().hex
+                self.uploads[upload_id] = {}
+                return 200, {}, ('<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                                 '<UploadId>%s</UploadId></InitiateMultipartUploadResult>'
+                                 % (bucket, key, upload_id)).encode()
+            elif operation == 'UploadPart':
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                self.uploads[upload_id][int(query['partNumber'][0])] = (etag, body)
+                return 200, {'ETag': etag}, b''
+            elif operation == 'CompleteMultipartUpload':
+                parts = self.uploads[upload_id]
+                requested = [(int(part.find('PartNumber').text), part.find('ETag').text)
+                             for part in ElementTree.fromstring(body).iter('Part')]
+                for index, (number, etag) in enumerate(requested):
+                    if number not in parts or parts[number][0] != etag:
+                        return 400, {}, error_body('InvalidPart', 'Part %d was not uploaded.' % number)
+                    if index < len(requested) - 1 and len(parts[number][1]) < self.min_part_size:
+                        return 400, {}, error_body('EntityTooSmall', 'Part %d is too small.' % number)
+                self.objects[key] = b''.join(parts[number][1] for number, etag in requested)
+                del self.uploads[upload_id]
+                # Errors of this request may be sent with a 200 status, so the
+                # result is checked by clients.
+                return 200, {}, ('<CompleteMultipartUploadResult><Key>%s</Key></CompleteMultipartUploadResult>'
+                                 % key).encode()
+            elif operation == 'AbortMultipartUpload':
+                del self.uploads[upload_id]
+                return 204, {}, b''
+        return 501, {}, error_body('NotImplemented', 'The request is not supported.')
+
+    def __operation(self, method, query):
+        if method == 'PUT':
+            return 'UploadPart' if 'uploadId' in query else 'PutObject'
+        if method == 'POST':
+            return 'CreateMultipartUpload' if 'uploads' in query else 'CompleteMultipartUpload'
+        if method == 'DELETE' and 'uploadId' in query:
+            return 'AbortMultipartUpload'
+        if method == 'GET':
+            return 'GetObject'
+        return method
+
+    def __handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keeps connections open for reuse.
+
+            def __respond(self):
+                parts = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, headers, response_body = server.handle(self.command, parts.path, parts.query,
+                                                               self.headers, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            do_GET = do_PUT = do_POST = do_DELETE = __respond
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
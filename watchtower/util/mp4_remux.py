@@ -0,0 +1,517 @@
+"""Plays raw H.264 recordings as progressive MP4 files without rewriting them.
+
+A ``RemuxedMP4`` is a virtual MP4 file: an ftyp and moov box describing every
+frame, followed by an mdat box holding the frames of ``video.h264`` with each
+NAL unit's start code replaced by its length. The moov box is built from a
+sample index, which lists the offset and length of every NAL unit in the raw
+file and the frames they belong to. The index is computed once, by scanning
+the raw file, and cached next to it as ``video.h264.index``.
+
+Any byte range of the MP4 is read straight from the raw file, so browsers can
+seek in a recording and the MP4 is served in constant memory, whatever the
+recording's size.
+
+Recordings saved to disk are indexed by a ``SampleIndexWriter`` as soon as
+they are closed, on the writer's thread, so requests don't have to scan them.
+"""
+
+import logging
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timezone
+from threading import Lock
+from ..streamer.writer import byte_writer
+from ..streamer.writer.mp4_writer import (START_CODE, TIMESCALE, TRACK_ID, MATRIX, NAL_SLICE, NAL_IDR_SLICE,
+                                          NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD, box, full_box, sample_entry)
+
+INDEX_SUFFIX = '.index'
+INDEX_MAGIC = b'WTI1'
+INDEX_HEADER_FORMAT = '<4sQQHHIII'
+CHUNK_SIZE = 64*1024  # The most bytes read from the raw file at once
+LENGTH_SIZE = 4  # The bytes of the length that replaces each start code
+
+# Profiles whose SPS describes the chroma format, bit depth and scaling lists
+CHROMA_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+
+class BitReader:
+    """
+    Reads the bits and Exp-Golomb numbers of an H.264 RBSP.
+    """
+
+    def __init__(self, data):
+        self.__data = data
+        self.__position = 0
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            index = self.__position >> 3
+            if index >= len(self.__data):
+                raise ValueError('Read past the end of the data.')
+            value = (value << 1) | ((self.__data[index] >> (7 - (self.__position & 7))) & 1)
+            self.__position += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.bits(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def sps_resolution(sps):
+    """
+    :param sps: an SPS NAL unit, starting with its header byte.
+    :return: a tuple of the width and height of the video, after cropping.
+    :raises ValueError: if the SPS is truncated.
+    """
+    reader = BitReader(sps[1:].replace(b'\x00\x00\x03', b'\x00\x00'))  # Emulation prevention
+    profile = reader.bits(8)
+    reader.bits(16)  # Constraint flags and level
+    reader.ue()  # seq_parameter_set_id
+    chroma_format = 1
+    separate_planes = 0
+    if profile in CHROMA_PROFILES:
+        chroma_format = reader.ue()
+        if chroma_format == 3:
+            separate_planes = reader.bits(1)
+        reader.ue()  # bit_depth_luma_minus8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.bits(1)  # qpprime_y_zero_transform_bypass_flag
+        if reader.bits(1):  # seq_scaling_matrix_present_flag
+            for i in range(12 if chroma_format == 3 else 8):
+                if reader.bits(1):
+                    skip_scaling_list(reader, 16 if i < 6 else 64)
+    reader.ue()  # log2_max_frame_num_minus4
+    poc_type = reader.ue()
+    if poc_type == 0:
+        reader.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif poc_type == 1:
+        reader.bits(1)  # delta_pic_order_always_zero_flag
+        reader.se()  # offset_for_non_ref_pic
+        reader.se()  # offset_for_top_to_bottom_field
+        for _ in range(reader.ue()):
+            reader.se()  # offset_for_ref_frame
+    reader.ue()  # max_num_ref_frames
+    reader.bits(1)  # gaps_in_frame_num_value_allowed_flag
+    width_mbs = reader.ue() + 1
+    height_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bits(1)
+    if not frame_mbs_only:
+        reader.bits(1)  # mb_adaptive_frame_field_flag
+    reader.bits(1)  # direct_8x8_inference_flag
+    left = right = top = bottom = 0
+    if reader.bits(1):  # frame_cropping_flag
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+    if chroma_format == 0 or separate_planes:
+        crop_x, crop_y = 1, 2 - frame_mbs_only
+    else:
+        crop_x = 1 if chroma_format == 3 else 2
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+    return (width_mbs * 16 - crop_x * (left + right),
+            (2 - frame_mbs_only) * height_map_units * 16 - crop_y * (top + bottom))
+
+
+def skip_scaling_list(reader, size):
+    last_scale = next_scale = 8
+    for _ in range(size):
+        if next_scale != 0:
+            next_scale = (last_scale + reader.se() + 256) % 256
+        last_scale = next_scale or last_scale
+
+
+def nal_units(f, chunk_size=CHUNK_SIZE):
+    """
+    Finds the NAL units of an H.264 byte stream, reading ``chunk_size`` bytes
+    at a time.
+
+    :param f: the stream's file.
+    :return: a generator of tuples of each NAL unit's offset and length,
+    without its start code and trailing zeros.
+    """
+    buffer = bytearray()
+    base = 0  # The file offset of the buffer's first byte
+    scanned = 0  # The buffer index up to which NAL unit ends are known
+    nal_start = nal_end = None
+
+    def scan(stop):
+        # Zeros precede 4 byte start codes, and fill space preallocated for a
+        # recording that is still being written.
+        nonlocal nal_end, scanned
+        if nal_start is not None and stop > scanned:
+            length = len(buffer[scanned:stop].rstrip(b'\x00'))
+            if length > 0:
+                nal_end = base + scanned + length
+        scanned = max(scanned, stop)
+
+    while True:
+        bts = f.read(chunk_size)
+        buffer += bts
+        while True:
+            index = buffer.find(START_CODE, scanned)
+            if index < 0:
+                break
+            scan(index)
+            if nal_start is not None and nal_end > nal_start:
+                yield nal_start, nal_end - nal_start
+            nal_start = nal_end = base + index + len(START_CODE)
+            scanned = index + len(START_CODE)
+        if len(bts) == 0:
+            break
+        # Keep the last bytes, which may begin a start code.
+        cut = max(len(buffer) - len(START_CODE) + 1, 0)
+        scan(cut)
+        cut = min(cut, scanned)
+        del buffer[:cut]
+        base += cut
+        scanned -= cut
+    scan(len(buffer))
+    if nal_start is not None and nal_end > nal_start:
+        yield nal_start, nal_end - nal_start
+
+
+class SampleIndex:
+    """
+    Lists the frames of a raw H.264 file. Frames are decoded from their NAL
+    units like ``FragmentedMP4Writer`` does: frames before the first SPS, PPS
+    and IDR frame are dropped, and SPS, PPS and access unit delimiter NAL units
+    are left out of the frames, since the MP4 describes them once.
+    """
+
+    def __init__(self, file_size, mtime_ns, sps, pps, nal_offsets, nal_lengths, sample_nal_counts, sync_samples):
+        """
+        :param file_size: the size of the raw file that was indexed.
+        :param mtime_ns: the modification time of the raw file that was indexed.
+        :param nal_offsets: an array of the offset of every NAL unit in a frame.
+        :param nal_lengths: an array of the length of every NAL unit in a frame.
+        :param sample_nal_counts: an array of the number of NAL units in each
+        frame.
+        :param sync_samples: an array of the numbers, starting at 1, of the
+        frames that are IDR frames.
+        """
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.sps = sps
+        self.pps = pps
+        self.nal_offsets = nal_offsets
+        self.nal_lengths = nal_lengths
+        self.sample_nal_counts = sample_nal_counts
+        self.sync_samples = sync_samples
+
+    @classmethod
+    def build(cls, h264_path):
+        """
+        Scans a raw H.264 file in chunks, so it is never held in memory.
+
+        :return: the file's ``SampleIndex``.
+        """
+        stat = os.stat(h264_path)
+        index = cls(stat.st_size, stat.st_mtime_ns, None, None, array('Q'), array('I'), array('I'), array('I'))
+        with open(h264_path, 'rb') as f, open(h264_path, 'rb') as nal_file:
+            access_unit = []  # Tuples of the offset, length and type of the frame's NAL units
+            has_picture = False
+            started = False
+            sps = pps = None
+
+            def finish_access_unit():
+                nonlocal access_unit, has_picture, started
+                if not has_picture:
+                    return
+                nals = access_unit
+                access_unit = []
+                has_picture = False
+                sync = any(nal_type == NAL_IDR_SLICE for _, _, nal_type in nals)
+                if not started:
+                    if not sync or sps is None or pps is None:
+                        return  # Can't be decoded
+                    index.sps, index.pps = sps, pps
+                    started = True
+                for offset, length, _ in nals:
+                    index.nal_offsets.append(offset)
+                    index.nal_lengths.append(length)
+                index.sample_nal_counts.append(len(nals))
+                if sync:
+                    index.sync_samples.append(len(index.sample_nal_counts))
+
+            for offset, length in nal_units(f):
+                # The scan only finds NAL units, so their headers are read
+                # separately.
+                nal_file.seek(offset)
+                header = nal_file.read(2)
+                nal_type = header[0] & 0x1F
+                if nal_type in (NAL_SPS, NAL_PPS, NAL_AUD, NAL_SEI):
+                    # These precede the slices of the next frame.
+                    finish_access_unit()
+                    if nal_type in (NAL_SPS, NAL_PPS):
+                        nal_file.seek(offset)
+                        parameter_set = nal_file.read(length)
+                        if nal_type == NAL_SPS:
+                            sps = parameter_set
+                        else:
+                            pps = parameter_set
+                    elif nal_type == NAL_SEI:
+                        access_unit.append((offset, length, nal_type))
+                elif nal_type in (NAL_SLICE, NAL_IDR_SLICE):
+                    # Only the first slice of a frame has first_mb_in_slice 0.
+                    if length > 1 and header[1] & 0x80:
+                        finish_access_unit()
+                    access_unit.append((offset, length, nal_type))
+                    has_picture = True
+                else:
+                    access_unit.append((offset, length, nal_type))
+            finish_access_unit()
+        return index
+
+    @classmethod
+    def load(cls, index_path, file_size, mtime_ns):
+        """
+        :return: the cached ``SampleIndex``, or None if the cache doesn't
+        exist, can't be read or describes another version of the raw file.
+        """
+        try:
+            with open(index_path, 'rb') as f:
+                header = f.read(struct.calcsize(INDEX_HEADER_FORMAT))
+                (magic, cached_size, cached_mtime, sps_length, pps_length,
+                 nal_count, sample_count, sync_count) = struct.unpack(INDEX_HEADER_FORMAT, header)
+                if magic != INDEX_MAGIC or cached_size != file_size or cached_mtime != mtime_ns:
+                    return None
+                sps = f.read(sps_length) or None
+                pps = f.read(pps_length) or None
+                arrays = []
+                for typecode, count in (('Q', nal_count), ('I', nal_count), ('I', sample_count), ('I', sync_count)):
+                    values = array(typecode)
+                    values.fromfile(f, count)
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                    arrays.append(values)
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(file_size, mtime_ns, sps, pps, *arrays)
+
+    def save(self, index_path):
+        """
+        Writes the index to a cache file. The file is replaced atomically, so
+        a reader never sees a partial index.
+        """
+        temp_path = index_path + '.tmp'
+        sps, pps = self.sps or b'', self.pps or b''
+        with open(temp_path, 'wb') as f:
+            f.write(struct.pack(INDEX_HEADER_FORMAT, INDEX_MAGIC, self.file_size, self.mtime_ns,
+                                len(sps), len(pps),
+                                len(self.nal_offsets), len(self.sample_nal_counts), len(self.sync_samples)))
+            f.write(sps)
+            f.write(pps)
+            for values in (self.nal_offsets, self.nal_lengths, self.sample_nal_counts, self.sync_samples):
+                if sys.byteorder == 'big':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                values.tofile(f)
+        os.replace(temp_path, index_path)
+
+
+class SampleIndexWriter(byte_writer.ByteWriter):
+    """
+    Wraps the ``ByteWriter`` of a raw H.264 file and caches the file's
+    ``SampleIndex`` once the writer is closed. Until then the file is listed
+    as being written, so it isn't indexed while it still changes.
+    """
+
+    __writing = set()  # The paths of the raw files being written
+    __writing_lock = Lock()
+
+    @classmethod
+    def is_writing(cls, h264_path):
+        """
+        :return: True if the raw file is still being written.
+        """
+        with cls.__writing_lock:
+            return os.path.abspath(h264_path) in cls.__writing
+
+    def __init__(self, writer):
+        """
+        :param writer: the ``ByteWriter`` that saves the raw file to its
+        ``full_path``.
+        """
+        super(SampleIndexWriter, self).__init__(writer.full_path)
+        self.__writer = writer
+        self.__path = os.path.abspath(writer.full_path)
+        with SampleIndexWriter.__writing_lock:
+            SampleIndexWriter.__writing.add(self.__path)
+
+    def append_bytes(self, bts, close=False):
+        try:
+            self.__writer.append_bytes(bts, close)
+        finally:
+            if close:
+                self.__index()
+
+    def __index(self):
+        try:
+            SampleIndex.build(self.__path).save(self.__path + INDEX_SUFFIX)
+        except OSError as e:
+            logging.getLogger(__name__).warning('Sample index of "%s" could not be saved: %s' % (self.__path, e))
+        finally:
+            with SampleIndexWriter.__writing_lock:
+                SampleIndexWriter.__writing.discard(self.__path)
+
+
+def movie_header(index, framerate):
+    """
+    :return: the ftyp and moov boxes and the mdat box header of a progressive
+    MP4 holding every frame of the index, in one chunk.
+    """
+    width, height = sps_resolution(index.sps)
+    sample_duration = int(round(TIMESCALE / float(framerate)))
+    sample_count = len(index.sample_nal_counts)
+    duration = sample_count * sample_duration
+    sample_sizes = array('I')
+    position = 0
+    for count in index.sample_nal_counts:
+        lengths = index.nal_lengths[position:position+count]
+        sample_sizes.append(sum(lengths) + LENGTH_SIZE * count)
+        position += count
+    mdat_size = sum(sample_sizes)
+
+    def moov(chunk_offset):
+        stbl = box(b'stbl',
+                   full_box(b'stsd', 0, 0, struct.pack('>I', 1), sample_entry(index.sps, index.pps, width, height)),
+                   full_box(b'stts', 0, 0, struct.pack('>III', 1, sample_count, sample_duration)),
+                   full_box(b'stss', 0, 0, struct.pack('>%dI' % (len(index.sync_samples) + 1),
+                                                       len(index.sync_samples), *index.sync_samples)),
+                   full_box(b'stsc', 0, 0, struct.pack('>IIII', 1, 1, sample_count, 1)),
+                   full_box(b'stsz', 0, 0, struct.pack('>%dI' % (sample_count + 2), 0, sample_count, *sample_sizes)),
+                   full_box(b'co64', 0, 0, struct.pack('>IQ', 1, chunk_offset)))
+        minf = box(b'minf',
+                   full_box(b'vmhd', 0, 1, bytes(8)),
+                   box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+                   stbl)
+        mdia = box(b'mdia',
+                   full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, duration, 0x55C4, 0)),
+                   full_box(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'vide'), bytes(12), b'VideoHandler\x00'),
+                   minf)
+        trak = box(b'trak',
+                   full_box(b'tkhd', 0, 0x3,
+                            struct.pack('>IIIII', 0, 0, TRACK_ID, 0, duration), bytes(8),
+                            struct.pack('>hhhH', 0, 0, 0, 0), MATRIX,
+                            struct.pack('>II', width << 16, height << 16)),
+                   mdia)
+        return box(b'moov',
+                   full_box(b'mvhd', 0, 0,
+                            struct.pack('>IIIIIH', 0, 0, TIMESCALE, duration, 0x00010000, 0x0100), bytes(10),
+                            MATRIX, bytes(24), struct.pack('>I', TRACK_ID + 1)),
+                   trak)
+
+    ftyp = box(b'ftyp', b'isom', struct.pack('>I', 512), b'isom', b'iso2', b'avc1', b'mp41')
+    if mdat_size + 8 <= 0xFFFFFFFF:
+        mdat_header = struct.pack('>I4s', mdat_size + 8, b'mdat')
+    else:
+        mdat_header = struct.pack('>I4sQ', 1, b'mdat', mdat_size + 16)
+    # The moov's size doesn't depend on the chunk offset's value.
+    header_size = len(ftyp) + len(moov(0)) + len(mdat_header)
+    return ftyp + moov(header_size) + mdat_header
+
+
+class RemuxedMP4:
+    """
+    A progressive MP4 made from a raw H.264 recording. The raw file's frames
+    are assumed to be ``framerate`` frames per second apart, since the byte
+    stream carries no timestamps.
+    """
+
+    def __init__(self, h264_path, framerate, index_path=None):
+        """
+        :param h264_path: the raw H.264 file.
+        :param framerate: the video's frames per second.
+        :param index_path: the sample index's cache file. Defaults to the raw
+        file's path with ``INDEX_SUFFIX`` appended.
+        :raises ValueError: if the raw file has no frames that can be decoded.
+        """
+        self.__h264_path = h264_path
+        self.__framerate = framerate
+        self.logger = logging.getLogger(__name__)
+        index_path = index_path or h264_path + INDEX_SUFFIX
+        stat = os.stat(h264_path)
+        self.__index = SampleIndex.load(index_path, stat.st_size, stat.st_mtime_ns)
+        if self.__index is None:
+            self.__index = SampleIndex.build(h264_path)
+            try:
+                self.__index.save(index_path)
+            except OSError as e:
+                self.logger.warning('Sample index of "%s" could not be cached: %s' % (h264_path, e))
+        if self.__index.sps is None or len(self.__index.sample_nal_counts) == 0:
+            raise ValueError('"%s" has no frames that can be decoded.' % h264_path)
+        self.__header = movie_header(self.__index, framerate)
+        # The MP4 offset of each NAL unit's length, for seeking.
+        self.__nal_positions = array('Q')
+        position = len(self.__header)
+        for length in self.__index.nal_lengths:
+            self.__nal_positions.append(position)
+            position += LENGTH_SIZE + length
+        self.__size = position
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def etag(self):
+        """
+        A strong entity tag, which changes with the raw file and the
+        framerate.
+        """
+        return '%x-%x-%s' % (self.__index.file_size, self.__index.mtime_ns, self.__framerate)
+
+    @property
+    def last_modified(self):
+        return datetime.fromtimestamp(self.__index.mtime_ns / 1e9, timezone.utc)
+
+    def iter_bytes(self, start=0, stop=None, chunk_size=CHUNK_SIZE):
+        """
+        :param start: the offset of the first byte.
+        :param stop: the offset after the last byte. Defaults to the MP4's size.
+        :return: a generator of the MP4's bytes in chunks of about
+        ``chunk_size`` bytes.
+        """
+        stop = self.__size if stop is None else min(stop, self.__size)
+        position = start
+        output = bytearray()
+        if position < len(self.__header):
+            output += self.__header[position:stop]
+            position = min(stop, len(self.__header))
+        if position >= stop:
+            if len(output) > 0:
+                yield bytes(output)
+            return
+        with open(self.__h264_path, 'rb') as f:
+            nal = bisect_right(self.__nal_positions, position) - 1
+            while position < stop:
+                nal_position = self.__nal_positions[nal]
+                length = self.__index.nal_lengths[nal]
+                skip = position - nal_position
+                if skip < LENGTH_SIZE:
+                    output += struct.pack('>I', length)[skip:LENGTH_SIZE][:stop - position]
+                    position = min(stop, nal_position + LENGTH_SIZE)
+                    skip = LENGTH_SIZE
+                # Read the NAL unit from the raw file in bounded chunks.
+                end = min(stop, nal_position + LENGTH_SIZE + length)
+                f.seek(self.__index.nal_offsets[nal] + skip - LENGTH_SIZE)
+                while position < end:
+                    if len(output) >= chunk_size:
+                        yield bytes(output)
+                        output = bytearray()
+                    bts = f.read(min(end - position, chunk_size - len(output)))
+                    if len(bts) == 0:
+                        raise IOError('"%s" was truncated.' % self.__h264_path)
+                    output += bts
+                    position += len(bts)
+                nal += 1
+        if len(output) > 0:
+            yield bytes(output)
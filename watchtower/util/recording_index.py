@@ -0,0 +1,288 @@
+"""A persistent index of the recordings in the recordings directory.
+
+Listing recordings with ``file_system.all_recordings`` walks every day
+directory and parses every directory name, which takes seconds on an SD card
+once a camera has saved a year of motion events. ``RecordingIndex`` keeps the
+day and time of every recording in a SQLite database instead. It is updated
+as recordings are saved and deleted, so listings are a single indexed query.
+
+The index is rebuilt from the recordings directory when its database is
+created, when the configured day or time format changes, and on demand with
+``rebuild()``. Days that contain no recordings aren't listed.
+
+Every change to the index increments its generation, which ``etag``
+combines with an ID made when the database is created. Clients that saved a
+listing's ETag can tell it is still current without listing it again.
+Listings can be paged with the opaque cursor returned with each page.
+"""
+
+import base64
+import itertools
+import logging
+import os
+import sqlite3
+import uuid
+from datetime import datetime
+from threading import Lock
+from . import file_system as fs
+
+SCHEMA_VERSION = 2
+
+
+class RecordingIndex:
+    """
+    Indexes recordings by their day and time directory names. Each name is
+    stored with a sortable key made from its parsed date, so listings are
+    ordered newest first like ``file_system.all_recordings``, whatever the
+    configured formats are.
+
+    An index can be shared by threads.
+    """
+
+    def __init__(self, recordings_path, index_path, day_format, time_format):
+        """
+        :param recordings_path: the directory containing the day directories.
+        :param index_path: the SQLite database file. It is created if it
+        doesn't exist.
+        :param day_format: the strftime format of day directory names.
+        :param time_format: the strftime format of time directory names.
+        """
+        self.__recordings_path = recordings_path
+        self.__day_format = day_format
+        self.__time_format = time_format
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(index_path, check_same_thread=False)
+        # WAL keeps each insert to a single sequential write on the SD card.
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.logger = logging.getLogger(__name__)
+        if self.__create_schema():
+            self.rebuild()
+
+    def add(self, day_dirname, time_dirname):
+        """
+        Adds a recording. Adding a recording that is already indexed does
+        nothing.
+
+        :return: False if a name doesn't match its format.
+        """
+        keys = self.__keys(day_dirname, time_dirname)
+        if keys is None:
+            self.logger.warning('Not indexing "%s/%s" which does not match the directory formats.'
+                                % (day_dirname, time_dirname))
+            return False
+        with self.__lock, self.__connection:
+            cursor = self.__connection.execute(
+                'INSERT OR IGNORE INTO recordings (day, time, day_key, time_key) VALUES (?, ?, ?, ?)',
+                (day_dirname, time_dirname) + keys
+            )
+            if cursor.rowcount > 0:
+                self.__increment_generation()
+        return True
+
+    def remove(self, day_dirname, time_dirname=None):
+        """
+        Removes a recording, or every recording of a day when no
+        ``time_dirname`` is supplied.
+        """
+        with self.__lock, self.__connection:
+            if time_dirname is None:
+                cursor = self.__connection.execute('DELETE FROM recordings WHERE day = ?', (day_dirname,))
+            else:
+                cursor = self.__connection.execute('DELETE FROM recordings WHERE day = ? AND time = ?',
+                                                   (day_dirname, time_dirname))
+            if cursor.rowcount > 0:
+                self.__increment_generation()
+
+    @property
+    def etag(self):
+        """
+        An entity tag that changes whenever a recording is added or removed.
+        """
+        rows = dict(self.__query("SELECT name, value FROM settings WHERE name IN ('id', 'generation')"))
+        return '%s-%s' % (rows['id'], rows['generation'])
+
+    def all_recordings(self):
+        """
+        :return: an array of dictionaries where each dictionary represents one
+        day, like ``file_system.all_recordings``.
+        """
+        return self.recordings_page()[0]
+
+    def recordings_page(self, since=None, until=None, cursor=None, limit=None):
+        """
+        Lists a page of recordings, newest first. A day's recordings may be
+        split across two pages.
+
+        :param since: if supplied, the first day listed.
+        :param until: if supplied, the last day listed.
+        :param cursor: the cursor returned with the previous page, or None for
+        the first page.
+        :param limit: the most recordings listed, or None to list them all.
+        :return: a tuple of an array of dictionaries where each dictionary
+        represents one day, and the cursor of the next page or None if this is
+        the last page.
+        :raises ValueError: if a day doesn't match the day format or the
+        cursor is invalid.
+        """
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append('day_key >= ?')
+            parameters.append(datetime.strptime(since, self.__day_format).isoformat())
+        if until is not None:
+            conditions.append('day_key <= ?')
+            parameters.append(datetime.strptime(until, self.__day_format).isoformat())
+        rows, next_cursor = self.__page(conditions, parameters, cursor, limit)
+        days = [{'day': day, 'times': [row[1] for row in rows]}
+                for day, rows in itertools.groupby(rows, key=lambda row: row[0])]
+        return days, next_cursor
+
+    def recording_days(self):
+        """
+        :return: an array of every day with recordings, newest first.
+        """
+        return [row[0] for row in self.__query(
+            'SELECT day FROM recordings GROUP BY day ORDER BY MAX(day_key) DESC')]
+
+    def recording_times_for_day(self, day_dirname):
+        """
+        :return: an array of the times of every recording of a day, newest
+        first.
+        """
+        return self.recording_times_page(day_dirname)[0]
+
+    def recording_times_page(self, day_dirname, cursor=None, limit=None):
+        """
+        Lists a page of the times of a day's recordings, newest first.
+
+        :param cursor: the cursor returned with the previous page, or None for
+        the first page.
+        :param limit: the most times listed, or None to list them all.
+        :return: a tuple of the array of times and the cursor of the next page
+        or None if this is the last page.
+        :raises ValueError: if the cursor is invalid.
+        """
+        rows, next_cursor = self.__page(['day = ?'], [day_dirname], cursor, limit)
+        return [row[1] for row in rows], next_cursor
+
+    def rebuild(self):
+        """
+        Replaces the index with the recordings found in the recordings
+        directory.
+
+        :return: the number of recordings indexed.
+        """
+        recordings = []
+        if os.path.isdir(self.__recordings_path):
+            for day in fs.all_recordings(self.__recordings_path, self.__day_format, self.__time_format):
+                for time in day['times']:
+                    recordings.append((day['day'], time) + self.__keys(day['day'], time))
+        with self.__lock, self.__connection:
+            self.__connection.execute('DELETE FROM recordings')
+            self.__connection.executemany(
+                'INSERT OR IGNORE INTO recordings (day, time, day_key, time_key) VALUES (?, ?, ?, ?)',
+                recordings
+            )
+            self.__increment_generation()
+        self.logger.info('Indexed %d recordings.' % len(recordings))
+        return len(recordings)
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __keys(self, day_dirname, time_dirname):
+        """
+        :return: a tuple of the sortable day and time keys, or None if a name
+        doesn't match its format.
+        """
+        try:
+            return (datetime.strptime(day_dirname, self.__day_format).isoformat(),
+                    datetime.strptime(time_dirname, self.__time_format).isoformat())
+        except ValueError:
+            return None
+
+    def __query(self, sql, parameters=()):
+        with self.__lock:
+            return self.__connection.execute(sql, parameters).fetchall()
+
+    def __page(self, conditions, parameters, cursor, limit):
+        """
+        Selects a page of recordings with keyset pagination. A cursor holds
+        the keys of the last recording of its page, so pages stay consistent
+        as recordings are added and removed.
+
+        :return: a tuple of the rows of the page and the cursor of the next
+        page, or None.
+        """
+        conditions, parameters = list(conditions), list(parameters)
+        if cursor is not None:
+            conditions.append('(day_key, time_key) < (?, ?)')
+            parameters.extend(decode_cursor(cursor))
+        sql = 'SELECT day, time, day_key, time_key FROM recordings'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY day_key DESC, time_key DESC'
+        if limit is not None:
+            # One more row tells whether there is another page.
+            sql += ' LIMIT ?'
+            parameters.append(limit + 1)
+        rows = self.__query(sql, parameters)
+        if limit is None or len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1][2], rows[-1][3])
+
+    def __increment_generation(self):
+        """
+        Must be called within a transaction that changed the index.
+        """
+        self.__connection.execute(
+            "UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE name = 'generation'")
+
+    def __create_schema(self):
+        """
+        Creates the index's tables, replacing any made by another schema
+        version or for other directory formats.
+
+        :return: True if the index is new and must be rebuilt.
+        """
+        formats = '%s\n%s' % (self.__day_format, self.__time_format)
+        with self.__lock, self.__connection:
+            version = self.__connection.execute('PRAGMA user_version').fetchone()[0]
+            if version == SCHEMA_VERSION:
+                row = self.__connection.execute("SELECT value FROM settings WHERE name = 'formats'").fetchone()
+                if row is not None and row[0] == formats:
+                    return False
+            self.__connection.execute('DROP TABLE IF EXISTS recordings')
+            self.__connection.execute('DROP TABLE IF EXISTS settings')
+            self.__connection.execute(
+                'CREATE TABLE recordings (day TEXT NOT NULL, time TEXT NOT NULL, '
+                'day_key TEXT NOT NULL, time_key TEXT NOT NULL, PRIMARY KEY (day, time))'
+            )
+            self.__connection.execute('CREATE INDEX recordings_by_date ON recordings (day_key, time_key)')
+            self.__connection.execute('CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.__connection.executemany('INSERT INTO settings (name, value) VALUES (?, ?)',
+                                          [('formats', formats), ('id', uuid.uuid4().hex[:8]), ('generation', '0')])
+            self.__connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        return True
+
+
+def encode_cursor(day_key, time_key):
+    """
+    :return: an opaque, URL-safe cursor holding the keys of a recording.
+    """
+    return base64.urlsafe_b64encode(('%s|%s' % (day_key, time_key)).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :return: a tuple of the day and time keys held by a cursor.
+    :raises ValueError: if the cursor is invalid.
+    """
+    keys = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+    if len(keys) != 2:
+        raise ValueError('Invalid cursor "%s".' % cursor)
+    for key in keys:
+        datetime.fromisoformat(key)
+    return tuple(keys)